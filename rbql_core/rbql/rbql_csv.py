@@ -2,11 +2,24 @@ import sys
 import os
 import io
 import re
+import dbm
+import glob
+import hashlib
+import pickle
+import stat as stat_module
+import tempfile
+import threading
 from errno import EPIPE
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
 
 from . import rbql_engine
 from . import csv_utils
+from . import rbql_dbm
 
 
 default_csv_encoding = 'utf-8'
@@ -14,6 +27,18 @@ ansi_reset_color_code = '\u001b[0m'
 
 debug_mode = False
 
+# Version of the on-disk join map cache format, increment on incompatible changes.
+join_map_cache_format_version = 1
+
+# In-memory LRU cache of join maps shared by all queries in the current process, e.g. by the files of a batch query or by the queries of a multi-query pass.
+# Each FileSystemCSVRegistry with a positive `join_cache_memory_capacity` uses it and keeps at most that many join tables in it.
+join_map_memory_cache = OrderedDict()
+# Stages of multi-stage queries and parallel workers can use the cache concurrently, which is unsafe for OrderedDict on free-threaded Python builds
+join_map_memory_cache_lock = threading.Lock()
+
+# Number of files of a multi-file input table that are read ahead by background threads, see MultiFileRecordIterator
+multi_file_prefetch_count = 4
+
 
 def is_ascii(s):
     return all(ord(c) < 128 for c in s)
@@ -319,6 +344,7 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
     def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=1024, line_mode=False, strip_whitespaces=False, comment_regex=None):
         assert encoding in ['utf-8', 'latin-1', None]
         self.encoding = encoding
+        self.raw_stream = stream
         self.stream = encode_input_stream(stream, encoding)
         self.delim = delim
         self.policy = policy
@@ -335,6 +361,10 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         self.NL = 0 # Line number (NL != NR when the CSV file has comments or multiline fields)
         self.chunk_size = chunk_size
         self.fields_info = dict()
+        self.line_mode = line_mode
+        self.track_positions = False
+        self.position = 0 # Number of bytes consumed from the stream, only tracked when track_positions is set
+        self.record_position = None # Byte position of the last returned record, only tracked when track_positions is set
 
         self.utf8_bom_removed = False
         self.first_defective_line = None
@@ -382,9 +412,15 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
                 str_after = one_more
         self.detected_line_separator = separator
         self.buffer = str_after
+        if self.track_positions:
+            self.position += self.get_encoded_length(str_before) + len(separator)
         return str_before
 
 
+    def get_encoded_length(self, text):
+        return len(text) if self.encoding == 'latin-1' else len(text.encode(self.encoding))
+
+
     def _read_until_found(self):
         if self.exhausted:
             return
@@ -453,6 +489,7 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         # Skip comment lines:
         found_record = False
         while not found_record:
+            self.record_position = self.position
             line = self.polymorphic_get_row()
             if line is None:
                 return None
@@ -499,6 +536,87 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         return result
 
 
+    def get_size_estimate(self):
+        try:
+            stat = os.fstat(self.raw_stream.fileno())
+        except Exception:
+            return None # E.g. in-memory streams
+        if not stat_module.S_ISREG(stat.st_mode):
+            return None # Pipes and terminals
+        return stat.st_size
+
+
+    def make_positional_reader(self, position):
+        self.raw_stream.seek(position)
+        # Disable universal newlines translation, so that lengths of decoded lines and separators match their byte lengths in the file.
+        text_stream = io.TextIOWrapper(self.raw_stream, encoding=self.encoding, newline='')
+        reader = CSVRecordIterator(text_stream, None, self.delim, self.policy, comment_prefix=self.comment_prefix, table_name=self.table_name, variable_prefix=self.variable_prefix, chunk_size=self.chunk_size, line_mode=True, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
+        reader.encoding = self.encoding # The stream is already decoded, but the encoding is still needed for BOM detection and byte positions
+        return reader
+
+
+    def get_records_with_positions(self):
+        # Random access requires a seekable binary stream, so positions are byte offsets of the first line of each record in the file.
+        if self.encoding is None or self.line_mode or not self.raw_stream.seekable():
+            return None
+        return self._iterate_records_with_positions()
+
+
+    def _iterate_records_with_positions(self):
+        reader = self.make_positional_reader(0)
+        reader.track_positions = True
+        try:
+            if self.has_header:
+                reader.get_record()
+            while True:
+                record = reader.get_record()
+                if record is None:
+                    break
+                yield (record, reader.record_position)
+            self.utf8_bom_removed = self.utf8_bom_removed or reader.utf8_bom_removed
+            self.first_defective_line = reader.first_defective_line
+            self.fields_info = reader.fields_info
+        finally:
+            # Detach the text wrapper, otherwise it would close the shared binary stream when garbage collected.
+            if not self.raw_stream.closed:
+                reader.stream.detach()
+
+
+    def get_record_at(self, position):
+        reader = self.make_positional_reader(position)
+        try:
+            return reader.get_record()
+        finally:
+            reader.stream.detach()
+
+
+    def get_partitions(self, num_partitions):
+        # Partitions are newline-aligned byte ranges of the input file. Records with multiline fields could cross range boundaries, so "quoted_rfc" policy is not supported.
+        if self.policy == 'quoted_rfc' or self.encoding is None or self.line_mode or self.get_size_estimate() is None:
+            return None
+        table_path = getattr(self.raw_stream, 'name', None)
+        if not isinstance(table_path, str) or not os.path.isfile(table_path):
+            return None
+        table_size = os.path.getsize(table_path)
+        with open(table_path, 'rb') as table_stream:
+            # Header and comment lines before it are skipped with a separate reader, this iterator keeps its state for serial execution.
+            text_stream = io.TextIOWrapper(table_stream, encoding=self.encoding, newline='')
+            reader = CSVRecordIterator(text_stream, None, self.delim, self.policy, comment_prefix=self.comment_prefix, chunk_size=self.chunk_size, line_mode=True, comment_regex=self.comment_regex)
+            reader.encoding = self.encoding
+            reader.track_positions = True
+            if self.has_header:
+                reader.get_record()
+            boundaries = [reader.position]
+            text_stream.detach()
+            for i in range(1, num_partitions):
+                table_stream.seek(max(boundaries[-1], boundaries[0] + (table_size - boundaries[0]) * i // num_partitions - 1))
+                table_stream.readline()
+                if boundaries[-1] < table_stream.tell() < table_size:
+                    boundaries.append(table_stream.tell())
+        boundaries.append(table_size)
+        return [CSVFilePartition(table_path, boundaries[i], boundaries[i + 1], self.encoding, self.delim, self.policy, self.comment_prefix, self.strip_whitespaces, self.comment_regex, self.table_name) for i in range(len(boundaries) - 1)]
+
+
     def get_warnings(self):
         result = list()
         if self.utf8_bom_removed:
@@ -509,10 +627,254 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
             result.append(make_inconsistent_num_fields_warning(self.table_name, self.fields_info))
         return result
 
-ActiveJoinFile = namedtuple('ActiveJoinFile', ['table_path', 'input_stream', 'record_iterator'])
+class FileRangeStream(io.RawIOBase):
+    # Binary stream over a byte range of a file
+    def __init__(self, path, begin, end):
+        self.file = open(path, 'rb')
+        self.file.seek(begin)
+        self.remaining = end - begin
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        super(FileRangeStream, self).close()
+
+
+class CSVFilePartition(object):
+    # A part of a CSV file for parallel execution in worker processes, see CSVRecordIterator.get_partitions()
+    def __init__(self, table_path, begin, end, encoding, delim, policy, comment_prefix, strip_whitespaces, comment_regex, table_name):
+        self.table_path = table_path
+        self.begin = begin
+        self.end = end
+        self.encoding = encoding
+        self.delim = delim
+        self.policy = policy
+        self.comment_prefix = comment_prefix
+        self.strip_whitespaces = strip_whitespaces
+        self.comment_regex = comment_regex
+        self.table_name = table_name
+        self.stream = None
+
+    def open(self):
+        self.stream = io.BufferedReader(FileRangeStream(self.table_path, self.begin, self.end))
+        return CSVRecordIterator(self.stream, self.encoding, self.delim, self.policy, comment_prefix=self.comment_prefix, table_name=self.table_name, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+def is_glob_pattern(path):
+    return re.search(r'[*?[]', path) is not None
+
+
+def get_glob_base_dir(path_pattern):
+    # The longest directory prefix of the pattern without wildcards
+    base_parts = []
+    for part in path_pattern.split(os.sep)[:-1]:
+        if is_glob_pattern(part):
+            break
+        base_parts.append(part)
+    return os.sep.join(base_parts)
+
+
+def parse_hive_path_keys(path):
+    # Returns (key, value) pairs of hive-style `key=value` directory names in the path, e.g. `logs/date=2026-10-01/part-0.csv`
+    result = []
+    for part in os.path.dirname(path).split(os.sep):
+        key, separator, value = part.partition('=')
+        if separator and re.match(r'^[_a-zA-Z][_a-zA-Z0-9]*$', key) is not None:
+            result.append((key, unquote(value)))
+    return result
+
+
+class InputFileReader(object):
+    # Reads and parses a single file of MultiFileRecordIterator in a background thread, records are passed to the main thread through a QueuePipe
+    def __init__(self, path, key_values, record_iterator_factory):
+        self.path = path
+        self.key_values = key_values
+        self.pipe = rbql_engine.QueuePipe()
+        self.warnings = []
+        self.thread = threading.Thread(target=self.run, args=(record_iterator_factory,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, record_iterator_factory):
+        writer = self.pipe.get_writer()
+        try:
+            with open(self.path, 'rb') as stream:
+                record_iterator = record_iterator_factory(stream, self.path)
+                writer.set_header(record_iterator.get_header())
+                while True:
+                    record = record_iterator.get_record()
+                    if record is None or not writer.write(record):
+                        break
+                record_iterator.fields_info = dict() # The number of fields warning is reported for the whole table by MultiFileRecordIterator
+                self.warnings = record_iterator.get_warnings()
+            writer.finish()
+        except Exception as e:
+            self.pipe.fail(e)
+
+    def close(self):
+        self.pipe.close()
+        self.thread.join()
+
+
+class MultiFileRecordIterator(rbql_engine.RBQLInputIterator):
+    # Reads CSV files with the same structure as a single table, e.g. shards matched by a glob pattern. Each file must have its own header line in header mode.
+    # Values of hive-style `key=value` directories of file paths are appended to records as additional fields with the key names in header mode.
+    # Files are read by background threads, at most multi_file_prefetch_count files at a time. Files that can't pass WHERE conditions on the path keys are skipped without opening, see set_file_filter()
+    def __init__(self, input_paths, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', strip_whitespaces=False, comment_regex=None):
+        self.input_paths = input_paths
+        self.encoding = encoding
+        self.delim = delim
+        self.policy = policy
+        self.has_header = has_header
+        self.comment_prefix = comment_prefix
+        self.table_name = table_name
+        self.variable_prefix = variable_prefix
+        self.strip_whitespaces = strip_whitespaces
+        self.comment_regex = comment_regex
+
+        self.file_header = None # Header of the first file
+        self.key_names = None # Path keys that are not present in the file header
+        self.file_filter = None
+        self.pending_paths = deque(input_paths)
+        self.file_readers = deque()
+        self.current_reader = None
+        self.NR = 0
+        self.fields_info = dict()
+        self.file_warnings = []
+        self.num_skipped_files = 0
+
+    def handle_query_modifier(self, modifier):
+        # For `... WITH (header) ...` syntax
+        if modifier in ['header', 'headers']:
+            self.has_header = True
+        if modifier in ['noheader', 'noheaders']:
+            self.has_header = False
+
+    def make_file_record_iterator(self, stream, path):
+        return CSVRecordIterator(stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=path, variable_prefix=self.variable_prefix, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
+
+    def read_file_header(self):
+        if self.file_header is None:
+            with open(self.input_paths[0], 'rb') as stream:
+                header_iterator = CSVRecordIterator(stream, self.encoding, self.delim, self.policy, has_header=True, comment_prefix=self.comment_prefix, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
+                self.file_header = header_iterator.get_header() or []
+            self.key_names = [key for key, _value in parse_hive_path_keys(self.input_paths[0]) if key not in self.file_header]
+        return self.file_header
+
+    def get_header(self):
+        if not self.has_header:
+            return None
+        return self.read_file_header() + self.key_names
+
+    def get_variables_map(self, query_text):
+        variable_map = dict()
+        rbql_engine.parse_basic_variables(query_text, self.variable_prefix, variable_map)
+        rbql_engine.parse_array_variables(query_text, self.variable_prefix, variable_map)
+        header = self.get_header()
+        if header is not None:
+            rbql_engine.parse_attribute_variables(query_text, self.variable_prefix, header, 'CSV header line', variable_map)
+            rbql_engine.parse_dictionary_variables(query_text, self.variable_prefix, header, variable_map)
+        return variable_map
+
+    def get_file_key_indices(self):
+        if not self.has_header:
+            return None
+        header_len = len(self.read_file_header())
+        return list(range(header_len, header_len + len(self.key_names)))
+
+    def set_file_filter(self, file_filter):
+        self.file_filter = file_filter
+
+    def get_key_values(self, path):
+        if not self.has_header:
+            return []
+        path_keys = dict(parse_hive_path_keys(path))
+        return [path_keys.get(key) for key in self.key_names]
+
+    def is_skipped_by_filter(self, key_values):
+        if self.file_filter is None:
+            return False
+        try:
+            return not self.file_filter([None] * len(self.file_header) + key_values)
+        except Exception:
+            return False # Conditions are also checked in the main loop, so the error would be reported there for records of this file
+
+    def start_file_readers(self):
+        while len(self.file_readers) < multi_file_prefetch_count and len(self.pending_paths):
+            path = self.pending_paths.popleft()
+            key_values = self.get_key_values(path)
+            if self.is_skipped_by_filter(key_values):
+                self.num_skipped_files += 1
+                continue
+            self.file_readers.append(InputFileReader(path, key_values, self.make_file_record_iterator))
+
+    def open_next_file(self):
+        self.start_file_readers()
+        if not len(self.file_readers):
+            return False
+        self.current_reader = self.file_readers[0]
+        file_header = self.current_reader.pipe.get_iterator().get_header()
+        if self.has_header and (file_header or []) != self.file_header:
+            self.file_warnings.append('Header of "{}" file is different from the header of "{}" file'.format(self.current_reader.path, self.input_paths[0]))
+        return True
+
+    def get_record(self):
+        while True:
+            if self.current_reader is None and not self.open_next_file():
+                return None
+            record = self.current_reader.pipe.get_iterator().get_record()
+            if record is not None:
+                break
+            self.file_readers.popleft().close()
+            self.file_warnings += self.current_reader.warnings
+            self.current_reader = None
+        self.NR += 1
+        num_fields = len(record)
+        if num_fields not in self.fields_info:
+            self.fields_info[num_fields] = self.NR
+        key_values = self.current_reader.key_values
+        if not len(key_values):
+            return record
+        header_len = len(self.file_header)
+        if num_fields == header_len:
+            return record + key_values
+        # Key fields always follow the fields of the file header
+        return record[:header_len] + [None] * (header_len - num_fields) + key_values + record[header_len:]
+
+    def close(self):
+        for file_reader in self.file_readers:
+            file_reader.close()
+        self.file_readers.clear()
+
+    def get_warnings(self):
+        result = list()
+        for warning in self.file_warnings:
+            if warning not in result:
+                result.append(warning)
+        if self.num_skipped_files:
+            result.append('{} of {} input files were skipped because their path keys don\'t satisfy WHERE conditions'.format(self.num_skipped_files, len(self.input_paths)))
+        if len(self.fields_info) > 1:
+            result.append(make_inconsistent_num_fields_warning(self.table_name, self.fields_info))
+        return result
+
+
+ActiveJoinFile = namedtuple('ActiveJoinFile', ['table_id', 'table_path', 'input_stream', 'record_iterator'])
 
 class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
-    def __init__(self, input_file_dir, delim, policy, encoding, has_header, comment_prefix, strip_whitespaces, comment_regex):
+    def __init__(self, input_file_dir, delim, policy, encoding, has_header, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir=None, join_cache_memory_capacity=0):
         self.input_file_dir = input_file_dir
         self.delim = delim
         self.policy = policy
@@ -521,64 +883,166 @@ class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
         self.comment_prefix = comment_prefix
         self.strip_whitespaces = strip_whitespaces
         self.comment_regex = comment_regex
+        self.join_cache_dir = join_cache_dir
+        self.join_cache_memory_capacity = join_cache_memory_capacity
 
         self.active_join_files = []
+        self.join_cache_warnings = []
 
 
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         table_path = find_table_path(self.input_file_dir, table_id)
         if table_path is None:
             raise rbql_engine.RbqlIOHandlingError('Unable to find join table "{}"'.format(table_id))
+        dbm_path = rbql_dbm.find_dbm_path(table_path)
+        if dbm_path is not None:
+            # dbm and shelve stores are joined with key lookups, see LookupJoinMap
+            db = dbm.open(dbm_path, 'r')
+            record_iterator = rbql_dbm.DbmRecordIterator(db, self.encoding, self.has_header, table_name=table_id, variable_prefix=single_char_alias)
+            self.active_join_files.append(ActiveJoinFile(table_id, table_path, db, record_iterator))
+            return record_iterator
         input_stream = open(table_path, 'rb')
         record_iterator = CSVRecordIterator(input_stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias, strip_whitespaces=self.strip_whitespaces, comment_regex=self.comment_regex)
-        self.active_join_files.append(ActiveJoinFile(table_path, input_stream, record_iterator))
+        self.active_join_files.append(ActiveJoinFile(table_id, table_path, input_stream, record_iterator))
         return record_iterator
 
+    def get_join_map_cache_key(self, table_id, state_format, key_indices):
+        if self.join_cache_dir is None and self.join_cache_memory_capacity <= 0:
+            return None
+        for active_join_file in reversed(self.active_join_files):
+            if active_join_file.table_id == table_id:
+                stat = os.stat(active_join_file.table_path)
+                record_iterator = active_join_file.record_iterator
+                return (join_map_cache_format_version, os.path.abspath(active_join_file.table_path), stat.st_size, stat.st_mtime_ns, self.encoding, self.delim, self.policy, record_iterator.has_header, self.comment_prefix, self.comment_regex, self.strip_whitespaces, state_format, tuple(key_indices))
+        return None
+
+    def get_join_map_cache_path(self, cache_key):
+        return os.path.join(self.join_cache_dir, hashlib.sha1(repr(cache_key).encode('utf-8')).hexdigest() + '.pickle')
+
+    def load_join_map_state(self, table_id, state_format, key_indices):
+        cache_key = self.get_join_map_cache_key(table_id, state_format, key_indices)
+        if cache_key is None:
+            return None
+        state = None
+        if self.join_cache_memory_capacity > 0:
+            with join_map_memory_cache_lock:
+                state = join_map_memory_cache.get(cache_key)
+                if state is not None:
+                    join_map_memory_cache.move_to_end(cache_key)
+        if state is not None:
+            self.join_cache_warnings.append('Join table "{}" index was loaded from the in-memory cache'.format(table_id))
+            return state
+        if self.join_cache_dir is not None:
+            try:
+                with open(self.get_join_map_cache_path(cache_key), 'rb') as cache_file:
+                    stored_cache_key, state = pickle.load(cache_file)
+                if stored_cache_key == cache_key:
+                    self.join_cache_warnings.append('Join table "{}" index was loaded from the cache in {}'.format(table_id, self.join_cache_dir))
+                    self.put_to_memory_cache(cache_key, state)
+                    return state
+            except Exception:
+                pass # Missing or broken cache file is a cache miss
+        self.join_cache_warnings.append('Join table "{}" index was not found in the cache and was built from the table'.format(table_id))
+        return None
+
+    def put_to_memory_cache(self, cache_key, state):
+        if self.join_cache_memory_capacity <= 0:
+            return
+        with join_map_memory_cache_lock:
+            join_map_memory_cache[cache_key] = state
+            join_map_memory_cache.move_to_end(cache_key)
+            while len(join_map_memory_cache) > self.join_cache_memory_capacity:
+                join_map_memory_cache.popitem(last=False)
+
+    def save_join_map_state(self, table_id, state_format, key_indices, state):
+        cache_key = self.get_join_map_cache_key(table_id, state_format, key_indices)
+        if cache_key is None:
+            return
+        self.put_to_memory_cache(cache_key, state)
+        if self.join_cache_dir is None:
+            return
+        if not os.path.isdir(self.join_cache_dir):
+            os.makedirs(self.join_cache_dir)
+        # Write to a temporary file first so that concurrent queries never see a partially written cache file.
+        fd, tmp_path = tempfile.mkstemp(dir=self.join_cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                pickle.dump((cache_key, state), cache_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.get_join_map_cache_path(cache_key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
     def finish(self):
         for active_join_file in self.active_join_files:
             active_join_file.input_stream.close()
 
     def get_warnings(self):
-        result = []
+        result = list(self.join_cache_warnings)
         if self.has_header:
             for active_join_file in self.active_join_files:
+                if isinstance(active_join_file.record_iterator, rbql_dbm.DbmRecordIterator):
+                    continue
                 result.append('The first record in JOIN file {} was also treated as header (and skipped)'.format(os.path.basename(active_join_file.table_path))) # UT JSON CSV
         return result
 
 
-def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False, strip_whitespaces=False, comment_regex=None):
+def check_query_options(query_text, input_delim, input_policy, output_delim, csv_encoding):
+    if input_delim == '"' and input_policy == 'quoted':
+        raise rbql_engine.RbqlIOHandlingError('Double quote delimiter is incompatible with "quoted" policy')
+    if input_delim != ' ' and input_policy == 'whitespace':
+        raise rbql_engine.RbqlIOHandlingError('Only whitespace " " delim is supported with "whitespace" policy')
+
+    if not is_ascii(query_text) and csv_encoding == 'latin-1':
+        raise rbql_engine.RbqlIOHandlingError('To use non-ascii characters in query enable UTF-8 encoding instead of latin-1/binary')
+
+    if (not is_ascii(input_delim) or not is_ascii(output_delim)) and csv_encoding == 'latin-1':
+        raise rbql_engine.RbqlIOHandlingError('To use non-ascii separators enable UTF-8 encoding instead of latin-1/binary')
+
+
+def get_user_init_code(user_init_code):
+    default_init_source_path = os.path.join(os.path.expanduser('~'), '.rbql_init_source.py')
+    if user_init_code == '' and os.path.exists(default_init_source_path):
+        return read_user_init_code(default_init_source_path)
+    return user_init_code
+
+
+def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False, strip_whitespaces=False, comment_regex=None, join_cache_dir=None, parallel_workers=None, join_cache_memory_capacity=0):
     output_stream, close_output_on_finish = (None, False)
     input_stream, close_input_on_finish = (None, False)
     join_tables_registry = None
+    input_iterator = None
+    # Input path can be a glob pattern for tables that consist of multiple files, see MultiFileRecordIterator
+    input_paths = None
+    if input_path is not None and is_glob_pattern(input_path) and not os.path.exists(input_path):
+        input_paths = sorted(glob.glob(input_path))
+        if not len(input_paths):
+            raise rbql_engine.RbqlIOHandlingError('No input files match "{}" pattern'.format(input_path))
     try:
         output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open(output_path, 'wb'), True)
-        input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
-
-        if input_delim == '"' and input_policy == 'quoted':
-            raise rbql_engine.RbqlIOHandlingError('Double quote delimiter is incompatible with "quoted" policy')
-        if input_delim != ' ' and input_policy == 'whitespace':
-            raise rbql_engine.RbqlIOHandlingError('Only whitespace " " delim is supported with "whitespace" policy')
+        if input_paths is None:
+            input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
 
-        if not is_ascii(query_text) and csv_encoding == 'latin-1':
-            raise rbql_engine.RbqlIOHandlingError('To use non-ascii characters in query enable UTF-8 encoding instead of latin-1/binary')
+        check_query_options(query_text, input_delim, input_policy, output_delim, csv_encoding)
+        user_init_code = get_user_init_code(user_init_code)
 
-        if (not is_ascii(input_delim) or not is_ascii(output_delim)) and csv_encoding == 'latin-1':
-            raise rbql_engine.RbqlIOHandlingError('To use non-ascii separators enable UTF-8 encoding instead of latin-1/binary')
-
-        default_init_source_path = os.path.join(os.path.expanduser('~'), '.rbql_init_source.py')
-        if user_init_code == '' and os.path.exists(default_init_source_path):
-            user_init_code = read_user_init_code(default_init_source_path)
-
-        input_file_dir = None if not input_path else os.path.dirname(input_path)
-        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, strip_whitespaces, comment_regex)
-        input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        if input_paths is not None:
+            input_file_dir = get_glob_base_dir(input_path)
+            input_iterator = MultiFileRecordIterator(input_paths, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        else:
+            input_file_dir = None if not input_path else os.path.dirname(input_path)
+            input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir, join_cache_memory_capacity)
         output_writer = CSVWriter(output_stream, close_output_on_finish, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
         if debug_mode:
             rbql_engine.set_debug_mode()
-        rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code)
+        rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, parallel_workers=parallel_workers)
     finally:
         if close_input_on_finish:
             input_stream.close()
+        if isinstance(input_iterator, MultiFileRecordIterator):
+            input_iterator.close()
         if close_output_on_finish:
             output_stream.close()
         if join_tables_registry:
@@ -586,6 +1050,120 @@ def query_csv(query_text, input_path, input_delim, input_policy, output_path, ou
             output_warnings += join_tables_registry.get_warnings()
 
 
+def query_csv_multiple(query_texts, input_path, input_delim, input_policy, output_paths, output_delim, output_policy, csv_encoding, output_warnings_list, with_headers, comment_prefix=None, user_init_code='', strip_whitespaces=False, comment_regex=None, join_cache_dir=None, join_cache_memory_capacity=0):
+    # Runs all queries in a single pass over the input table, the input is read and parsed only once, see rbql_engine.query_multiple()
+    # Query i writes its result into output_paths[i] and its warnings into output_warnings_list[i].
+    # Returns a list with the exception of each failed query or None for each successful query, output files of failed queries are removed.
+    if len(query_texts) != len(output_paths) or len(query_texts) != len(output_warnings_list):
+        raise rbql_engine.RbqlIOHandlingError('Number of queries must match number of output paths')
+    output_streams = []
+    input_stream, close_input_on_finish = (None, False)
+    join_tables_registries = []
+    input_iterator = None
+    input_paths = None
+    if input_path is not None and is_glob_pattern(input_path) and not os.path.exists(input_path):
+        input_paths = sorted(glob.glob(input_path))
+        if not len(input_paths):
+            raise rbql_engine.RbqlIOHandlingError('No input files match "{}" pattern'.format(input_path))
+    query_errors = None
+    try:
+        for query_text in query_texts:
+            check_query_options(query_text, input_delim, input_policy, output_delim, csv_encoding)
+        user_init_code = get_user_init_code(user_init_code)
+        for output_path in output_paths:
+            if input_path is not None and os.path.exists(output_path) and os.path.exists(input_path) and os.path.samefile(input_path, output_path):
+                raise rbql_engine.RbqlIOHandlingError('Output file would overwrite the input file')
+        if input_paths is None:
+            input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
+        for output_path in output_paths:
+            output_streams.append(open(output_path, 'wb'))
+
+        if input_paths is not None:
+            input_file_dir = get_glob_base_dir(input_path)
+            input_iterator = MultiFileRecordIterator(input_paths, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        else:
+            input_file_dir = None if not input_path else os.path.dirname(input_path)
+            input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, strip_whitespaces=strip_whitespaces, comment_regex=comment_regex)
+        # Each query gets its own registry because queries run in separate threads and the registry keeps track of opened join files
+        join_tables_registries = [FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, strip_whitespaces, comment_regex, join_cache_dir, join_cache_memory_capacity) for _ in query_texts]
+        output_writers = [CSVWriter(output_stream, True, csv_encoding, output_delim, output_policy) for output_stream in output_streams]
+        if debug_mode:
+            rbql_engine.set_debug_mode()
+        query_errors = rbql_engine.query_multiple(query_texts, input_iterator, output_writers, output_warnings_list, join_tables_registries, user_init_code)
+    finally:
+        if close_input_on_finish:
+            input_stream.close()
+        if isinstance(input_iterator, MultiFileRecordIterator):
+            input_iterator.close()
+        for output_stream in output_streams:
+            output_stream.close()
+        for join_tables_registry, output_warnings in zip(join_tables_registries, output_warnings_list):
+            join_tables_registry.finish()
+            output_warnings += join_tables_registry.get_warnings()
+    for output_path, query_error in zip(output_paths, query_errors):
+        if query_error is not None and os.path.exists(output_path):
+            os.remove(output_path)
+    return query_errors
+
+
+BatchFileResult = namedtuple('BatchFileResult', ['input_path', 'output_path', 'warnings', 'error_type', 'error_msg'])
+
+
+def expand_batch_input_paths(input_paths):
+    result = []
+    for input_path in input_paths:
+        if is_glob_pattern(input_path) and not os.path.exists(input_path):
+            matched_paths = sorted(glob.glob(input_path))
+            if not len(matched_paths):
+                raise rbql_engine.RbqlIOHandlingError('No input files match "{}" pattern'.format(input_path))
+        else:
+            matched_paths = [input_path]
+        for matched_path in matched_paths:
+            if matched_path not in result:
+                result.append(matched_path)
+    return result
+
+
+def run_batch_query(query_text, input_path, output_path, query_options):
+    output_warnings = []
+    try:
+        if os.path.exists(output_path) and os.path.samefile(input_path, output_path):
+            raise rbql_engine.RbqlIOHandlingError('Output file would overwrite the input file')
+        output_dir = os.path.dirname(output_path)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+        query_csv(query_text, input_path, output_path=output_path, output_warnings=output_warnings, **query_options)
+        return BatchFileResult(input_path, output_path, output_warnings, None, None)
+    except Exception as e:
+        error_type, error_msg = rbql_engine.exception_to_error_info(e)
+        if os.path.exists(output_path) and not os.path.samefile(input_path, output_path):
+            os.remove(output_path) # Output directory contains only complete results
+        return BatchFileResult(input_path, output_path, output_warnings, error_type, error_msg)
+
+
+def query_csv_batch(query_text, input_paths, output_dir, input_delim, input_policy, output_delim, output_policy, csv_encoding, with_headers, comment_prefix=None, user_init_code='', strip_whitespaces=False, comment_regex=None, join_cache_dir=None, num_workers=None, join_cache_memory_capacity=0):
+    # Applies the query to each input file separately, outputs are written into output_dir with the same paths relative to the common directory of the inputs.
+    # Files are processed by a pool of worker processes (threads on free-threaded Python builds), each worker compiles the main loop only once for each distinct input header, see rbql_engine.compile_main_loop()
+    # Returns a list of BatchFileResult in the input order, errors are reported per file.
+    input_paths = expand_batch_input_paths(input_paths)
+    if not len(input_paths):
+        return []
+    base_dir = os.path.commonpath([os.path.dirname(os.path.abspath(input_path)) for input_path in input_paths])
+    output_paths = [os.path.join(output_dir, os.path.relpath(os.path.abspath(input_path), base_dir)) for input_path in input_paths]
+    query_options = {'input_delim': input_delim, 'input_policy': input_policy, 'output_delim': output_delim, 'output_policy': output_policy, 'csv_encoding': csv_encoding, 'with_headers': with_headers,
+                     'comment_prefix': comment_prefix, 'user_init_code': user_init_code, 'strip_whitespaces': strip_whitespaces, 'comment_regex': comment_regex, 'join_cache_dir': join_cache_dir, 'join_cache_memory_capacity': join_cache_memory_capacity}
+    num_workers = num_workers or os.cpu_count() or 1
+    num_tasks = len(input_paths)
+    if num_workers == 1 or num_tasks == 1:
+        return [run_batch_query(query_text, input_path, output_path, query_options) for input_path, output_path in zip(input_paths, output_paths)]
+    import concurrent.futures
+    pool_type = concurrent.futures.ThreadPoolExecutor if rbql_engine.use_thread_workers() else concurrent.futures.ProcessPoolExecutor
+    with pool_type(max_workers=num_workers) as pool:
+        # Small files are sent to workers in chunks to reduce the per-task overhead
+        chunk_size = max(1, num_tasks // (num_workers * 4))
+        return list(pool.map(run_batch_query, [query_text] * num_tasks, input_paths, output_paths, [query_options] * num_tasks, chunksize=chunk_size))
+
+
 def set_debug_mode():
     global debug_mode
     debug_mode = True
@@ -0,0 +1,118 @@
+
+# This module allows to use dbm and shelve key-value stores as RBQL join tables without loading them into memory
+
+
+import os
+import dbm
+import pickle
+
+from . import rbql_engine
+
+
+dbm_header = ['key', 'value']
+
+# Query modifier which tells that the join table is a shelve store, so its values are unpickled, e.g. `SELECT a1, b2 JOIN store.db ON a1 == b1 WITH (shelve)`
+# Values of plain dbm stores are never unpickled because unpickling can execute arbitrary code and any text value can look like a pickle.
+shelve_modifier = 'shelve'
+
+
+def find_dbm_path(table_path):
+    # Returns the path that should be passed to dbm.open() if table_path is a dbm database or one of its files, e.g. "table.dat" of a dbm.dumb database.
+    # dbm.gnu and dbm.sqlite3 databases are single files without an extension, so table_path itself is checked first.
+    candidate_paths = [table_path]
+    base_path, extension = os.path.splitext(table_path)
+    if extension in ['.db', '.dat', '.dir', '.pag']:
+        candidate_paths.append(base_path)
+    for candidate_path in candidate_paths:
+        if dbm.whichdb(candidate_path):
+            return candidate_path
+    return None
+
+
+class DbmRecordIterator(rbql_engine.RBQLInputIterator):
+    # Each key-value pair is a record with the key in the first field and the value in the second field.
+    # Values of shelve stores are unpickled, list and tuple values are unpacked into separate fields, see shelve_modifier.
+    def __init__(self, db, encoding, has_header=False, table_name='input', variable_prefix='a', is_shelve=False):
+        self.db = db
+        self.encoding = encoding if encoding is not None else 'utf-8'
+        self.has_header = has_header
+        self.table_name = table_name
+        self.variable_prefix = variable_prefix
+        self.is_shelve = is_shelve
+        self.keys_iterator = None
+
+
+    def handle_query_modifier(self, modifier):
+        # For `... WITH (header) ...` syntax
+        if modifier in ['header', 'headers']:
+            self.has_header = True
+        if modifier in ['noheader', 'noheaders']:
+            self.has_header = False
+        if modifier == shelve_modifier:
+            self.is_shelve = True
+
+
+    def get_header(self):
+        return dbm_header if self.has_header else None
+
+
+    def get_variables_map(self, query_text):
+        variable_map = dict()
+        rbql_engine.parse_basic_variables(query_text, self.variable_prefix, variable_map)
+        rbql_engine.parse_array_variables(query_text, self.variable_prefix, variable_map)
+        if self.has_header:
+            rbql_engine.parse_attribute_variables(query_text, self.variable_prefix, dbm_header, 'dbm field names', variable_map)
+            rbql_engine.parse_dictionary_variables(query_text, self.variable_prefix, dbm_header, variable_map)
+        return variable_map
+
+
+    def make_record(self, key, value):
+        key = key.decode(self.encoding)
+        if self.is_shelve:
+            value = pickle.loads(value)
+            if isinstance(value, (list, tuple)):
+                return [key] + list(value)
+            return [key, value]
+        return [key, value.decode(self.encoding)]
+
+
+    def iterate_keys(self):
+        # Keys are read one by one where the backend allows it, e.g. dbm.keys() of dbm.ndbm loads all keys into memory
+        if hasattr(self.db, 'firstkey'):
+            key = self.db.firstkey()
+            while key is not None:
+                yield key
+                key = self.db.nextkey(key)
+            return
+        try:
+            keys = iter(self.db)
+        except TypeError:
+            keys = iter(self.db.keys())
+        for key in keys:
+            yield key
+
+
+    def get_record(self):
+        if self.keys_iterator is None:
+            self.keys_iterator = self.iterate_keys()
+        for key in self.keys_iterator:
+            return self.make_record(key, self.db[key])
+        return None
+
+
+    def supports_key_lookups(self, key_indices):
+        return key_indices == [0]
+
+
+    def lookup_records(self, key):
+        # Keys of the records are strings, so other values can't be equal to them
+        if not isinstance(key, str):
+            return []
+        try:
+            encoded_key = key.encode(self.encoding)
+        except UnicodeEncodeError:
+            return []
+        value = self.db.get(encoded_key)
+        if value is None:
+            return []
+        return [(None, self.make_record(encoded_key, value))]
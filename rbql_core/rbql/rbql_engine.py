@@ -1,14 +1,28 @@
 import sys
+import os
 import re
 import ast
+import array
+import bisect
+import tempfile
+import hashlib
+import heapq
+import itertools
+import pickle
+import shutil
+import threading
 from collections import OrderedDict, defaultdict, namedtuple
 
 import random # For usage inside user queries only.
 import datetime # For usage inside user queries only.
-import os # For usage inside user queries only.
 import math # For usage inside user queries only.
 import time # For usage inside user queries only.
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from ._version import __version__
 
 # This module must be both python2 and python3 compatible.
@@ -27,6 +41,10 @@ INNER_JOIN = 'INNER JOIN'
 LEFT_JOIN = 'LEFT JOIN'
 LEFT_OUTER_JOIN = 'LEFT OUTER JOIN'
 STRICT_LEFT_JOIN = 'STRICT LEFT JOIN'
+ASOF_JOIN = 'ASOF JOIN'
+LEFT_ASOF_JOIN = 'LEFT ASOF JOIN'
+INTERVAL_JOIN = 'INTERVAL JOIN'
+LEFT_INTERVAL_JOIN = 'LEFT INTERVAL JOIN'
 ORDER_BY = 'ORDER BY'
 WHERE = 'WHERE'
 LIMIT = 'LIMIT'
@@ -34,17 +52,71 @@ EXCEPT = 'EXCEPT'
 WITH = 'WITH'
 FROM = 'FROM'
 
-default_statement_groups = [[STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, JOIN], [SELECT], [ORDER_BY], [WHERE], [UPDATE], [GROUP_BY], [LIMIT], [EXCEPT], [FROM]]
+# Query modifier that allows the engine to use approximate algorithms, e.g. `SELECT TOP 50 DISTINCT COUNT a3 WITH (approx)`
+APPROXIMATE_MODIFIER = 'approx'
+# Query modifier which tells the engine that the input is sorted by GROUP BY key, so groups can be aggregated and written one by one, e.g. `SELECT a1, COUNT(*) GROUP BY a1 WITH (sorted)`
+SORTED_INPUT_MODIFIER = 'sorted'
+# Query modifier which tells the engine that both input and join tables are sorted by the join key, so they can be joined in one streaming pass, e.g. `SELECT * JOIN B ON a1 == b1 WITH (mergejoin)`
+MERGE_JOIN_MODIFIER = 'mergejoin'
+# Query modifier which tells the engine that the join table is sorted by the join key, so it can be searched with binary search instead of loading it into memory, e.g. `SELECT * JOIN B ON a1 == b1 WITH (binarysearch)`
+BINARY_SEARCH_JOIN_MODIFIER = 'binarysearch'
+
+join_statements = [STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_ASOF_JOIN, LEFT_INTERVAL_JOIN, LEFT_JOIN, INNER_JOIN, ASOF_JOIN, INTERVAL_JOIN, JOIN]
+range_join_statements = [ASOF_JOIN, LEFT_ASOF_JOIN, INTERVAL_JOIN, LEFT_INTERVAL_JOIN]
+
+default_statement_groups = [join_statements, [SELECT], [ORDER_BY], [WHERE], [UPDATE], [GROUP_BY], [LIMIT], [EXCEPT], [FROM]]
 
 ambiguous_error_msg = 'Ambiguous variable name: "{}" is present both in input and in join tables'
 invalid_keyword_in_aggregate_query_error_msg = '"ORDER BY", "UPDATE" and "DISTINCT" keywords are not allowed in aggregate queries'
 wrong_aggregation_usage_error = 'Usage of RBQL aggregation functions inside Python expressions is not allowed, see the docs'
-numeric_conversion_error = 'Unable to convert value "{}" to int or float. MIN, MAX, SUM, AVG, MEDIAN and VARIANCE aggregate functions convert their string arguments to numeric values'
+numeric_conversion_error = 'Unable to convert value "{}" to int or float. MIN, MAX, SUM, AVG, MEDIAN, PERCENTILE, APPROX_PERCENTILE and VARIANCE aggregate functions convert their string arguments to numeric values'
 
 RBQL_VERSION = __version__
 
 debug_mode = False
 
+# Max number of values of a single group that MEDIAN and PERCENTILE aggregators keep in memory, the rest is spilled to a temporary file.
+values_spill_threshold = 1000000
+
+# Size parameter `k` of the quantile sketch used by APPROX_PERCENTILE, see KLLSketch for the error bound.
+approx_percentile_sketch_size = 200
+
+# Default number of index bits of the HyperLogLog sketch used by APPROX_COUNT_DISTINCT: 2^14 one-byte registers per group, ~0.81% standard error.
+approx_count_distinct_precision = 14
+
+# Number of Space-Saving counters per requested item in TOP_K aggregate and in approximate `TOP N DISTINCT COUNT` queries.
+space_saving_counters_per_item = 10
+
+# GROUP BY queries move finished groups to a temporary file when this many first groups have arrived in ascending key order, see AggregateWriter
+sorted_aggregation_detection_groups = 100000
+
+# Max number of distinct records that DISTINCT and DISTINCT COUNT queries track in memory, new distinct records above this limit go to hash-partitioned temporary files.
+distinct_records_memory_limit = 1000000
+distinct_spill_partitions = 16
+
+# Max number of join table records that a hash join keeps in memory, larger join tables are joined with partitioned "Grace" hash join using temporary files.
+join_table_memory_limit = 2000000
+join_spill_partitions = 32
+# Size of the Bloom filter of join keys that lets partitioned hash join skip partitioning of input records without matches. 64M bits with 5 hashes give ~1% false positive rate for ~7M distinct keys
+join_bloom_filter_bits = 64 * 1024 * 1024
+join_bloom_filter_hashes = 5
+# Hash join builds its map on the input table "A" instead of the join table "B" when B is estimated to be at least this many times larger than A
+join_build_side_size_ratio = 4
+# Number of recent keys whose matches are kept in memory by LookupJoinMap
+join_lookup_cache_size = 10000
+
+# Stages of multi-stage queries run concurrently and pass records in batches of this size through bounded queues, so memory usage doesn't depend on the size of intermediate results
+pipeline_batch_size = 1000
+pipeline_queue_batches = 16
+
+# Number of recently compiled main loops that are reused by subsequent queries. The same query over tables with the same header generates the same main loop code, e.g. in batch mode
+compiled_main_loop_cache_size = 64
+compiled_main_loop_cache = OrderedDict()
+compiled_main_loop_cache_lock = threading.Lock()
+
+# Parallel queries run in a thread pool on free-threaded CPython builds with disabled GIL and in a process pool otherwise. Set to 'threads' or 'processes' to override the detection
+parallel_backend = None
+
 class RbqlRuntimeError(Exception):
     pass
 
@@ -83,13 +155,26 @@ class RBQLContext:
 
         self.aggregation_stage = 0
         self.aggregation_key_expression = None
+        self.streaming_aggregation = False
         self.functional_aggregators = []
 
+        self.warning_sources = [] # Internal aggregators and writers that can report warnings e.g. error bounds of approximate algorithms
+
         self.join_map_impl = None
         self.join_map = None
+        self.joiner_type = None
+        self.join_tables_registry = None
+        self.join_table_id = None
+        self.join_key_indices = None
+        self.lhs_join_key_indices = None
         self.lhs_join_var_expression = None
+        self.join_filter_expression = None # WHERE conjuncts that depend only on join table fields, they are applied to B records when the join map is built
+        self.join_filter_init_code = None
+        self.semi_join = False # Join records are not referenced by the query, so only the number of matches matters
 
         self.where_expression = None
+        self.input_file_filter_expression = None # WHERE conjuncts that depend only on file key fields of the input table, see RBQLInputIterator.get_file_key_indices()
+        self.input_file_filter_init_code = None
 
         self.select_expression = None
 
@@ -97,6 +182,9 @@ class RBQLContext:
 
         self.variables_init_code = None
 
+        self.fused_stages = [] # Contexts of preceding row-wise pipeline stages that run inside the main loop of this stage, see parse_fused_stages()
+        self.output_fields_info = dict() # Output record sizes of fused stages, used for inconsistent number of fields warnings
+
 
 QueryColumnInfo = namedtuple('QueryColumnInfo', ['table_name', 'column_index', 'column_name', 'is_star', 'alias_name'])
 
@@ -406,25 +494,430 @@ class VarianceAggregator:
         return float(final_sum_of_squares) / final_cnt - (float(final_sum) / final_cnt) ** 2
 
 
+def select_kth_smallest(values, k):
+    # Quickselect with three-way partitioning, O(n) expected time. `values` is not modified.
+    while True:
+        pivot = values[random.randrange(len(values))]
+        lows = [v for v in values if v < pivot]
+        if k < len(lows):
+            values = lows
+            continue
+        highs = [v for v in values if v > pivot]
+        num_not_highs = len(values) - len(highs)
+        if k < num_not_highs:
+            return pivot
+        values = highs
+        k -= num_not_highs
+
+
+def get_int_array_typecode():
+    try:
+        array.array('q')
+        return 'q'
+    except ValueError:
+        return 'l' # Python 2 doesn't support 'q' typecode, values that don't fit into C long fall back to lists
+
+
+int_array_typecode = get_int_array_typecode()
+
+
+class GroupValuesStorage:
+    # Keeps all numeric values of each group in compact typed arrays.
+    # Groups which have more than `values_spill_threshold` values are spilled in chunks to a shared temporary file.
+    def __init__(self):
+        self.groups = dict()
+        self.spilled_chunks = defaultdict(list)
+        self.spill_file = None
+
+    def append(self, key, val):
+        values = self.groups.get(key)
+        if values is None:
+            if isinstance(val, int):
+                values = array.array(int_array_typecode)
+            elif isinstance(val, float):
+                values = array.array('d')
+            else:
+                values = list() # Fallback for non-numeric values e.g. from non-CSV inputs
+            self.groups[key] = values
+        if isinstance(values, array.array):
+            if values.typecode == int_array_typecode and isinstance(val, float):
+                values = array.array('d', values)
+                self.groups[key] = values
+            try:
+                values.append(val)
+            except (OverflowError, TypeError):
+                values = list(values)
+                values.append(val)
+                self.groups[key] = values
+            if len(values) >= values_spill_threshold:
+                self.spill(key, values)
+        else:
+            values.append(val)
+
+    def spill(self, key, values):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spilled_chunks[key].append((self.spill_file.tell(), values.typecode, len(values)))
+        values.tofile(self.spill_file)
+        self.groups[key] = array.array(values.typecode)
+
+    def get_num_values(self, key):
+        return sum(count for _offset, _typecode, count in self.spilled_chunks.get(key, [])) + len(self.groups[key])
+
+    def read_chunk(self, offset, typecode, count):
+        chunk = array.array(typecode)
+        self.spill_file.seek(offset)
+        chunk.fromfile(self.spill_file, count)
+        return chunk
+
+    def iterate_chunks(self, key):
+        # Yields spilled chunks of the group one by one followed by the values that are still in memory.
+        for offset, typecode, count in self.spilled_chunks.get(key, []):
+            yield self.read_chunk(offset, typecode, count)
+        yield self.groups[key]
+
+    def get_value_at(self, key, index):
+        for offset, typecode, count in self.spilled_chunks.get(key, []):
+            if index < count:
+                return self.read_chunk(offset, typecode, count)[index]
+            index -= count
+        return self.groups[key][index]
+
+    def select_kth_smallest(self, key, k):
+        # Values of spilled groups are never loaded into memory all at once: each pass over the spilled chunks narrows the range of candidate values around the k-th smallest one until the candidates fit into memory.
+        if key not in self.spilled_chunks:
+            return select_kth_smallest(self.groups[key], k)
+        lower_bound, upper_bound = None, None # Exclusive bounds of the candidate values range
+        pivot = self.get_value_at(key, random.randrange(self.get_num_values(key)))
+        while True:
+            num_lows, num_highs, num_equal = 0, 0, 0
+            low_sample, high_sample = None, None
+            for chunk in self.iterate_chunks(key):
+                for v in chunk:
+                    if (lower_bound is not None and v <= lower_bound) or (upper_bound is not None and v >= upper_bound):
+                        continue
+                    if v < pivot:
+                        num_lows += 1
+                        if random.randrange(num_lows) == 0:
+                            low_sample = v # Reservoir sampling of the next pivot
+                    elif v > pivot:
+                        num_highs += 1
+                        if random.randrange(num_highs) == 0:
+                            high_sample = v
+                    else:
+                        num_equal += 1
+            if k < num_lows:
+                upper_bound, pivot, num_candidates = pivot, low_sample, num_lows
+            elif k < num_lows + num_equal:
+                return pivot
+            else:
+                k -= num_lows + num_equal
+                lower_bound, pivot, num_candidates = pivot, high_sample, num_highs
+            if num_candidates <= values_spill_threshold:
+                candidates = [v for chunk in self.iterate_chunks(key) for v in chunk if (lower_bound is None or v > lower_bound) and (upper_bound is None or v < upper_bound)]
+                return select_kth_smallest(candidates, k)
+
+    def pop(self, key, default=None):
+        # Returns the group state without reading spilled values and releases the group, the state can be restored with `storage[key] = state`.
+        if key not in self.groups:
+            return default
+        return (self.groups.pop(key), self.spilled_chunks.pop(key, []))
+
+    def __setitem__(self, key, state):
+        values, spilled_chunks = state
+        self.groups[key] = values
+        if len(spilled_chunks):
+            self.spilled_chunks[key] = spilled_chunks
+
+
 class MedianAggregator:
     def __init__(self):
-        self.stats = defaultdict(list)
+        self.stats = GroupValuesStorage()
         self.num_handler = NumHandler(True)
 
     def increment(self, key, val):
         val = self.num_handler.parse(val)
-        self.stats[key].append(val)
+        self.stats.append(key, val)
+
+    def get_final(self, key):
+        num_values = self.stats.get_num_values(key)
+        assert num_values
+        m = int(num_values / 2)
+        if num_values % 2:
+            result = self.stats.select_kth_smallest(key, m)
+        else:
+            a = self.stats.select_kth_smallest(key, m - 1)
+            b = self.stats.select_kth_smallest(key, m)
+            result = a if a == b else (a + b) / 2.0
+        self.stats.pop(key)
+        return result
+
+
+class PercentileAggregator:
+    # Exact percentile with linear interpolation between the closest ranks, `PERCENTILE(x, 50)` is equivalent to `MEDIAN(x)`.
+    def __init__(self, percentile):
+        self.stats = GroupValuesStorage()
+        self.num_handler = NumHandler(True)
+        self.percentile = percentile
+
+    def increment(self, key, val):
+        val = self.num_handler.parse(val)
+        self.stats.append(key, val)
 
     def get_final(self, key):
-        sorted_vals = sorted(self.stats[key])
-        assert len(sorted_vals)
-        m = int(len(sorted_vals) / 2)
-        if len(sorted_vals) % 2:
-            return sorted_vals[m]
+        num_values = self.stats.get_num_values(key)
+        assert num_values
+        rank = (num_values - 1) * self.percentile / 100.0
+        lower_rank = int(math.floor(rank))
+        a = self.stats.select_kth_smallest(key, lower_rank)
+        if lower_rank == rank:
+            result = a
         else:
-            a = sorted_vals[m - 1]
-            b = sorted_vals[m]
-            return a if a == b else (a + b) / 2.0
+            b = self.stats.select_kth_smallest(key, lower_rank + 1)
+            result = a if a == b else a + (b - a) * (rank - lower_rank)
+        self.stats.pop(key)
+        return result
+
+
+class KLLSketch:
+    # Mergeable streaming quantile sketch from Karnin, Lang, Liberty "Optimal Quantile Approximation in Streams" (2016).
+    # Keeps at most ~3k values no matter how long the stream is. Items at level h stand for 2^h original values.
+    # Error bound: with k = 200 the rank of the returned value differs from the requested rank by less than ~1.65% of the stream length with 99% probability; the error shrinks roughly as 1/k.
+    def __init__(self, k):
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.grow()
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(h) for h in range(len(self.compactors)))
+
+    def capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2.0 / 3.0) ** depth)) + 1
+
+    def update(self, item):
+        self.compactors[0].append(item)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def compact_level(self, height):
+        # Sort the level and promote every other item (with a random offset) to the next level.
+        level = self.compactors[height]
+        level.sort()
+        num_compacted = len(level) - len(level) % 2
+        self.compactors[height] = level[num_compacted:]
+        return level[random.randint(0, 1):num_compacted:2]
+
+    def compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self.capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self.grow()
+                self.compactors[h + 1].extend(self.compact_level(h))
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for h, level in enumerate(other.compactors):
+            self.compactors[h].extend(level)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+
+    def get_quantile(self, fraction):
+        weighted_items = sorted(((item, 2 ** h) for h, level in enumerate(self.compactors) for item in level), key=lambda v: v[0])
+        assert len(weighted_items)
+        target_weight = fraction * sum(weight for _item, weight in weighted_items)
+        cumulative_weight = 0
+        for item, weight in weighted_items:
+            cumulative_weight += weight
+            if cumulative_weight >= target_weight:
+                return item
+        return weighted_items[-1][0]
+
+
+class ApproxPercentileAggregator:
+    def __init__(self, percentile):
+        self.stats = dict()
+        self.num_handler = NumHandler(True)
+        self.percentile = percentile
+
+    def increment(self, key, val):
+        val = self.num_handler.parse(val)
+        sketch = self.stats.get(key)
+        if sketch is None:
+            sketch = KLLSketch(approx_percentile_sketch_size)
+            self.stats[key] = sketch
+        sketch.update(val)
+
+    def get_final(self, key):
+        return self.stats[key].get_quantile(self.percentile / 100.0)
+
+
+text_type = type(u'') # `unicode` in python2, `str` in python3
+
+
+def encode_hashed_value(value):
+    if isinstance(value, bytes):
+        return value # `str` in python2
+    if not isinstance(value, text_type):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class HyperLogLogSketch:
+    # Flajolet et al. "HyperLogLog: the analysis of a near-optimal cardinality estimation algorithm" (2007).
+    # Uses 2^precision one-byte registers, standard error of the estimate is 1.04 / sqrt(2^precision).
+    # Values are hashed with a stable 64-bit hash, so sketches built in different processes can be merged.
+    def __init__(self, precision):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+
+    def update(self, value):
+        hash_value = int(hashlib.md5(encode_hashed_value(value)).hexdigest()[:16], 16)
+        register_index = hash_value >> (64 - self.precision)
+        remaining_bits = hash_value & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - remaining_bits.bit_length() + 1
+        if rank > self.registers[register_index]:
+            self.registers[register_index] = rank
+
+    def merge(self, other):
+        assert self.precision == other.precision
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def get_estimate(self):
+        # Improved raw estimator from Ertl "New cardinality estimation algorithms for HyperLogLog sketches" (2017), it has no bias in the small and mid ranges, so no empirical corrections are needed.
+        m = self.num_registers
+        q = 64 - self.precision
+        histogram = [0] * (q + 2)
+        for r in self.registers:
+            histogram[r] += 1
+        if histogram[0] == m:
+            return 0
+        z = m * hll_tau(1.0 - float(histogram[q + 1]) / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * hll_sigma(float(histogram[0]) / m)
+        return int(round(m * m / (2 * math.log(2) * z)))
+
+
+def hll_sigma(x):
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        z_old = z
+        z += x * y
+        y += y
+        if z == z_old:
+            return z
+
+
+def hll_tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y = 1.0
+    z = 1.0 - x
+    while True:
+        x = math.sqrt(x)
+        z_old = z
+        y *= 0.5
+        z -= (1.0 - x) ** 2 * y
+        if z == z_old:
+            return z / 3.0
+
+
+class ApproxCountDistinctAggregator:
+    def __init__(self, precision):
+        self.stats = dict()
+        self.precision = precision
+
+    def increment(self, key, val):
+        sketch = self.stats.get(key)
+        if sketch is None:
+            sketch = HyperLogLogSketch(self.precision)
+            self.stats[key] = sketch
+        sketch.update(val)
+
+    def get_final(self, key):
+        return self.stats[key].get_estimate()
+
+
+class SpaceSavingSummary:
+    # Metwally, Agrawal, El Abbadi "Efficient Computation of Frequent and Top-k Elements in Data Streams" (2005).
+    # Keeps at most `capacity` counters. Each counter tracks its own maximum overestimation error which is never greater than N / capacity.
+    # The counter with the minimal count is found with a lazily updated min-heap: counts only grow, so stale heap entries are lower bounds and are fixed on pop.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = dict() # item -> [count, error]
+        self.min_heap = []
+        self.heap_push_id = 0 # Tie breaker to avoid comparing items which might be of incomparable types
+
+    def push_to_heap(self, count, item):
+        self.heap_push_id += 1
+        heapq.heappush(self.min_heap, (count, self.heap_push_id, item))
+
+    def update(self, item):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += 1
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [1, 0]
+            self.push_to_heap(1, item)
+            return
+        while True:
+            min_count, _push_id, victim = heapq.heappop(self.min_heap)
+            victim_count = self.counters[victim][0]
+            if victim_count == min_count:
+                break
+            self.push_to_heap(victim_count, victim)
+        del self.counters[victim]
+        self.counters[item] = [min_count + 1, min_count]
+        self.push_to_heap(min_count + 1, item)
+
+    def get_top(self, num_items):
+        # Returns list of (item, count, error) tuples in descending count order. Python sort is stable, so ties are resolved by first appearance in the summary.
+        top_items = sorted(self.counters.items(), key=lambda v: -v[1][0])[:num_items]
+        return [(item, counter[0], counter[1]) for item, counter in top_items]
+
+
+def make_space_saving_warning(what, max_error):
+    return '{} results are approximate: reported frequencies could be overestimated by up to {}, values with close frequencies might be missing or out of order'.format(what, max_error)
+
+
+class TopKAggregator:
+    def __init__(self, num_items):
+        self.stats = dict()
+        self.num_items = num_items
+        self.max_error = 0
+
+    def increment(self, key, val):
+        summary = self.stats.get(key)
+        if summary is None:
+            summary = SpaceSavingSummary(self.num_items * space_saving_counters_per_item)
+            self.stats[key] = summary
+        summary.update(val)
+
+    def get_final(self, key):
+        top_items = self.stats[key].get_top(self.num_items)
+        for _item, _count, error in top_items:
+            self.max_error = max(self.max_error, error)
+        return [item for item, _count, _error in top_items]
+
+    def get_warnings(self):
+        if self.max_error > 0:
+            return [make_space_saving_warning('TOP_K', self.max_error)]
+        return []
 
 
 class CountAggregator:
@@ -455,24 +948,18 @@ class ArrayAggAggregator:
 
 class ConstGroupVerifier:
     def __init__(self, output_index):
-        self.const_values = dict()
+        self.stats = dict()
         self.output_index = output_index
 
     def increment(self, key, value):
-        old_value = self.const_values.get(key)
+        old_value = self.stats.get(key)
         if old_value is None:
-            self.const_values[key] = value
+            self.stats[key] = value
         elif old_value != value:
             raise RbqlRuntimeError('Invalid aggregate expression: non-constant values in output column {}. E.g. "{}" and "{}"'.format(self.output_index + 1, old_value, value)) # UT JSON
 
     def get_final(self, key):
-        return self.const_values[key]
-
-
-def add_to_set(dst_set, value):
-    len_before = len(dst_set)
-    dst_set.add(value)
-    return len_before != len(dst_set)
+        return self.stats[key]
 
 
 class TopWriter(object):
@@ -493,44 +980,183 @@ class TopWriter(object):
         self.subwriter.finish()
 
 
+def normalize_fingerprint_value(value):
+    # Values that are equal in Python must have equal fingerprints, e.g. 1, 1.0 and True or 'a' and u'a' in python2
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, text_type) and not isinstance(value, str):
+        return value.encode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return type(value)(normalize_fingerprint_value(v) for v in value)
+    return value
+
+
+def record_fingerprint(record):
+    # 128-bit fingerprint of the record, collision probability is negligible even for billions of distinct records.
+    normalized_record = tuple(normalize_fingerprint_value(v) for v in record)
+    return hashlib.md5(repr(normalized_record).encode('utf-8')).digest()
+
+
+def get_fingerprint_bucket(fingerprint, num_buckets):
+    return ord(fingerprint[:1]) % num_buckets
+
+
+def iterate_pickled_entries(stream):
+    stream.seek(0)
+    while True:
+        try:
+            yield pickle.load(stream)
+        except EOFError:
+            return
+
+
+class DistinctRecordsSpill(object):
+    # Hash-partitioned temporary files with distinct records that didn't fit into memory.
+    # Each partition is deduplicated separately and the partitions are merged back by the sequence number of the first occurrence, so first-seen order is preserved.
+    def __init__(self):
+        self.partitions = [tempfile.TemporaryFile() for _ in range(distinct_spill_partitions)]
+        self.seq = 0
+
+    def add(self, fingerprint, record):
+        partition = self.partitions[get_fingerprint_bucket(fingerprint, len(self.partitions))]
+        pickle.dump((fingerprint, self.seq, record), partition, pickle.HIGHEST_PROTOCOL)
+        self.seq += 1
+
+    def iterate_distinct(self):
+        # Yields (record, count) tuples in first-seen order.
+        sorted_runs = []
+        for partition in self.partitions:
+            groups = dict()
+            for fingerprint, seq, record in iterate_pickled_entries(partition):
+                group = groups.get(fingerprint)
+                if group is None:
+                    groups[fingerprint] = [seq, 1, record]
+                else:
+                    group[1] += 1
+            partition.close()
+            sorted_run = tempfile.TemporaryFile()
+            for group in sorted(groups.values(), key=lambda v: v[0]):
+                pickle.dump(tuple(group), sorted_run, pickle.HIGHEST_PROTOCOL)
+            sorted_runs.append(sorted_run)
+        # Sequence numbers are unique, so records themselves are never compared by the merge.
+        for _seq, count, record in heapq.merge(*[iterate_pickled_entries(sorted_run) for sorted_run in sorted_runs]):
+            yield (record, count)
+        for sorted_run in sorted_runs:
+            sorted_run.close()
+
+
 class UniqWriter(object):
     def __init__(self, subwriter):
         self.subwriter = subwriter
         self.seen = set()
+        self.spill = None
 
     def write(self, record):
-        immutable_record = tuple(record)
-        if not add_to_set(self.seen, immutable_record):
+        fingerprint = record_fingerprint(record)
+        if fingerprint in self.seen:
+            return True
+        if self.spill is not None:
+            # New records are deduplicated and written in first-seen order on finish.
+            self.spill.add(fingerprint, record)
             return True
+        self.seen.add(fingerprint)
+        if len(self.seen) >= distinct_records_memory_limit:
+            self.spill = DistinctRecordsSpill()
         if not self.subwriter.write(record):
             return False
         return True
 
     def finish(self):
+        if self.spill is not None:
+            for record, _cnt in self.spill.iterate_distinct():
+                if not self.subwriter.write(record):
+                    break
         self.subwriter.finish()
 
 
 class UniqCountWriter(object):
-    def __init__(self, subwriter):
+    def __init__(self, subwriter, approximate_top_count=None):
+        # In approximate mode (`TOP N DISTINCT COUNT ... WITH (approx)`) only a fixed number of Space-Saving counters is kept and the N most frequent records are written in descending count order.
+        # In exact mode records are counted in an ordered dict with record tuples as keys until the distinct records limit is reached.
+        # After that the records are moved to a temporary file in first-seen order and only their counts stay in memory, keyed by record fingerprint; records that are new after that are spilled to hash-partitioned files.
         self.subwriter = subwriter
-        self.records = OrderedDict()
+        self.counts = None
+        self.records_file = None
+        self.spill = None
+        self.summary = None
+        self.approximate_top_count = approximate_top_count
+        self.max_error = 0
+        if approximate_top_count is None:
+            self.counts = OrderedDict()
+        else:
+            self.summary = SpaceSavingSummary(approximate_top_count * space_saving_counters_per_item)
 
     def write(self, record):
-        record = tuple(record)
-        if record in self.records:
-            self.records[record] += 1
+        if self.summary is not None:
+            self.summary.update(tuple(record))
+            return True
+        if self.spill is None:
+            record = tuple(record)
+            if record in self.counts:
+                self.counts[record] += 1
+                return True
+            self.counts[record] = 1
+            if len(self.counts) >= distinct_records_memory_limit:
+                self.start_spill()
+            return True
+        fingerprint = record_fingerprint(record)
+        if fingerprint in self.counts:
+            self.counts[fingerprint] += 1
         else:
-            self.records[record] = 1
+            self.spill.add(fingerprint, record)
         return True
 
+    def start_spill(self):
+        self.records_file = tempfile.TemporaryFile()
+        fingerprint_counts = OrderedDict()
+        for record, cnt in self.counts.items():
+            pickle.dump(record, self.records_file, pickle.HIGHEST_PROTOCOL)
+            fingerprint_counts[record_fingerprint(record)] = cnt
+        self.counts = fingerprint_counts
+        self.spill = DistinctRecordsSpill()
+
+    def iterate_exact_counted_records(self):
+        if self.records_file is None:
+            for record, cnt in self.counts.items():
+                yield (record, cnt)
+            return
+        for record, cnt in zip(iterate_pickled_entries(self.records_file), self.counts.values()):
+            yield (record, cnt)
+        if self.spill is not None:
+            for record, cnt in self.spill.iterate_distinct():
+                yield (record, cnt)
+
+    def get_counted_records(self):
+        if self.summary is None:
+            return self.iterate_exact_counted_records()
+        result = []
+        for record, cnt, error in self.summary.get_top(self.approximate_top_count):
+            self.max_error = max(self.max_error, error)
+            result.append((record, cnt))
+        return result
+
     def finish(self):
-        for record, cnt in self.records.items():
+        for record, cnt in self.get_counted_records():
             mutable_record = list(record)
             mutable_record.insert(0, cnt)
             if not self.subwriter.write(mutable_record):
                 break
+        if self.records_file is not None:
+            self.records_file.close()
         self.subwriter.finish()
 
+    def get_warnings(self):
+        if self.max_error > 0:
+            return [make_space_saving_warning('DISTINCT COUNT', self.max_error)]
+        return []
+
 
 class SortedWriter(object):
     def __init__(self, subwriter, reverse_sort):
@@ -553,19 +1179,165 @@ class SortedWriter(object):
 
 
 class AggregateWriter(object):
-    def __init__(self, subwriter):
+    def __init__(self, subwriter, sorted_input=False):
+        # Hash aggregation keeps all groups in memory and writes them in the key order on finish.
+        # With "WITH (sorted)" modifier the input is expected to be sorted by the group key in either direction: each group is written as soon as the key changes, so only one group is kept in memory and the groups are written in the input order.
+        # If a key breaks the order, the groups that haven't been written yet fall back to hash aggregation. A key of a group that could have been written already can't be merged into it anymore, which is reported as an error.
+        # Without the modifier ascending input is detected automatically: when the first sorted_aggregation_detection_groups groups have arrived in ascending order, finished groups are moved to a temporary file. They are written on finish or loaded back as soon as a key breaks the order.
         self.subwriter = subwriter
         self.aggregators = []
         self.aggregation_keys = set()
+        self.sorted_input = sorted_input
+        self.has_current_key = False
+        self.current_key = None
+        self.key_order = 0 # 1 for ascending and -1 for descending sorted input, detected on the first key change
+        self.written_keys_range = None # First and last keys of the groups that have been written in sorted input mode
+        self.fell_back_to_hash_aggregation = False
+        self.detecting_sorted_input = not sorted_input
+        self.finished_groups_file = None
+
+    def save_finished_group(self, key):
+        # All aggregators keep their per-group state in `stats` mapping.
+        states = [ag.stats.pop(key) for ag in self.aggregators]
+        try:
+            data = pickle.dumps((key, states), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # E.g. ARRAY_AGG of values that can't be pickled
+            for ag, state in zip(self.aggregators, states):
+                ag.stats[key] = state
+            return False
+        if self.finished_groups_file is None:
+            self.finished_groups_file = tempfile.TemporaryFile()
+        self.finished_groups_file.write(data)
+        return True
+
+    def iterate_finished_groups(self):
+        if self.finished_groups_file is None:
+            return
+        for key, states in iterate_pickled_entries(self.finished_groups_file):
+            for ag, state in zip(self.aggregators, states):
+                ag.stats[key] = state
+            yield key
+        self.finished_groups_file.close()
+        self.finished_groups_file = None
+
+    def stop_sorted_input_detection(self):
+        self.detecting_sorted_input = False
+        if self.finished_groups_file is None:
+            return
+        self.aggregation_keys.add(self.current_key)
+        for key in self.iterate_finished_groups():
+            self.aggregation_keys.add(key)
+
+    def detect_sorted_input(self, key):
+        # Called when the key changes while all keys so far have arrived in ascending order
+        if self.has_current_key:
+            try:
+                is_ascending = key > self.current_key
+            except TypeError:
+                is_ascending = False
+            if not is_ascending:
+                self.stop_sorted_input_detection()
+                return
+            if self.finished_groups_file is not None:
+                if not self.save_finished_group(self.current_key):
+                    self.stop_sorted_input_detection()
+                    return
+            elif len(self.aggregation_keys) >= sorted_aggregation_detection_groups:
+                finished_keys = sorted(self.aggregation_keys)
+                for i, finished_key in enumerate(finished_keys):
+                    if not self.save_finished_group(finished_key):
+                        self.aggregation_keys = set(finished_keys[i:])
+                        self.current_key = finished_keys[-1]
+                        self.stop_sorted_input_detection()
+                        return
+                self.aggregation_keys = set()
+        self.has_current_key = True
+        self.current_key = key
+
+    def check_group_is_not_written(self, key):
+        if self.written_keys_range is None:
+            return
+        first_key, last_key = self.written_keys_range
+        low_key, high_key = (first_key, last_key) if self.key_order > 0 else (last_key, first_key)
+        try:
+            is_new_group = key < low_key or key > high_key
+        except TypeError:
+            is_new_group = False
+        if not is_new_group:
+            raise RbqlRuntimeError('Input table is not sorted by GROUP BY key: a group that has already been written can appear again, run the query without "WITH ({})" modifier'.format(SORTED_INPUT_MODIFIER))
+
+    def switch_sorted_input_group(self, key):
+        # Called when the key changes in sorted input mode, writes the finished group
+        if not self.has_current_key:
+            self.has_current_key = True
+            self.current_key = key
+            return True
+        if self.fell_back_to_hash_aggregation:
+            if key not in self.aggregation_keys:
+                self.check_group_is_not_written(key)
+                self.aggregation_keys.add(key)
+            self.current_key = key
+            return True
+        try:
+            key_order = 1 if key > self.current_key else -1
+        except TypeError:
+            key_order = 0
+        if self.key_order == 0:
+            self.key_order = key_order
+        if key_order == 0 or key_order != self.key_order:
+            self.check_group_is_not_written(key)
+            self.fell_back_to_hash_aggregation = True
+            self.aggregation_keys.add(self.current_key)
+            self.aggregation_keys.add(key)
+            self.current_key = key
+            return True
+        if not self.write_group(self.current_key):
+            self.has_current_key = False # The subwriter doesn't accept more groups
+            return False
+        first_key = self.current_key if self.written_keys_range is None else self.written_keys_range[0]
+        self.written_keys_range = (first_key, self.current_key)
+        self.current_key = key
+        return True
+
+    def add_key(self, key):
+        # Must be called before the aggregators are incremented with the values of the record, so that a finished group is moved out before the values of the next group are added.
+        # Returns False if the subwriter doesn't accept more records.
+        if self.has_current_key and key == self.current_key:
+            return True
+        if self.sorted_input:
+            return self.switch_sorted_input_group(key)
+        if self.detecting_sorted_input:
+            self.detect_sorted_input(key)
+        if self.finished_groups_file is None:
+            self.aggregation_keys.add(key)
+        return True
+
+    def write_group(self, key):
+        out_fields = [ag.get_final(key) for ag in self.aggregators]
+        for ag in self.aggregators:
+            ag.stats.pop(key, None)
+        return self.subwriter.write(out_fields)
 
     def finish(self):
-        all_keys = sorted(list(self.aggregation_keys))
+        if self.finished_groups_file is not None:
+            all_keys = itertools.chain(self.iterate_finished_groups(), [self.current_key])
+        elif self.sorted_input and not self.fell_back_to_hash_aggregation:
+            all_keys = [self.current_key] if self.has_current_key else []
+        else:
+            all_keys = sorted(list(self.aggregation_keys))
         for key in all_keys:
-            out_fields = [ag.get_final(key) for ag in self.aggregators]
-            if not self.subwriter.write(out_fields):
+            if not self.write_group(key):
                 break
+        if self.finished_groups_file is not None:
+            self.finished_groups_file.close()
         self.subwriter.finish()
 
+    def get_warnings(self):
+        if self.fell_back_to_hash_aggregation:
+            return ['Input table is not sorted by GROUP BY key: "WITH ({})" aggregation fell back to hash aggregation for the groups that haven\'t been written yet'.format(SORTED_INPUT_MODIFIER)]
+        return []
+
 
 class InnerJoiner(object):
     def __init__(self, join_map):
@@ -620,7 +1392,10 @@ def select_aggregated(query_context, key, transparent_values):
     if query_context.aggregation_stage == 1:
         if type(query_context.writer) is SortedWriter or type(query_context.writer) is UniqWriter or type(query_context.writer) is UniqCountWriter:
             raise RbqlParsingError(invalid_keyword_in_aggregate_query_error_msg) # UT JSON
-        query_context.writer = AggregateWriter(query_context.writer)
+        query_context.writer = AggregateWriter(query_context.writer, sorted_input=query_context.streaming_aggregation)
+        if query_context.streaming_aggregation:
+            query_context.warning_sources.append(query_context.writer)
+        query_context.writer.add_key(key)
         num_aggregators_found = 0
         for i, trans_value in enumerate(transparent_values):
             if isinstance(trans_value, RBQLAggregationToken):
@@ -634,9 +1409,11 @@ def select_aggregated(query_context, key, transparent_values):
             raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
         query_context.aggregation_stage = 2
     else:
+        if not query_context.writer.add_key(key):
+            return False
         for i, trans_value in enumerate(transparent_values):
             query_context.writer.aggregators[i].increment(key, trans_value)
-    query_context.writer.aggregation_keys.add(key)
+    return True
 
 
 PROCESS_SELECT_COMMON = '''
@@ -645,7 +1422,8 @@ if __RBQLMP__where_expression:
     out_fields = __RBQLMP__select_expression
     if query_context.aggregation_stage > 0:
         key = __RBQLMP__aggregation_key_expression
-        select_aggregated(query_context, key, out_fields)
+        if not select_aggregated(query_context, key, out_fields):
+            stop_flag = True
     else:
         sort_key = __RBQLMP__sort_key_expression
         if query_context.unnest_list is not None:
@@ -674,6 +1452,46 @@ for join_match in join_matches:
 '''
 
 
+PROCESS_SELECT_SEMI_JOIN = '''
+join_matches = query_context.join_map.get_rhs(__RBQLMP__lhs_join_var_expression)
+star_fields = record_a
+for join_match in join_matches:
+    __CODE__
+    if stop_flag:
+        break
+'''
+
+
+JOIN_BUILD = '''
+build_join(query_context, None)
+'''
+
+
+JOIN_BUILD_WITH_FILTER = '''
+def join_record_filter(record_b):
+    __RBQLMP__join_filter_init_code
+    return __RBQLMP__join_filter_expression
+build_join(query_context, join_record_filter)
+'''
+
+
+INPUT_FILE_FILTER = '''
+def input_file_filter(record_a):
+    __RBQLMP__input_file_filter_init_code
+    return __RBQLMP__input_file_filter_expression
+query_context.input_iterator.set_file_filter(input_file_filter)
+'''
+
+
+PROCESS_FUSED_STAGE = '''
+star_fields = record_a
+__RBQLMP__variables_init_code
+if not (__RBQLMP__where_expression):
+    continue
+record_a = __RBQLMP__select_expression
+'''
+
+
 PROCESS_UPDATE_JOIN = '''
 join_matches = query_context.join_map.get_rhs(__RBQLMP__lhs_join_var_expression)
 if len(join_matches) > 1:
@@ -704,7 +1522,7 @@ if not query_context.writer.write(up_fields):
 
 # We need dummy_wrapper_for_exec function because otherwise "import" statements won't work as expected if used inside user-defined functions, see: https://github.com/mechatroner/sublime_rainbow_csv/issues/22
 MAIN_LOOP_BODY = '''
-def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested):
+def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, PERCENTILE, APPROX_PERCENTILE, APPROX_COUNT_DISTINCT, TOP_K, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested):
 
     try:
         pass
@@ -728,6 +1546,14 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALU
     Variance = VARIANCE
     median = MEDIAN
     Median = MEDIAN
+    percentile = PERCENTILE
+    Percentile = PERCENTILE
+    approx_percentile = APPROX_PERCENTILE
+    Approx_percentile = APPROX_PERCENTILE
+    approx_count_distinct = APPROX_COUNT_DISTINCT
+    Approx_count_distinct = APPROX_COUNT_DISTINCT
+    top_k = TOP_K
+    Top_k = TOP_K
     array_agg = ARRAY_AGG
     max = mad_max
     min = mad_min
@@ -735,9 +1561,14 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALU
 
     udf = user_namespace
 
+    __INPUT_FILE_FILTER_CODE__
+
+    __JOIN_BUILD_CODE__
+
     NR = 0
     NU = 0
     stop_flag = False
+    __FUSED_STAGES_INIT_CODE__
 
     while not stop_flag:
         record_a = query_context.input_iterator.get_record()
@@ -761,7 +1592,7 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALU
                 raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
             raise RbqlRuntimeError('At record ' + str(NR) + ', Details: ' + str(e)) # UT JSON
 
-dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
+dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, ANY_VALUE, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, PERCENTILE, APPROX_PERCENTILE, APPROX_COUNT_DISTINCT, TOP_K, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
 '''
 
 
@@ -788,16 +1619,52 @@ def embed_code(parent_code, child_placeholder, child_code):
     assert False
 
 
+def generate_fused_stages_code(fused_stages):
+    # Each fused stage replaces record_a with its output record. NR is counted separately for the input of each stage, so it has the same meaning as in unfused pipelines.
+    python_code = 'fused_stage_nr_0 += 1\nNR = fused_stage_nr_0\n'
+    for i, stage_context in enumerate(fused_stages):
+        where_expression = 'True' if stage_context.where_expression is None else stage_context.where_expression
+        stage_code = embed_code(PROCESS_FUSED_STAGE, '__RBQLMP__variables_init_code', stage_context.variables_init_code)
+        stage_code = embed_expression(stage_code, '__RBQLMP__where_expression', where_expression)
+        stage_code = embed_expression(stage_code, '__RBQLMP__select_expression', stage_context.select_expression)
+        python_code += stage_code
+        python_code += 'fused_stage_nr_{0} += 1\nNR = fused_stage_nr_{0}\nNF = len(record_a)\nfused_stage_fields_info_{0}.setdefault(NF, NR)\n'.format(i + 1)
+    return python_code + '__CODE__\n'
+
+
 def generate_main_loop_code(query_context):
     is_select_query = query_context.select_expression is not None
-    is_join_query = query_context.join_map is not None
+    is_join_query = query_context.join_map_impl is not None
     where_expression = 'True' if query_context.where_expression is None else query_context.where_expression
     aggregation_key_expression = 'None' if query_context.aggregation_key_expression is None else query_context.aggregation_key_expression
     sort_key_expression = 'None' if query_context.sort_key_expression is None else query_context.sort_key_expression
     python_code = embed_code(MAIN_LOOP_BODY, '__USER_INIT_CODE__', query_context.user_init_code)
+    if len(query_context.fused_stages):
+        fused_stages_init_code = 'fused_stage_nr_0 = 0\n'
+        for i in range(len(query_context.fused_stages)):
+            fused_stages_init_code += 'fused_stage_nr_{0} = 0\nfused_stage_fields_info_{0} = query_context.fused_stages[{1}].output_fields_info\n'.format(i + 1, i)
+        python_code = embed_code(python_code, '__FUSED_STAGES_INIT_CODE__', fused_stages_init_code)
+        python_code = embed_code(python_code, '__CODE__', generate_fused_stages_code(query_context.fused_stages))
+    else:
+        python_code = embed_code(python_code, '__FUSED_STAGES_INIT_CODE__', 'pass')
+    if query_context.input_file_filter_expression is None:
+        python_code = embed_code(python_code, '__INPUT_FILE_FILTER_CODE__', 'pass')
+    else:
+        python_code = embed_code(python_code, '__INPUT_FILE_FILTER_CODE__', INPUT_FILE_FILTER)
+        python_code = embed_code(python_code, '__RBQLMP__input_file_filter_init_code', query_context.input_file_filter_init_code)
+        python_code = embed_expression(python_code, '__RBQLMP__input_file_filter_expression', query_context.input_file_filter_expression)
+    if not is_join_query:
+        python_code = embed_code(python_code, '__JOIN_BUILD_CODE__', 'pass')
+    elif query_context.join_filter_expression is None:
+        python_code = embed_code(python_code, '__JOIN_BUILD_CODE__', JOIN_BUILD)
+    else:
+        python_code = embed_code(python_code, '__JOIN_BUILD_CODE__', JOIN_BUILD_WITH_FILTER)
+        python_code = embed_code(python_code, '__RBQLMP__join_filter_init_code', query_context.join_filter_init_code)
+        python_code = embed_expression(python_code, '__RBQLMP__join_filter_expression', query_context.join_filter_expression)
     if is_select_query:
         if is_join_query:
-            python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_JOIN), '__CODE__', PROCESS_SELECT_COMMON)
+            process_select_join = PROCESS_SELECT_SEMI_JOIN if query_context.semi_join else PROCESS_SELECT_JOIN
+            python_code = embed_code(embed_code(python_code, '__CODE__', process_select_join), '__CODE__', PROCESS_SELECT_COMMON)
             python_code = embed_expression(python_code, '__RBQLMP__lhs_join_var_expression', query_context.lhs_join_var_expression)
         else:
             python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_SIMPLE), '__CODE__', PROCESS_SELECT_COMMON)
@@ -818,6 +1685,11 @@ def generate_main_loop_code(query_context):
     return python_code
 
 
+def ensure_valid_percentile(function_name, percentile):
+    if not isinstance(percentile, (int, float)) or not 0 <= percentile <= 100:
+        raise RbqlParsingError('{} second argument must be a number between 0 and 100, got "{}"'.format(function_name, percentile))
+
+
 builtin_max = max
 builtin_min = min
 builtin_sum = sum
@@ -855,13 +1727,10 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
                 return False
         return True
 
-    def init_aggregator(generator_name, val, post_proc=None):
+    def init_aggregator(generator_name, val, *aggregator_args):
         query_context.aggregation_stage = 1
         res = RBQLAggregationToken(len(query_context.functional_aggregators), val)
-        if post_proc is not None:
-            query_context.functional_aggregators.append(generator_name(post_proc))
-        else:
-            query_context.functional_aggregators.append(generator_name())
+        query_context.functional_aggregators.append(generator_name(*aggregator_args))
         return res
 
 
@@ -889,6 +1758,36 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
     def MEDIAN(val):
         return init_aggregator(MedianAggregator, val) if query_context.aggregation_stage < 2 else val
 
+    def PERCENTILE(val, percentile):
+        if query_context.aggregation_stage < 2:
+            ensure_valid_percentile('PERCENTILE', percentile)
+            return init_aggregator(PercentileAggregator, val, percentile)
+        return val
+
+    def APPROX_PERCENTILE(val, percentile):
+        if query_context.aggregation_stage < 2:
+            ensure_valid_percentile('APPROX_PERCENTILE', percentile)
+            return init_aggregator(ApproxPercentileAggregator, val, percentile)
+        return val
+
+    def APPROX_COUNT_DISTINCT(val, precision=None):
+        if query_context.aggregation_stage < 2:
+            if precision is None:
+                precision = approx_count_distinct_precision
+            if not isinstance(precision, int) or not 4 <= precision <= 18:
+                raise RbqlParsingError('APPROX_COUNT_DISTINCT precision must be an integer between 4 and 18, got "{}"'.format(precision))
+            return init_aggregator(ApproxCountDistinctAggregator, val, precision)
+        return val
+
+    def TOP_K(val, num_items):
+        if query_context.aggregation_stage < 2:
+            if not isinstance(num_items, int) or num_items < 1:
+                raise RbqlParsingError('TOP_K second argument must be a positive integer, got "{}"'.format(num_items))
+            res = init_aggregator(TopKAggregator, val, num_items)
+            query_context.warning_sources.append(query_context.functional_aggregators[-1])
+            return res
+        return val
+
     def ARRAY_AGG(val, post_proc=None):
         # TODO consider passing array to output writer
         return init_aggregator(ArrayAggAggregator, val, post_proc) if query_context.aggregation_stage < 2 else val
@@ -938,10 +1837,25 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
         return (mad_max, mad_min, mad_sum)
 
     main_loop_body = generate_main_loop_code(query_context)
-    compiled_main_loop = compile(main_loop_body, '<main loop>', 'exec')
+    compiled_main_loop = compile_main_loop(main_loop_body)
     exec(compiled_main_loop, globals(), locals())
 
 
+def compile_main_loop(main_loop_body):
+    # The generated code gets all query state through the query_context argument of dummy_wrapper_for_exec(), so compiled code objects can be shared by queries
+    with compiled_main_loop_cache_lock:
+        compiled_main_loop = compiled_main_loop_cache.pop(main_loop_body, None)
+        if compiled_main_loop is not None:
+            compiled_main_loop_cache[main_loop_body] = compiled_main_loop
+            return compiled_main_loop
+    compiled_main_loop = compile(main_loop_body, '<main loop>', 'exec')
+    with compiled_main_loop_cache_lock:
+        compiled_main_loop_cache[main_loop_body] = compiled_main_loop
+        while len(compiled_main_loop_cache) > compiled_main_loop_cache_size:
+            compiled_main_loop_cache.popitem(last=False)
+    return compiled_main_loop
+
+
 def exception_to_error_info(e):
     exceptions_type_map = {
         'RbqlRuntimeError': 'query execution',
@@ -1008,8 +1922,79 @@ def parse_join_expression(src):
     return (table_id, variable_pairs)
 
 
+def parse_range_join_expression(src):
+    src = src.strip()
+    invalid_join_syntax_error = 'Invalid range join syntax. Valid syntax: <ASOF JOIN> /path/to/B/table on [a... == b... and ...] a... >= b... OR <INTERVAL JOIN> /path/to/B/table on [a... == b... and ...] b... <= a... < b...'
+    match = re.search(r'^([^ ]+) +on +', src, re.IGNORECASE)
+    if match is None:
+        raise RbqlParsingError(invalid_join_syntax_error)
+    table_id = match.group(1)
+    variable_pairs = []
+    range_conditions = []
+    for condition in re.split(r'(?i) +and +', src[match.end():].strip()):
+        match = re.search(r'^([^ =<>]+) *(==?|<=|>=|<|>) *([^ =<>]+)(?: *(<=|<) *([^ =<>]+))?$', condition)
+        if match is None:
+            raise RbqlParsingError(invalid_join_syntax_error)
+        if match.group(2) in ['=', '==']:
+            if match.group(4) is not None:
+                raise RbqlParsingError(invalid_join_syntax_error)
+            variable_pairs.append((match.group(1), match.group(3)))
+        else:
+            range_conditions.append(match.groups())
+    if len(range_conditions) != 1:
+        raise RbqlParsingError(invalid_join_syntax_error)
+    return (table_id, variable_pairs, range_conditions[0])
+
+
+def resolve_join_variable(var_name, input_variables_map, join_variables_map, string_literals):
+    # Returns table alias and field index of a join expression variable, index -1 is for NR
+    var_name = combine_string_literals(var_name, string_literals)
+    if var_name in input_variables_map and var_name in join_variables_map:
+        raise RbqlParsingError(ambiguous_error_msg.format(var_name))
+    if var_name in ['NR', 'a.NR', 'aNR']:
+        return ('a', -1)
+    if var_name in ['bNR', 'b.NR']:
+        return ('b', -1)
+    if var_name in input_variables_map:
+        return ('a', input_variables_map.get(var_name).index)
+    if var_name in join_variables_map:
+        return ('b', join_variables_map.get(var_name).index)
+    raise RbqlParsingError('Unable to parse JOIN expression: Neither input nor join table has field "{}"'.format(var_name))
+
+
+def resolve_range_join_condition(join_subtype, range_condition, input_variables_map, join_variables_map, string_literals):
+    # Returns lhs expression of the range value from the input table and join map parameters
+    var_1, op_1, var_2, op_2, var_3 = range_condition
+    if join_subtype in [ASOF_JOIN, LEFT_ASOF_JOIN]:
+        if op_2 is not None:
+            raise RbqlParsingError('{} condition must compare one input table field with one join table field e.g. "a2 >= b2"'.format(join_subtype))
+        table_1, index_1 = resolve_join_variable(var_1, input_variables_map, join_variables_map, string_literals)
+        table_2, index_2 = resolve_join_variable(var_2, input_variables_map, join_variables_map, string_literals)
+        if table_1 == table_2:
+            raise RbqlParsingError('{} condition must compare one input table field with one join table field e.g. "a2 >= b2"'.format(join_subtype))
+        if table_1 == 'b':
+            index_1, index_2 = index_2, index_1
+            op_1 = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}[op_1]
+        # `a >= b` looks for the closest join record backward, `a <= b` - forward.
+        join_map_params = {'range_index': index_2, 'backward': op_1 in ['>', '>='], 'strict': op_1 in ['<', '>']}
+        lhs_index = index_1
+    else:
+        error_msg = '{} condition must have form "b... <= a... < b..." where "<" and "<=" operators can be used in any combination'.format(join_subtype)
+        if op_2 is None or op_1 not in ['<', '<=']:
+            raise RbqlParsingError(error_msg)
+        table_1, lo_index = resolve_join_variable(var_1, input_variables_map, join_variables_map, string_literals)
+        table_2, lhs_index = resolve_join_variable(var_2, input_variables_map, join_variables_map, string_literals)
+        table_3, hi_index = resolve_join_variable(var_3, input_variables_map, join_variables_map, string_literals)
+        if (table_1, table_2, table_3) != ('b', 'a', 'b'):
+            raise RbqlParsingError(error_msg)
+        join_map_params = {'lo_index': lo_index, 'hi_index': hi_index, 'strict_lo': op_1 == '<', 'strict_hi': op_2 == '<'}
+    lhs_expression = 'NR' if lhs_index == -1 else 'safe_join_get(record_a, {})'.format(lhs_index)
+    return (lhs_expression, join_map_params)
+
+
 def resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals):
     lhs_variables = []
+    lhs_indices = []
     rhs_indices = []
     valid_join_syntax_msg = 'Valid JOIN syntax: <JOIN> /path/to/B/table on a... == b... [and a... == b... [and ... ]]'
     for join_var_1, join_var_2 in variable_pairs:
@@ -1035,8 +2020,9 @@ def resolve_join_variables(input_variables_map, join_variables_map, variable_pai
             raise RbqlParsingError('Unable to parse JOIN expression: Join table does not have field "{}"\n{}'.format(join_var_2, valid_join_syntax_msg)) # UT JSON
         lhs_join_var_expression = 'NR' if lhs_key_index == -1 else 'safe_join_get(record_a, {})'.format(lhs_key_index)
         rhs_indices.append(rhs_key_index)
+        lhs_indices.append(lhs_key_index)
         lhs_variables.append(lhs_join_var_expression)
-    return (lhs_variables, rhs_indices)
+    return (lhs_variables, lhs_indices, rhs_indices)
 
 
 def parse_basic_variables(query_text, prefix, dst_variables_map):
@@ -1269,11 +2255,11 @@ def separate_actions(statement_groups, rbql_expression):
     # make sure all rbql_expression was separated and SELECT or UPDATE is at the beginning
     rbql_expression = rbql_expression.strip(' ')
     result = dict()
-    # For now support no more than one query modifier per query
-    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20})\) *$', rbql_expression)
+    # Multiple query modifiers can be provided as a comma-separated list e.g. `WITH (header, approx)`
+    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20}(?: *, *[a-z]{4,20})*)\) *$', rbql_expression)
     if mobj is not None:
         rbql_expression = mobj.group(1)
-        result[WITH] = mobj.group(2)
+        result[WITH] = [m.strip() for m in mobj.group(2).split(',')]
     ordered_statements = locate_statements(statement_groups, rbql_expression)
     for i in range(len(ordered_statements)):
         statement_start = ordered_statements[i][0]
@@ -1286,7 +2272,7 @@ def separate_actions(statement_groups, rbql_expression):
 
         statement_params = dict()
 
-        if statement in [STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, JOIN]:
+        if statement in join_statements:
             statement_params['join_subtype'] = statement
             statement = JOIN
 
@@ -1352,12 +2338,47 @@ def translate_except_expression(except_expression, input_variables_map, string_l
     return (output_header, 'select_except(record_a, [{}])'.format(','.join(skip_indices)))
 
 
-class HashJoinMap:
-    # Other possible flavors: BinarySearchJoinMap, MergeJoinMap
+class KeyBloomFilter(object):
+    # Compact probabilistic set of join keys: may_contain() can return false positives but never false negatives.
+    # Uses Python hash(), so the filter is only valid within a single process.
+    def __init__(self, num_bits, num_hashes):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+
+
+    def get_bit_positions(self, key):
+        # Fibonacci hashing mixes poorly distributed hashes like hash() of small ints, double hashing derives the rest of the positions.
+        key_hash = (hash(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h1 = key_hash >> 32
+        h2 = (key_hash & 0xFFFFFFFF) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+    def add(self, key):
+        for pos in self.get_bit_positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+
+    def may_contain(self, key):
+        for pos in self.get_bit_positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class JoinMap(object):
+    # Base class for join maps: all flavors return lists of (bNR, bNF, record_b) tuples from get_join_records()
+    cacheable = False # Cacheable join maps can be saved and restored with get_state() / set_state(), see build_join_map()
+    state_format = None # Identifies the format of get_state() result, so that states of different join map flavors are never mixed up
+    supports_record_filter = False # Join maps that support filters skip B records rejected by the filter in build(), see set_record_filter()
+
     def __init__(self, record_iterator, key_indices):
         self.max_record_len = 0
-        self.hash_map = defaultdict(list)
         self.record_iterator = record_iterator
+        self.cached_warnings = None
+        self.stored_field_indices = None
+        self.record_filter = None
         self.key_indices = None
         self.key_index = None
         if len(key_indices) == 1:
@@ -1383,6 +2404,70 @@ class HashJoinMap:
         return tuple(result)
 
 
+    def set_stored_field_indices(self, stored_field_indices):
+        # In compact mode only fields referenced by the query are stored, see compact_join_variables_map()
+        self.stored_field_indices = stored_field_indices
+
+
+    def set_record_filter(self, record_filter):
+        self.record_filter = record_filter
+
+
+    def is_rejected_by_filter(self, fields):
+        if self.record_filter is None:
+            return False
+        try:
+            return not self.record_filter(fields)
+        except Exception:
+            # Filter conditions are also checked in the main loop, so the error would be reported there if this record matches any input record.
+            return False
+
+
+    def make_stored_record(self, fields):
+        if self.stored_field_indices is None:
+            return fields
+        return [safe_get(fields, i) for i in self.stored_field_indices]
+
+
+    def get_state_format(self):
+        if self.stored_field_indices is None:
+            return self.state_format
+        return '{}:{}'.format(self.state_format, ','.join([str(i) for i in self.stored_field_indices]))
+
+
+    def wrap_input_iterator(self, input_iterator, lhs_key_indices):
+        return input_iterator # Reimplement if the join map needs to preprocess or reorder the input table. lhs_key_indices use -1 for NR
+
+
+    def finish(self):
+        pass # Reimplement if the join map needs to do something after the main loop e.g. cleanup
+
+
+    def get_warnings(self):
+        if self.cached_warnings is not None:
+            return self.cached_warnings
+        return self.record_iterator.get_warnings()
+
+
+class HashJoinMap(JoinMap):
+    cacheable = True
+    state_format = 'hash'
+    supports_record_filter = True
+
+    def __init__(self, record_iterator, key_indices):
+        super(HashJoinMap, self).__init__(record_iterator, key_indices)
+        self.hash_map = defaultdict(list)
+        self.no_join_records = []
+
+
+    def get_state(self):
+        return (self.hash_map, self.max_record_len, self.record_iterator.get_warnings())
+
+
+    def set_state(self, state):
+        self.hash_map, self.max_record_len, self.cached_warnings = state
+
+
     def build(self):
         nr = 0
         while True:
@@ -1393,46 +2478,752 @@ class HashJoinMap:
             nf = len(fields)
             self.max_record_len = max(self.max_record_len, nf)
             key = self.polymorphic_get_key(nr, fields)
-            self.hash_map[key].append((nr, nf, fields))
+            if self.is_rejected_by_filter(fields):
+                continue
+            self.hash_map[key].append((nr, nf, self.make_stored_record(fields)))
 
 
     def get_join_records(self, key):
-        return self.hash_map[key]
+        # Plain lookup instead of defaultdict indexing, so that missed lookups don't insert empty entries into the map.
+        return self.hash_map.get(key, self.no_join_records)
 
 
-    def get_warnings(self):
-        return self.record_iterator.get_warnings()
-
+class GraceHashJoinMap(HashJoinMap):
+    # Works exactly as HashJoinMap while the join table fits into `join_table_memory_limit`.
+    # Otherwise both tables are partitioned by the key hash into temporary files, partitions are joined one by one and matches are merged back in the input table record order.
+    # The main loop then reads input records from PartitionedJoinInputIterator, so NR, output order and joiner semantics are the same as with HashJoinMap.
+    def __init__(self, record_iterator, key_indices):
+        super(GraceHashJoinMap, self).__init__(record_iterator, key_indices)
+        self.b_partitions = None
+        self.key_filter = None
+        self.match_runs = []
+        self.current_matches = None
 
-def cleanup_query(query_text):
-    rbql_lines = query_text.split('\n')
-    rbql_lines = [strip_comments(l) for l in rbql_lines]
-    rbql_lines = [l for l in rbql_lines if len(l)]
-    return ' '.join(rbql_lines).rstrip(';')
 
+    def get_partition(self, partitions, key):
+        return partitions[hash(key) % len(partitions)]
 
-def remove_redundant_input_table_name(query_text):
-    query_text = re.sub(' +from +a(?: +|$)', ' ', query_text, flags=re.IGNORECASE).strip()
-    query_text = re.sub('^ *update +a +set ', 'update ', query_text, flags=re.IGNORECASE).strip()
-    return query_text
 
+    def spill_hash_map(self):
+        self.b_partitions = [tempfile.TemporaryFile() for _ in range(join_spill_partitions)]
+        self.key_filter = KeyBloomFilter(join_bloom_filter_bits, join_bloom_filter_hashes)
+        for key, records in self.hash_map.items():
+            self.key_filter.add(key)
+            partition = self.get_partition(self.b_partitions, key)
+            for record in records:
+                pickle.dump((key, record), partition, pickle.HIGHEST_PROTOCOL)
+        self.hash_map = None
 
-def select_output_header(input_header, join_header, query_column_infos):
-    if input_header is None:
-        assert join_header is None
-    query_has_star = False
-    query_has_column_alias = False
-    for qci in query_column_infos:
-        query_has_star = query_has_star or (qci is not None and qci.is_star)
-        query_has_column_alias = query_has_column_alias or (qci is not None and qci.alias_name is not None)
 
-    if input_header is None:
-        if query_has_star and query_has_column_alias:
-            raise RbqlParsingError('Using both * (star) and AS alias in the same query is not allowed for input tables without header')
-        if not query_has_column_alias:
-            return None
-        input_header = []
-        join_header = []
+    def build(self):
+        nr = 0
+        while True:
+            fields = self.record_iterator.get_record()
+            if fields is None:
+                break
+            nr += 1
+            nf = len(fields)
+            self.max_record_len = max(self.max_record_len, nf)
+            key = self.polymorphic_get_key(nr, fields)
+            if self.is_rejected_by_filter(fields):
+                continue
+            record_b = (nr, nf, self.make_stored_record(fields))
+            if self.b_partitions is not None:
+                self.key_filter.add(key)
+                pickle.dump((key, record_b), self.get_partition(self.b_partitions, key), pickle.HIGHEST_PROTOCOL)
+                continue
+            self.hash_map[key].append(record_b)
+            if nr >= join_table_memory_limit:
+                self.spill_hash_map()
+
+
+    def wrap_input_iterator(self, input_iterator, lhs_key_indices):
+        if self.b_partitions is None:
+            return input_iterator
+        a_partitions = [tempfile.TemporaryFile() for _ in range(len(self.b_partitions))]
+        # Input records that definitely have no matches bypass the partitions and go directly to a separate match run.
+        unmatched_run = tempfile.TemporaryFile()
+        self.match_runs.append(unmatched_run)
+        nr = 0
+        while True:
+            record_a = input_iterator.get_record()
+            if record_a is None:
+                break
+            nr += 1
+            key_parts = []
+            for ki in lhs_key_indices:
+                key_parts.append(nr if ki == -1 else safe_get(record_a, ki))
+            # Records without a key field would fail in the main loop anyway, so their partition doesn't matter.
+            key = key_parts[0] if len(key_parts) == 1 else tuple(key_parts)
+            if not self.key_filter.may_contain(key):
+                pickle.dump((nr, record_a, self.no_join_records), unmatched_run, pickle.HIGHEST_PROTOCOL)
+                continue
+            pickle.dump((nr, key, record_a), self.get_partition(a_partitions, key), pickle.HIGHEST_PROTOCOL)
+        for a_partition, b_partition in zip(a_partitions, self.b_partitions):
+            partition_map = defaultdict(list)
+            for key, record_b in iterate_pickled_entries(b_partition):
+                partition_map[key].append(record_b)
+            b_partition.close()
+            # Records in A partitions are already ordered by NR, so each match run is sorted too.
+            match_run = tempfile.TemporaryFile()
+            for nr, key, record_a in iterate_pickled_entries(a_partition):
+                pickle.dump((nr, record_a, partition_map.get(key, [])), match_run, pickle.HIGHEST_PROTOCOL)
+            a_partition.close()
+            self.match_runs.append(match_run)
+        self.b_partitions = None
+        self.key_filter = None
+        # NRs are unique, so the merge never compares records.
+        merged_matches = heapq.merge(*[iterate_pickled_entries(match_run) for match_run in self.match_runs])
+        return PartitionedJoinInputIterator(input_iterator, merged_matches, self, nr)
+
+
+    def get_state(self):
+        if self.hash_map is None:
+            return None # The join table was spilled to disk
+        return super(GraceHashJoinMap, self).get_state()
+
+
+    def get_join_records(self, key):
+        if self.current_matches is not None:
+            return self.current_matches
+        return self.hash_map.get(key, self.no_join_records)
+
+
+    def finish(self):
+        for match_run in self.match_runs:
+            match_run.close()
+
+
+class SemiJoinMap(JoinMap):
+    # Used when the query doesn't reference any join table fields, e.g. `SELECT a.* JOIN blocklist.csv ON a1 == b1`.
+    # Only the number of records for each key is stored, which is enough to preserve multiplicity of inner join matches.
+    cacheable = True
+    state_format = 'key_counts'
+    supports_record_filter = True
+
+    def __init__(self, record_iterator, key_indices):
+        super(SemiJoinMap, self).__init__(record_iterator, key_indices)
+        self.key_counts = dict()
+        self.matches_by_count = dict()
+
+
+    def get_state(self):
+        return (self.key_counts, self.max_record_len, self.record_iterator.get_warnings())
+
+
+    def set_state(self, state):
+        self.key_counts, self.max_record_len, self.cached_warnings = state
+
+
+    def build(self):
+        nr = 0
+        while True:
+            fields = self.record_iterator.get_record()
+            if fields is None:
+                break
+            nr += 1
+            self.max_record_len = max(self.max_record_len, len(fields))
+            key = self.polymorphic_get_key(nr, fields)
+            if self.is_rejected_by_filter(fields):
+                continue
+            self.key_counts[key] = self.key_counts.get(key, 0) + 1
+
+
+    def get_join_records(self, key):
+        count = self.key_counts.get(key, 0)
+        matches = self.matches_by_count.get(count)
+        if matches is None:
+            matches = [(None, None, [])] * count
+            self.matches_by_count[count] = matches
+        return matches
+
+
+class BinarySearchJoinMap(JoinMap):
+    # Join table B must be sorted by the join key in ascending order (lexicographic order for string keys).
+    # Only a sorted array of B keys and positions of the corresponding records is kept in memory, matching B records are read and split on demand.
+    # Requires a join table iterator with random access, see RBQLInputIterator.get_records_with_positions()
+    cacheable = True
+    state_format = 'binary_search'
+
+    def __init__(self, record_iterator, key_indices):
+        super(BinarySearchJoinMap, self).__init__(record_iterator, key_indices)
+        self.keys = []
+        self.positions = []
+        self.has_current_key = False
+        self.current_key = None
+        self.current_run = []
+
+
+    def get_state(self):
+        return (self.keys, self.positions, self.max_record_len, self.record_iterator.get_warnings())
+
+
+    def set_state(self, state):
+        self.keys, self.positions, self.max_record_len, self.cached_warnings = state
+
+
+    def build(self):
+        records_with_positions = self.record_iterator.get_records_with_positions()
+        if records_with_positions is None:
+            raise RbqlIOHandlingError('Join table "B" doesn\'t support random access which is required for "WITH ({})" mode'.format(BINARY_SEARCH_JOIN_MODIFIER))
+        nr = 0
+        for fields, position in records_with_positions:
+            nr += 1
+            self.max_record_len = max(self.max_record_len, len(fields))
+            key = self.polymorphic_get_key(nr, fields)
+            if len(self.keys) and key < self.keys[-1]:
+                raise RbqlRuntimeError('Join table "B" is not sorted by the join key: key "{}" at record {} is smaller than the previous key "{}"'.format(key, nr, self.keys[-1]))
+            self.keys.append(key)
+            self.positions.append(position)
+
+
+    def get_join_records(self, key):
+        # Input records with equal keys often go one after another, so the last run of matches is reused.
+        if self.has_current_key and key == self.current_key:
+            return self.current_run
+        self.has_current_key = True
+        self.current_key = key
+        self.current_run = []
+        begin = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_right(self.keys, key, begin)
+        for i in range(begin, end):
+            fields = self.record_iterator.get_record_at(self.positions[i])
+            self.current_run.append((i + 1, len(fields), self.make_stored_record(fields)))
+        return self.current_run
+
+
+class InputTableHashJoinMap(JoinMap):
+    # Hash join that builds its map on the input table "A" and streams the join table "B", used when A is estimated to be much smaller than B.
+    # Only A records and B records that match them are kept in memory. Matches are collected for each A record and replayed in the original A order,
+    # so NR, output order and joiner semantics are the same as with HashJoinMap.
+    # If A doesn't fit into `join_table_memory_limit` after all, both tables are partitioned by the key hash into temporary files like in GraceHashJoinMap and the partitions are joined one by one.
+    supports_record_filter = True
+
+    def __init__(self, record_iterator, key_indices):
+        super(InputTableHashJoinMap, self).__init__(record_iterator, key_indices)
+        self.current_matches = None
+        self.no_join_records = []
+        self.a_partitions = None
+        self.key_filter = None
+        self.match_runs = []
+
+
+    def build(self):
+        pass # B is streamed in wrap_input_iterator() after A is loaded
+
+
+    def get_partition(self, partitions, key):
+        return partitions[hash(key) % len(partitions)]
+
+
+    def spill_input_records(self, input_records, input_keys):
+        self.a_partitions = [tempfile.TemporaryFile() for _ in range(join_spill_partitions)]
+        self.key_filter = KeyBloomFilter(join_bloom_filter_bits, join_bloom_filter_hashes)
+        for pos, record_a in enumerate(input_records):
+            self.spill_input_record(pos + 1, input_keys[pos], record_a)
+
+
+    def spill_input_record(self, nr, key, record_a):
+        self.key_filter.add(key)
+        pickle.dump((nr, key, record_a), self.get_partition(self.a_partitions, key), pickle.HIGHEST_PROTOCOL)
+
+
+    def collect_matches(self, join_records, input_positions_by_key, matches):
+        # join_records is an iterable of (nr, fields) pairs of B records
+        for nr, fields in join_records:
+            nf = len(fields)
+            self.max_record_len = max(self.max_record_len, nf)
+            key = self.polymorphic_get_key(nr, fields)
+            input_positions = input_positions_by_key.get(key)
+            if input_positions is None or self.is_rejected_by_filter(fields):
+                continue
+            record_b = (nr, nf, self.make_stored_record(fields))
+            for pos in input_positions:
+                matches.setdefault(pos, []).append(record_b)
+
+
+    def iterate_join_records(self):
+        nr = 0
+        while True:
+            fields = self.record_iterator.get_record()
+            if fields is None:
+                break
+            nr += 1
+            yield (nr, fields)
+
+
+    def join_partitions(self, input_iterator, num_input_records):
+        b_partitions = [tempfile.TemporaryFile() for _ in range(len(self.a_partitions))]
+        for nr, fields in self.iterate_join_records():
+            key = self.polymorphic_get_key(nr, fields)
+            if not self.key_filter.may_contain(key):
+                self.max_record_len = max(self.max_record_len, len(fields))
+                continue
+            pickle.dump((nr, fields), self.get_partition(b_partitions, key), pickle.HIGHEST_PROTOCOL)
+        for a_partition, b_partition in zip(self.a_partitions, b_partitions):
+            input_positions_by_key = defaultdict(list)
+            for nr, key, _record_a in iterate_pickled_entries(a_partition):
+                input_positions_by_key[key].append(nr)
+            matches = dict()
+            self.collect_matches(iterate_pickled_entries(b_partition), input_positions_by_key, matches)
+            b_partition.close()
+            # Records in A partitions are already ordered by NR, so each match run is sorted too.
+            match_run = tempfile.TemporaryFile()
+            for nr, _key, record_a in iterate_pickled_entries(a_partition):
+                pickle.dump((nr, record_a, matches.get(nr, self.no_join_records)), match_run, pickle.HIGHEST_PROTOCOL)
+            a_partition.close()
+            self.match_runs.append(match_run)
+        self.a_partitions = None
+        self.key_filter = None
+        # NRs are unique, so the merge never compares records.
+        merged_matches = heapq.merge(*[iterate_pickled_entries(match_run) for match_run in self.match_runs])
+        return PartitionedJoinInputIterator(input_iterator, merged_matches, self, num_input_records)
+
+
+    def wrap_input_iterator(self, input_iterator, lhs_key_indices):
+        input_records = []
+        input_keys = []
+        nr = 0
+        while True:
+            record_a = input_iterator.get_record()
+            if record_a is None:
+                break
+            nr += 1
+            key_parts = []
+            for ki in lhs_key_indices:
+                key_parts.append(nr if ki == -1 else safe_get(record_a, ki))
+            # Records without a key field would fail in the main loop anyway.
+            key = key_parts[0] if len(key_parts) == 1 else tuple(key_parts)
+            if self.a_partitions is not None:
+                self.spill_input_record(nr, key, record_a)
+                continue
+            input_records.append(record_a)
+            input_keys.append(key)
+            if nr >= join_table_memory_limit:
+                self.spill_input_records(input_records, input_keys)
+                input_records, input_keys = None, None
+        if self.a_partitions is not None:
+            return self.join_partitions(input_iterator, nr)
+        input_positions_by_key = defaultdict(list)
+        for pos, key in enumerate(input_keys):
+            input_positions_by_key[key].append(pos)
+        matches = dict()
+        self.collect_matches(self.iterate_join_records(), input_positions_by_key, matches)
+        replayed_matches = ((pos + 1, record_a, matches.get(pos, self.no_join_records)) for pos, record_a in enumerate(input_records))
+        return PartitionedJoinInputIterator(input_iterator, replayed_matches, self, len(input_records))
+
+
+    def get_join_records(self, key):
+        return self.current_matches
+
+
+    def finish(self):
+        for match_run in self.match_runs:
+            match_run.close()
+
+
+    def get_warnings(self):
+        return ['Join hash map was built on the input table because it is estimated to be much smaller than the join table'] + self.record_iterator.get_warnings()
+
+
+def should_build_join_on_input_table(input_iterator, join_record_iterator):
+    input_size = input_iterator.get_size_estimate()
+    join_size = join_record_iterator.get_size_estimate()
+    if input_size is None or join_size is None:
+        return False
+    return input_size * join_build_side_size_ratio <= join_size
+
+
+class RangeJoinMap(JoinMap):
+    # Base class for join maps that match records by ordered range values: B records are grouped by the equality keys and indexed by range values inside each group.
+    # get_join_records() expects (key, value) pairs where key is the equality key and value is the range value from the input record.
+    # Range values are compared as numbers if all range values in B are numeric and as strings otherwise.
+    def __init__(self, record_iterator, key_indices, range_indices):
+        super(RangeJoinMap, self).__init__(record_iterator, key_indices)
+        self.range_indices = range_indices
+        self.numeric = True
+        self.groups = dict()
+        self.no_join_records = []
+
+
+    def get_range_value(self, nr, fields, index):
+        if index == -1:
+            return nr
+        if index >= len(fields):
+            raise RbqlRuntimeError('No field with index {} at record {} in "B" table'.format(index + 1, nr))
+        return fields[index]
+
+
+    def convert_value(self, value):
+        return float(value) if self.numeric else str(value)
+
+
+    def build(self):
+        entries_by_key = defaultdict(list)
+        nr = 0
+        while True:
+            fields = self.record_iterator.get_record()
+            if fields is None:
+                break
+            nr += 1
+            nf = len(fields)
+            self.max_record_len = max(self.max_record_len, nf)
+            key = self.polymorphic_get_key(nr, fields)
+            range_values = [self.get_range_value(nr, fields, index) for index in self.range_indices]
+            if self.numeric:
+                try:
+                    for value in range_values:
+                        float(value)
+                except ValueError:
+                    self.numeric = False
+            entries_by_key[key].append((range_values, (nr, nf, self.make_stored_record(fields))))
+        for key, entries in entries_by_key.items():
+            entries = [([self.convert_value(v) for v in range_values], record_b) for range_values, record_b in entries]
+            self.groups[key] = self.build_group_index(entries)
+
+
+    def build_group_index(self, entries):
+        raise NotImplementedError('Unable to call the interface method')
+
+
+    def find_group_records(self, group_index, value):
+        raise NotImplementedError('Unable to call the interface method')
+
+
+    def get_join_records(self, key_and_value):
+        key, value = key_and_value
+        group_index = self.groups.get(key)
+        if group_index is None or value is None:
+            return self.no_join_records
+        try:
+            value = self.convert_value(value)
+        except ValueError:
+            return self.no_join_records # Non-numeric input value can't match numeric join values
+        return self.find_group_records(group_index, value)
+
+
+class AsofJoinMap(RangeJoinMap):
+    # Matches each input record with a single closest join record: the last one with the greatest range value not greater (`a >= b`) than the input value,
+    # or the first one with the smallest range value not smaller (`a <= b`) than the input value. Lookups take O(log n) with bisect.
+    def __init__(self, record_iterator, key_indices, range_index, backward, strict):
+        super(AsofJoinMap, self).__init__(record_iterator, key_indices, [range_index])
+        self.backward = backward
+        self.strict = strict
+
+
+    def build_group_index(self, entries):
+        # Stable sort keeps equal range values in the join table order.
+        entries.sort(key=lambda entry: entry[0][0])
+        return ([entry[0][0] for entry in entries], [entry[1] for entry in entries])
+
+
+    def find_group_records(self, group_index, value):
+        values, records = group_index
+        if self.backward:
+            pos = (bisect.bisect_left(values, value) if self.strict else bisect.bisect_right(values, value)) - 1
+        else:
+            pos = bisect.bisect_right(values, value) if self.strict else bisect.bisect_left(values, value)
+        if pos < 0 or pos >= len(values):
+            return self.no_join_records
+        return [records[pos]]
+
+
+class IntervalJoinMap(RangeJoinMap):
+    # Matches each input record with all join records which intervals `[lo, hi)` (or other combination of strict and non-strict bounds) contain the input value.
+    # Intervals are sorted by the lower bound and organized into an implicit balanced search tree augmented with the max upper bound of each subtree,
+    # so lookups take O(log n + k log n) where k is the number of matches. Matches are returned in the order of interval lower bounds.
+    def __init__(self, record_iterator, key_indices, lo_index, hi_index, strict_lo, strict_hi):
+        super(IntervalJoinMap, self).__init__(record_iterator, key_indices, [lo_index, hi_index])
+        self.strict_lo = strict_lo
+        self.strict_hi = strict_hi
+
+
+    def build_group_index(self, entries):
+        entries.sort(key=lambda entry: entry[0][0])
+        lows = [entry[0][0] for entry in entries]
+        highs = [entry[0][1] for entry in entries]
+        records = [entry[1] for entry in entries]
+        subtree_max_highs = [None] * len(entries)
+        self.fill_subtree_max_highs(highs, subtree_max_highs, 0, len(entries))
+        return (lows, highs, records, subtree_max_highs)
+
+
+    def fill_subtree_max_highs(self, highs, subtree_max_highs, begin, end):
+        # Subtree of range [begin, end) has its root at the middle of the range
+        if begin >= end:
+            return None
+        mid = (begin + end) // 2
+        result = highs[mid]
+        for child_max_high in [self.fill_subtree_max_highs(highs, subtree_max_highs, begin, mid), self.fill_subtree_max_highs(highs, subtree_max_highs, mid + 1, end)]:
+            if child_max_high is not None and child_max_high > result:
+                result = child_max_high
+        subtree_max_highs[mid] = result
+        return result
+
+
+    def find_group_records(self, group_index, value):
+        lows, highs, records, subtree_max_highs = group_index
+        # Only intervals before `end` have acceptable lower bounds.
+        end = bisect.bisect_left(lows, value) if self.strict_lo else bisect.bisect_right(lows, value)
+        result = []
+        self.collect_matches(highs, records, subtree_max_highs, value, 0, len(lows), end, result)
+        return result
+
+
+    def collect_matches(self, highs, records, subtree_max_highs, value, begin, end, max_end, result):
+        if begin >= end or begin >= max_end:
+            return
+        mid = (begin + end) // 2
+        max_high = subtree_max_highs[mid]
+        if max_high < value or (self.strict_hi and max_high == value):
+            return
+        self.collect_matches(highs, records, subtree_max_highs, value, begin, mid, max_end, result)
+        if mid < max_end and (highs[mid] > value or (not self.strict_hi and highs[mid] == value)):
+            result.append(records[mid])
+        self.collect_matches(highs, records, subtree_max_highs, value, mid + 1, end, max_end, result)
+
+
+class LookupJoinMap(JoinMap):
+    # Performs a point lookup in the join table B for each input key instead of loading B into memory, used for join tables backed by indexed key-value stores or databases.
+    # Startup cost doesn't depend on the size of B and memory usage is bounded by the LRU cache of recent lookups.
+    # Requires a join table iterator with key lookups, see RBQLInputIterator.supports_key_lookups(). Since B is not scanned in advance `max_record_len` is taken from the B header or from the first B record.
+    supports_record_filter = True
+
+    def __init__(self, record_iterator, key_indices):
+        super(LookupJoinMap, self).__init__(record_iterator, key_indices)
+        self.lookup_cache = OrderedDict()
+        self.max_key_index = max(key_indices)
+
+
+    def build(self):
+        header = self.record_iterator.get_header()
+        if header is not None:
+            self.max_record_len = len(header)
+            return
+        first_record = self.record_iterator.get_record()
+        if first_record is not None:
+            self.max_record_len = len(first_record)
+
+
+    def get_join_records(self, key):
+        join_records = self.lookup_cache.pop(key, None)
+        if join_records is None:
+            join_records = []
+            for nr, fields in self.record_iterator.lookup_records(key):
+                # Lookups can return more records than python `==` would match, e.g. because of sqlite type affinity or collation
+                if len(fields) <= self.max_key_index or self.polymorphic_get_key(nr, fields) != key or self.is_rejected_by_filter(fields):
+                    continue
+                self.max_record_len = max(self.max_record_len, len(fields))
+                join_records.append((nr, len(fields), self.make_stored_record(fields)))
+            if len(self.lookup_cache) >= join_lookup_cache_size:
+                self.lookup_cache.popitem(last=False)
+        self.lookup_cache[key] = join_records
+        return join_records
+
+
+def build_join_map(join_map_impl, tables_registry, table_id, key_indices):
+    # Filtered join maps depend on the query and the user init code, so they are never cached.
+    use_cache = join_map_impl.cacheable and join_map_impl.record_filter is None
+    if use_cache:
+        state = tables_registry.load_join_map_state(table_id, join_map_impl.get_state_format(), key_indices)
+        if state is not None:
+            join_map_impl.set_state(state)
+            return
+    join_map_impl.build()
+    if use_cache:
+        state = join_map_impl.get_state()
+        if state is not None:
+            tables_registry.save_join_map_state(table_id, join_map_impl.get_state_format(), key_indices, state)
+
+
+def build_join(query_context, record_filter):
+    # Called from the main loop code before the first input record is processed, so that the record filter can use query functions and the user init code.
+    join_map_impl = query_context.join_map_impl
+    if record_filter is not None and query_context.joiner_type is LeftJoiner:
+        # Input records without matches get a null B record in left joins, so the filter is only safe when it rejects the null record just like the WHERE clause in the main loop would.
+        try:
+            if record_filter([]):
+                record_filter = None
+        except Exception:
+            record_filter = None
+    if record_filter is not None:
+        join_map_impl.set_record_filter(record_filter)
+    build_join_map(join_map_impl, query_context.join_tables_registry, query_context.join_table_id, query_context.join_key_indices)
+    query_context.input_iterator = join_map_impl.wrap_input_iterator(query_context.input_iterator, query_context.lhs_join_key_indices)
+    query_context.join_map = query_context.joiner_type(join_map_impl)
+
+
+class MergeJoinMap(JoinMap):
+    # Streams join table B along with input table A, both tables must be sorted by the join key in ascending order (lexicographic order for string keys).
+    # Only the current run of B records with equal keys is kept in memory. Since B is not scanned in advance `max_record_len` is taken from the first B record.
+    def __init__(self, record_iterator, key_indices):
+        super(MergeJoinMap, self).__init__(record_iterator, key_indices)
+        self.nr = 0
+        self.next_entry = None
+        self.has_current_key = False
+        self.current_key = None
+        self.current_run = []
+
+
+    def read_next_entry(self):
+        fields = self.record_iterator.get_record()
+        if fields is None:
+            self.next_entry = None
+            return
+        self.nr += 1
+        nf = len(fields)
+        self.max_record_len = max(self.max_record_len, nf)
+        key = self.polymorphic_get_key(self.nr, fields)
+        if self.next_entry is not None and key < self.next_entry[0]:
+            raise RbqlRuntimeError('Join table "B" is not sorted by the join key: key "{}" at record {} is smaller than the previous key "{}"'.format(key, self.nr, self.next_entry[0]))
+        self.next_entry = (key, (self.nr, nf, self.make_stored_record(fields)))
+
+
+    def build(self):
+        self.read_next_entry()
+
+
+    def get_join_records(self, key):
+        if self.has_current_key:
+            if key == self.current_key:
+                return self.current_run
+            if key < self.current_key:
+                raise RbqlRuntimeError('Input table "A" is not sorted by the join key: key "{}" is smaller than the previous key "{}"'.format(key, self.current_key))
+        self.has_current_key = True
+        self.current_key = key
+        self.current_run = []
+        while self.next_entry is not None and self.next_entry[0] < key:
+            self.read_next_entry()
+        while self.next_entry is not None and self.next_entry[0] == key:
+            self.current_run.append(self.next_entry[1])
+            self.read_next_entry()
+        return self.current_run
+
+
+    def finish(self):
+        # Scan the rest of B to make sure that the whole table is sorted, otherwise some matches could have been silently skipped.
+        while self.next_entry is not None:
+            self.read_next_entry()
+
+
+def split_top_level_conjuncts(expression):
+    # Splits expression by top-level `and` operators. Expressions with top-level `or`, conditional expressions or lambdas are returned as a single conjunct
+    depth = 0
+    conjuncts = []
+    conjunct_start = 0
+    for match in re.finditer(r'[()\[\]{}]|\b(?:and|or|if|else|lambda)\b', expression):
+        token = match.group(0)
+        if token in ['(', '[', '{']:
+            depth += 1
+        elif token in [')', ']', '}']:
+            depth -= 1
+        elif depth == 0:
+            if token != 'and':
+                return [expression.strip()]
+            conjuncts.append(expression[conjunct_start:match.start()].strip())
+            conjunct_start = match.end()
+    conjuncts.append(expression[conjunct_start:].strip())
+    return conjuncts
+
+
+def is_join_table_only_expression(expression, input_variables_map, join_variables_map):
+    if re.search(r'(?:^|[^_a-zA-Z0-9.])a(?:$|[^_a-zA-Z0-9])', expression) is not None:
+        return False
+    if re.search(r'(?:^|[^_a-zA-Z0-9])(NR|NF|NU|aNR|bNR|bNF|record_a|record_b|star_fields)(?:$|[^_a-zA-Z0-9])', expression) is not None:
+        return False
+    for var_name in input_variables_map:
+        if expression.find(var_name) != -1:
+            return False
+    for var_name in join_variables_map:
+        if expression.find(var_name) != -1:
+            return True
+    return False
+
+
+def is_file_key_only_expression(expression, input_variables_map, join_variables_map, file_key_indices):
+    uses_file_keys = False
+    # Longer variable names are removed first, so that e.g. `a1` is not found inside `a10`
+    for var_name in sorted(input_variables_map.keys(), key=len, reverse=True):
+        if expression.find(var_name) != -1:
+            if input_variables_map[var_name].index not in file_key_indices:
+                return False
+            expression = expression.replace(var_name, ' ')
+            uses_file_keys = True
+    if not uses_file_keys:
+        return False
+    for var_name in (join_variables_map or dict()):
+        if expression.find(var_name) != -1:
+            return False
+    return re.search(r'(?:^|[^_a-zA-Z0-9.])(a|b|NR|NF|NU|aNR|bNR|bNF|record_a|record_b|star_fields)(?:$|[^_a-zA-Z0-9])', expression) is None
+
+
+def generate_filter_init_statements(filter_expression, variables_map, variable_prefix):
+    code_lines = generate_common_init_code(filter_expression, variable_prefix)
+    for var_name, var_info in variables_map.items():
+        if var_info.initialize and filter_expression.find(var_name) != -1:
+            code_lines.append('{} = safe_get(record_{}, {})'.format(var_name, variable_prefix, var_info.index))
+    return '\n'.join(code_lines)
+
+
+def query_uses_whole_join_record(format_expression, rb_actions):
+    if SELECT in rb_actions:
+        select_expression = replace_star_count(rb_actions[SELECT]['text'])
+        if re.search(r'(?:^|,) *(\*|b\.\*) *(?=$|,)', select_expression) is not None:
+            return True
+    # Direct references to internal variables can't be analyzed, so they also require whole records.
+    return re.search(r'(?:^|[^_a-zA-Z0-9])(record_b|star_fields)(?:$|[^_a-zA-Z0-9])', format_expression) is not None
+
+
+def query_uses_join_record_info(format_expression):
+    return re.search(r'(?:^|[^_a-zA-Z0-9])(bNR|bNF|b\.NR)(?:$|[^_a-zA-Z0-9])', format_expression) is not None
+
+
+def query_uses_join_fields_outside_join_expression(join_record_iterator, rb_actions, string_literals):
+    # Variables in the ON clause are evaluated by the join map itself, so only references in other statements require join table fields in the main loop.
+    non_join_texts = [action['text'] for statement, action in rb_actions.items() if statement != JOIN and isinstance(action, dict) and 'text' in action]
+    non_join_expression = combine_string_literals(' '.join(non_join_texts), string_literals)
+    return len(join_record_iterator.get_variables_map(non_join_expression)) > 0
+
+
+def compact_join_variables_map(join_variables_map):
+    # Returns indices of join table fields referenced by the query and the variables map remapped to positions in the compact records.
+    stored_field_indices = sorted(set([var_info.index for var_info in join_variables_map.values()]))
+    positions = {field_index: position for position, field_index in enumerate(stored_field_indices)}
+    compact_variables_map = dict()
+    for var_name, var_info in join_variables_map.items():
+        compact_variables_map[var_name] = VariableInfo(initialize=var_info.initialize, index=positions[var_info.index])
+    return (stored_field_indices, compact_variables_map)
+
+
+def cleanup_query(query_text):
+    rbql_lines = query_text.split('\n')
+    rbql_lines = [strip_comments(l) for l in rbql_lines]
+    rbql_lines = [l for l in rbql_lines if len(l)]
+    return ' '.join(rbql_lines).rstrip(';')
+
+
+def remove_redundant_input_table_name(query_text):
+    query_text = re.sub(' +from +a(?: +|$)', ' ', query_text, flags=re.IGNORECASE).strip()
+    query_text = re.sub('^ *update +a +set ', 'update ', query_text, flags=re.IGNORECASE).strip()
+    return query_text
+
+
+def select_output_header(input_header, join_header, query_column_infos):
+    if input_header is None:
+        assert join_header is None
+    query_has_star = False
+    query_has_column_alias = False
+    for qci in query_column_infos:
+        query_has_star = query_has_star or (qci is not None and qci.is_star)
+        query_has_column_alias = query_has_column_alias or (qci is not None and qci.alias_name is not None)
+
+    if input_header is None:
+        if query_has_star and query_has_column_alias:
+            raise RbqlParsingError('Using both * (star) and AS alias in the same query is not allowed for input tables without header')
+        if not query_has_column_alias:
+            return None
+        input_header = []
+        join_header = []
     if join_header is None:
         # This means that there is no join table.
         join_header = []
@@ -1486,8 +3277,9 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
     if input_iterator is None:
         raise RbqlParsingError('Queries without context-based input table must contain "FROM" statement')
 
-    if WITH in rb_actions:
-        input_iterator.handle_query_modifier(rb_actions[WITH])
+    query_modifiers = rb_actions.get(WITH, [])
+    for modifier in query_modifiers:
+        input_iterator.handle_query_modifier(modifier)
     input_variables_map = input_iterator.get_variables_map(query_text)
 
     if ORDER_BY in rb_actions and UPDATE in rb_actions:
@@ -1498,20 +3290,26 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
             raise RbqlParsingError(invalid_keyword_in_aggregate_query_error_msg) # UT JSON
         query_context.aggregation_key_expression = '({},)'.format(combine_string_literals(rb_actions[GROUP_BY]['text'], string_literals))
         query_context.aggregation_stage = 1
+        query_context.streaming_aggregation = SORTED_INPUT_MODIFIER in query_modifiers
 
 
     input_header = input_iterator.get_header()
     join_variables_map = None
     join_header = None
     if JOIN in rb_actions:
-        rhs_table_id, variable_pairs = parse_join_expression(rb_actions[JOIN]['text'])
+        join_subtype = rb_actions[JOIN]['join_subtype']
+        range_condition = None
+        if join_subtype in range_join_statements:
+            rhs_table_id, variable_pairs, range_condition = parse_range_join_expression(rb_actions[JOIN]['text'])
+        else:
+            rhs_table_id, variable_pairs = parse_join_expression(rb_actions[JOIN]['text'])
         if tables_registry is None:
             raise RbqlParsingError('JOIN operations are not supported by the application') # UT JSON
         join_record_iterator = tables_registry.get_iterator_by_table_id(rhs_table_id, 'b')
         if join_record_iterator is None:
             raise RbqlParsingError('Unable to find join table: "{}"'.format(rhs_table_id)) # UT JSON CSV
-        if WITH in rb_actions:
-            join_record_iterator.handle_query_modifier(rb_actions[WITH])
+        for modifier in query_modifiers:
+            join_record_iterator.handle_query_modifier(modifier)
         join_variables_map = join_record_iterator.get_variables_map(query_text)
         join_header = join_record_iterator.get_header()
         if input_header is None and join_header is not None:
@@ -1520,14 +3318,56 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
             raise RbqlIOHandlingError('Inconsistent modes: Input table has a header while the Join table doesn\'t have a header')
 
         # TODO check ambiguous column names here instead of external check.
-        lhs_variables, rhs_indices = resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals)
-        joiner_type = {JOIN: InnerJoiner, INNER_JOIN: InnerJoiner, LEFT_OUTER_JOIN: LeftJoiner, LEFT_JOIN: LeftJoiner, STRICT_LEFT_JOIN: StrictLeftJoiner}[rb_actions[JOIN]['join_subtype']]
+        lhs_variables, lhs_indices, rhs_indices = resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals)
+        joiner_type = {JOIN: InnerJoiner, INNER_JOIN: InnerJoiner, LEFT_OUTER_JOIN: LeftJoiner, LEFT_JOIN: LeftJoiner, STRICT_LEFT_JOIN: StrictLeftJoiner, ASOF_JOIN: InnerJoiner, LEFT_ASOF_JOIN: LeftJoiner, INTERVAL_JOIN: InnerJoiner, LEFT_INTERVAL_JOIN: LeftJoiner}[join_subtype]
         query_context.lhs_join_var_expression = lhs_variables[0] if len(lhs_variables) == 1 else '({})'.format(', '.join(lhs_variables))
-        query_context.join_map_impl = HashJoinMap(join_record_iterator, rhs_indices)
-        query_context.join_map_impl.build()
-        query_context.join_map = joiner_type(query_context.join_map_impl)
-
-    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map, join_variables_map), string_literals)
+        if range_condition is not None:
+            lhs_range_expression, range_join_map_params = resolve_range_join_condition(join_subtype, range_condition, input_variables_map, join_variables_map, string_literals)
+            query_context.lhs_join_var_expression = '({}, {})'.format(query_context.lhs_join_var_expression, lhs_range_expression)
+        if WHERE in rb_actions and UPDATE not in rb_actions and joiner_type in [InnerJoiner, LeftJoiner]:
+            # Push down WHERE conjuncts that depend only on B fields into the join map build. The conjuncts are still checked in the main loop, so the filter only has to reject records that can never pass.
+            # Strict left joins and UPDATE joins are excluded because they validate the number of B matches before WHERE is evaluated.
+            filter_conjuncts = [c for c in split_top_level_conjuncts(rb_actions[WHERE]['text']) if is_join_table_only_expression(c, input_variables_map, join_variables_map)]
+            if len(filter_conjuncts):
+                filter_expression = ' and '.join(['({})'.format(c) for c in filter_conjuncts])
+                query_context.join_filter_expression = combine_string_literals(filter_expression, string_literals)
+                query_context.join_filter_init_code = combine_string_literals(generate_filter_init_statements(filter_expression, join_variables_map, 'b'), string_literals)
+        stored_field_indices = None
+        if not query_uses_whole_join_record(format_expression, rb_actions):
+            # Join records are stored in compact form with referenced fields only, which significantly reduces memory usage for wide join tables.
+            stored_field_indices, join_variables_map = compact_join_variables_map(join_variables_map)
+            query_context.semi_join = not query_uses_join_fields_outside_join_expression(join_record_iterator, rb_actions, string_literals) and not query_uses_join_record_info(format_expression)
+        join_map_type = SemiJoinMap if query_context.semi_join else GraceHashJoinMap
+        if not query_uses_join_record_info(format_expression) and join_record_iterator.supports_key_lookups(rhs_indices):
+            # Looked up records don't have record numbers of the table scan, so bNR and bNF queries scan the join table
+            join_map_type = LookupJoinMap
+        elif join_map_type is GraceHashJoinMap and should_build_join_on_input_table(query_context.input_iterator, join_record_iterator):
+            join_map_type = InputTableHashJoinMap
+        if MERGE_JOIN_MODIFIER in query_modifiers:
+            join_map_type = MergeJoinMap
+        elif BINARY_SEARCH_JOIN_MODIFIER in query_modifiers:
+            join_map_type = BinarySearchJoinMap
+        if join_subtype in [ASOF_JOIN, LEFT_ASOF_JOIN]:
+            query_context.join_map_impl = AsofJoinMap(join_record_iterator, rhs_indices, **range_join_map_params)
+        elif join_subtype in [INTERVAL_JOIN, LEFT_INTERVAL_JOIN]:
+            query_context.join_map_impl = IntervalJoinMap(join_record_iterator, rhs_indices, **range_join_map_params)
+        else:
+            query_context.join_map_impl = join_map_type(join_record_iterator, rhs_indices)
+        if stored_field_indices is not None:
+            query_context.join_map_impl.set_stored_field_indices(stored_field_indices)
+        if not query_context.join_map_impl.supports_record_filter:
+            query_context.join_filter_expression = None
+            query_context.join_filter_init_code = None
+        # The join map is built by build_join() from the main loop code
+        query_context.joiner_type = joiner_type
+        query_context.join_tables_registry = tables_registry
+        query_context.join_table_id = rhs_table_id
+        query_context.join_key_indices = rhs_indices
+        query_context.lhs_join_key_indices = lhs_indices
+
+    # Semi-join queries reference join table fields only in the ON clause which is evaluated by the join map, so join records are not available in the main loop.
+    init_join_variables_map = None if query_context.semi_join else join_variables_map
+    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map, init_join_variables_map), string_literals)
 
 
     if WHERE in rb_actions:
@@ -1535,6 +3375,15 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         if re.search(r'[^><!=]=[^=]', where_expression) is not None:
             raise RbqlParsingError('Assignments "=" are not allowed in "WHERE" expressions. For equality test use "=="') # UT JSON
         query_context.where_expression = combine_string_literals(where_expression, string_literals)
+        file_key_indices = input_iterator.get_file_key_indices()
+        is_strict_join = JOIN in rb_actions and rb_actions[JOIN]['join_subtype'] == STRICT_LEFT_JOIN
+        # UPDATE queries output all records and NR values would depend on skipped files. Strict left joins validate the number of B matches before WHERE is evaluated
+        if file_key_indices and UPDATE not in rb_actions and not is_strict_join and re.search(r'\b(NR|aNR)\b', format_expression) is None:
+            filter_conjuncts = [c for c in split_top_level_conjuncts(where_expression) if is_file_key_only_expression(c, input_variables_map, join_variables_map, file_key_indices)]
+            if len(filter_conjuncts):
+                filter_expression = ' and '.join(['({})'.format(c) for c in filter_conjuncts])
+                query_context.input_file_filter_expression = combine_string_literals(filter_expression, string_literals)
+                query_context.input_file_filter_init_code = combine_string_literals(generate_filter_init_statements(filter_expression, input_variables_map, 'a'), string_literals)
 
 
     if UPDATE in rb_actions:
@@ -1563,7 +3412,11 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         if query_context.top_count is not None:
             query_context.writer = TopWriter(query_context.writer, query_context.top_count)
         if 'distinct_count' in rb_actions[SELECT]:
-            query_context.writer = UniqCountWriter(query_context.writer)
+            if APPROXIMATE_MODIFIER in query_modifiers and query_context.top_count is not None:
+                query_context.writer = UniqCountWriter(query_context.writer, approximate_top_count=query_context.top_count)
+                query_context.warning_sources.append(query_context.writer)
+            else:
+                query_context.writer = UniqCountWriter(query_context.writer)
         elif 'distinct' in rb_actions[SELECT]:
             query_context.writer = UniqWriter(query_context.writer)
 
@@ -1589,26 +3442,529 @@ def split_query_to_stages(query_text):
     return re.split(pattern, query_text, flags=re.IGNORECASE)
 
 
-def staged_query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace):
-    query_context = RBQLContext(input_iterator, output_writer, user_init_code)
-    shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
+aggregate_or_unnest_call_rgx = re.compile(r'\b(?:any_value|min|max|count|sum|avg|variance|median|percentile|approx_percentile|approx_count_distinct|top_k|array_agg|unnest)\s*\(', flags=re.IGNORECASE)
+
+
+def parse_stage_actions(query_text):
+    format_expression, _string_literals = separate_string_literals(cleanup_query(query_text))
+    statement_groups = default_statement_groups[:]
+    statement_groups.remove([FROM])
+    try:
+        return format_expression, separate_actions(statement_groups, format_expression)
+    except RbqlParsingError:
+        return format_expression, None # The error will be reported when the stage is parsed for execution
+
+
+def is_row_wise_stage(query_text):
+    # Row-wise stages only map and filter records one by one, so they can be fused into the main loop of the next stage.
+    format_expression, rb_actions = parse_stage_actions(query_text)
+    if rb_actions is None or SELECT not in rb_actions or not set(rb_actions.keys()).issubset([SELECT, WHERE, EXCEPT, WITH]):
+        return False
+    if rb_actions[SELECT].get('top') is not None or rb_actions[SELECT].get('distinct') or rb_actions[SELECT].get('distinct_count'):
+        return False
+    # Aggregate functions and UNNEST can change the number of output records, so stages that use them are never fused.
+    return aggregate_or_unnest_call_rgx.search(format_expression) is None
+
+
+def is_join_stage(query_text):
+    _format_expression, rb_actions = parse_stage_actions(query_text)
+    return rb_actions is None or JOIN in rb_actions
+
+
+def group_fused_stages(query_stages):
+    # Splits pipeline stages into groups that run in a single main loop: zero or more row-wise stages followed by a stage that processes their output.
+    # Join stages don't take fused stages because join maps can reorder and replay records of the input iterator, see JoinMap.wrap_input_iterator()
+    stage_groups = [[]]
+    for i, query_stage_text in enumerate(query_stages):
+        stage_groups[-1].append(query_stage_text)
+        if i + 1 < len(query_stages) and not (is_row_wise_stage(query_stage_text) and not is_join_stage(query_stages[i + 1])):
+            stage_groups.append([])
+    return stage_groups
+
+
+def parse_fused_stages(fused_stage_texts, input_iterator, user_init_code):
+    # Returns contexts of the fused stages and an iterator that provides the output header of the last fused stage for parsing of the next stage.
+    fused_stages = []
+    for query_stage_text in fused_stage_texts:
+        header_writer = TableWriter([])
+        stage_context = RBQLContext(input_iterator, header_writer, user_init_code)
+        shallow_parse_input_query(query_stage_text, input_iterator, None, stage_context)
+        assert stage_context.writer is header_writer and stage_context.select_expression is not None and stage_context.join_map_impl is None
+        fused_stages.append(stage_context)
+        input_iterator = TableIterator([], header_writer.header)
+    return fused_stages, input_iterator
+
+
+def use_thread_workers():
+    if parallel_backend is not None:
+        return parallel_backend == 'threads'
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None) # Available since Python 3.13
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+class ParallelExecutor(object):
+    # Runs tasks of parallel queries in a thread pool or in a process pool.
+    # Thread workers share memory with the main process, so their runs are kept in memory and the user namespace is available to them.
+    # Process workers save runs into files in a temporary work directory. Each worker parses and compiles the query into its own RBQLContext, so no query state is shared in both cases.
+    def __init__(self, num_workers, use_threads):
+        self.num_workers = num_workers
+        self.use_threads = use_threads
+        self.work_dir = None if use_threads else tempfile.mkdtemp(prefix='rbql_parallel_')
+        self.pool = None
+
+    def run_tasks(self, task_function, tasks_args):
+        # Returns None if any of the tasks has failed. The query is then executed serially, so that errors are reported exactly as in serial mode
+        import concurrent.futures
+        if self.pool is None:
+            pool_type = concurrent.futures.ThreadPoolExecutor if self.use_threads else concurrent.futures.ProcessPoolExecutor
+            self.pool = pool_type(max_workers=self.num_workers)
+        futures = [self.pool.submit(task_function, *task_args) for task_args in tasks_args]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            return None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def make_parallel_executor(num_workers, user_namespace):
+    try:
+        import concurrent.futures
+    except ImportError:
+        return None # Python 2 doesn't have concurrent.futures, queries are executed serially
+    use_threads = use_thread_workers()
+    if user_namespace is not None and not use_threads:
+        return None # User namespace can't be shared with worker processes
+    return ParallelExecutor(num_workers, use_threads)
+
+
+class RunWriter(object):
+    # Collects entries of a run or a bucket in memory for thread workers (work_dir is None) or in a file for process workers, see iterate_run()
+    def __init__(self, work_dir):
+        self.entries = None
+        self.run_path = None
+        self.run_file = None
+        if work_dir is None:
+            self.entries = []
+        else:
+            run_fd, self.run_path = tempfile.mkstemp(prefix='rbql_run_', dir=work_dir)
+            self.run_file = os.fdopen(run_fd, 'wb')
+
+    def add(self, entry):
+        if self.entries is not None:
+            self.entries.append(entry)
+        else:
+            pickle.dump(entry, self.run_file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        # Returns the run: either a list of entries or a path to the run file
+        if self.run_file is not None:
+            self.run_file.close()
+            return self.run_path
+        return self.entries
+
+
+def save_run(entries, work_dir):
+    run_writer = RunWriter(work_dir)
+    for entry in entries:
+        run_writer.add(entry)
+    return run_writer.close()
+
+
+def iterate_run(run):
+    if isinstance(run, list):
+        for entry in run:
+            yield entry
+        return
+    with open(run, 'rb') as run_file:
+        for entry in iterate_pickled_entries(run_file):
+            yield entry
+
+
+def merge_runs(runs, reverse=False):
+    # Entries of each run must be ordered and unique, so that records themselves are never compared by the merge.
+    return heapq.merge(*[iterate_run(run) for run in runs], reverse=reverse)
+
+
+class SortedRunWriter(object):
+    # Collects output of a partition in parallel ORDER BY queries and sorts it into a run, see run_parallel_sort()
+    def __init__(self, partition_index, reverse_sort):
+        self.partition_index = partition_index
+        self.reverse_sort = reverse_sort
+        self.entries = []
+
+    def write(self, sort_key_value, record):
+        self.entries.append((sort_key_value, self.partition_index, len(self.entries), record))
+        return True
+
+    def finish(self):
+        # Same stable sort as in SortedWriter. Partition indices and sequence numbers order records with equal keys in the original order when the runs are merged.
+        self.entries.sort(key=lambda x: x[0])
+        if self.reverse_sort:
+            self.entries.reverse()
+
+
+def get_partition_stats(partition_iterator):
+    fields_info = partition_iterator.fields_info
+    partition_iterator.fields_info = dict() # NR of partition records is relative to the partition start, the number of fields warning is reported for the whole table by the main process
+    return (partition_iterator.NR, fields_info, partition_iterator.get_warnings())
+
+
+def parse_partition_query(query_text, input_header, join_tables_registry, user_init_code):
+    # Queries are parsed in workers against the table headers, so variables are resolved like in the main process.
+    schema_iterator = TableIterator([], input_header)
+    query_context = RBQLContext(schema_iterator, TableWriter([]), user_init_code)
+    shallow_parse_input_query(query_text, schema_iterator, join_tables_registry, query_context)
+    return query_context
+
+
+def run_partition_query(query_text, input_header, partition, writer, user_init_code, user_namespace):
+    # Executes the query over a single partition of the input table in a worker
+    query_context = parse_partition_query(query_text, input_header, None, user_init_code)
+    query_context.writer = writer # The output header, TOP, DISTINCT and sorting are handled by the main process
+    partition_iterator = partition.open()
+    try:
+        query_context.input_iterator = partition_iterator
+        compile_and_run(query_context, user_namespace)
+        writer.finish()
+        return get_partition_stats(partition_iterator)
+    finally:
+        partition.close()
+
+
+def run_sorted_partition(query_text, input_header, partition, partition_index, reverse_sort, user_init_code, user_namespace, work_dir):
+    run_writer = SortedRunWriter(partition_index, reverse_sort)
+    partition_stats = run_partition_query(query_text, input_header, partition, run_writer, user_init_code, user_namespace)
+    return (save_run(run_writer.entries, work_dir), partition_stats)
+
+
+def merge_partition_stats(table_iterator, partition_stats_list, output_warnings):
+    # Records that were read before partitioning are the header, they are counted in NR of the table iterator
+    nr_offset = table_iterator.NR if table_iterator.get_header() is not None else 0
+    table_warnings = table_iterator.get_warnings()
+    for partition_nr, fields_info, partition_warnings in partition_stats_list:
+        for num_fields, nr in fields_info.items():
+            table_iterator.fields_info.setdefault(num_fields, nr_offset + nr)
+        nr_offset += partition_nr
+        for warning in partition_warnings:
+            if warning not in table_warnings and warning not in output_warnings:
+                output_warnings.append(warning)
+
+
+def get_partition_nr_offsets(partition_stats_list):
+    # NR of the first record of each partition minus one, the header is not counted
+    nr_offsets = [0]
+    for partition_nr, _fields_info, _partition_warnings in partition_stats_list[:-1]:
+        nr_offsets.append(nr_offsets[-1] + partition_nr)
+    return nr_offsets
+
+
+def can_run_in_parallel(query_text, query_context):
+    if len(query_context.fused_stages) or query_context.select_expression is None or query_context.aggregation_stage != 0:
+        return False
+    # NR in workers is relative to the partition start and aggregate functions need all records of the table
+    return re.search(r'\bNR\b', query_text) is None and aggregate_or_unnest_call_rgx.search(query_text) is None
+
+
+def run_parallel_sort(query_text, query_context, executor, user_namespace, output_warnings):
+    # Each worker sorts records of a part of the input table into a run, the runs are merged into the output by the main process.
+    # Returns False if the query should be executed serially.
+    if query_context.sort_key_expression is None or not can_run_in_parallel(query_text, query_context):
+        return False
+    partitions = query_context.input_iterator.get_partitions(executor.num_workers)
+    if partitions is None or len(partitions) < 2:
+        return False
+    sorted_writer = query_context.writer
+    input_header = query_context.input_iterator.get_header()
+    partition_results = executor.run_tasks(run_sorted_partition, [(query_text, input_header, partition, i, sorted_writer.reverse_sort, query_context.user_init_code, user_namespace, executor.work_dir) for i, partition in enumerate(partitions)])
+    if partition_results is None:
+        return False
+    for _sort_key, _partition_index, _seq, record in merge_runs([run for run, _partition_stats in partition_results], reverse=sorted_writer.reverse_sort):
+        if not sorted_writer.subwriter.write(record):
+            break
+    merge_partition_stats(query_context.input_iterator, [partition_stats for _run, partition_stats in partition_results], output_warnings)
+    return True
+
+
+def scatter_partition(partition, key_indices, num_buckets, work_dir):
+    # Hash-partitions records of a part of a table by the join key into buckets of (seq, record) entries, see run_parallel_join().
+    # Fingerprints of keys don't depend on the process, so records with equal keys of both tables get into buckets with the same index.
+    bucket_writers = []
+    partition_iterator = partition.open()
+    try:
+        bucket_writers = [RunWriter(work_dir) for _ in range(num_buckets)]
+        max_record_len = 0
+        while True:
+            record = partition_iterator.get_record()
+            if record is None:
+                break
+            max_record_len = max(max_record_len, len(record))
+            key_fingerprint = record_fingerprint(tuple([safe_get(record, i) for i in key_indices]))
+            bucket_writers[get_fingerprint_bucket(key_fingerprint, num_buckets)].add((partition_iterator.NR, record))
+        return ([bucket_writer.close() for bucket_writer in bucket_writers], max_record_len, get_partition_stats(partition_iterator))
+    finally:
+        for bucket_writer in bucket_writers:
+            bucket_writer.close()
+        partition.close()
+
+
+class BucketHashJoinMap(HashJoinMap):
+    # Hash join map over a single bucket of the join table in parallel join queries, see run_parallel_join()
+    cacheable = False
+
+    def __init__(self, buckets, nr_offsets, key_indices, max_record_len):
+        super(BucketHashJoinMap, self).__init__(None, key_indices)
+        self.buckets = buckets
+        self.nr_offsets = nr_offsets
+        self.global_max_record_len = max_record_len
+        self.cached_warnings = []
+
+
+    def build(self):
+        # Buckets of the join table partitions are read in the table order, so matches of each key are ordered by bNR like in serial mode
+        for bucket, nr_offset in zip(self.buckets, self.nr_offsets):
+            for seq, fields in iterate_run(bucket):
+                nr = nr_offset + seq
+                key = self.polymorphic_get_key(nr, fields)
+                if self.is_rejected_by_filter(fields):
+                    continue
+                self.hash_map[key].append((nr, len(fields), self.make_stored_record(fields)))
+        self.max_record_len = self.global_max_record_len
+
+
+class BucketRunWriter(object):
+    # Tags output records with the position of the input record, so that the main process can merge outputs of all buckets in the input table order
+    def __init__(self, bucket_iterator):
+        self.bucket_iterator = bucket_iterator
+        self.entries = []
+
+    def write(self, record):
+        partition_index, seq = self.bucket_iterator.position
+        self.entries.append((partition_index, seq, len(self.entries), record))
+        return True
+
+    def finish(self):
+        pass
+
+
+def probe_join_bucket(query_text, input_header, join_header, input_buckets, join_buckets, join_nr_offsets, join_max_record_len, user_init_code, user_namespace, work_dir):
+    query_context = parse_partition_query(query_text, input_header, JoinSchemaRegistry(join_header), user_init_code)
+    bucket_join_map = BucketHashJoinMap(join_buckets, join_nr_offsets, query_context.join_key_indices, join_max_record_len)
+    if query_context.join_map_impl.stored_field_indices is not None:
+        bucket_join_map.set_stored_field_indices(query_context.join_map_impl.stored_field_indices)
+    query_context.join_map_impl = bucket_join_map
+    query_context.input_iterator = BucketIterator(input_buckets)
+    query_context.writer = BucketRunWriter(query_context.input_iterator)
     compile_and_run(query_context, user_namespace)
+    return save_run(query_context.writer.entries, work_dir)
+
+
+def run_parallel_join(query_text, query_context, executor, user_namespace, output_warnings):
+    # Both tables are hash-partitioned by the join key into buckets, then each worker builds a hash map from a bucket of B and probes it with records of the same bucket of A.
+    # Outputs of the buckets are merged back in the input table order by the main process.
+    # Returns False if the query should be executed serially.
+    if type(query_context.join_map_impl) not in [GraceHashJoinMap, SemiJoinMap, InputTableHashJoinMap] or query_context.joiner_type not in [InnerJoiner, LeftJoiner, StrictLeftJoiner]:
+        return False
+    # Serial execution of TOP queries stops after the first output records, while the whole tables would be partitioned in parallel mode
+    if query_context.sort_key_expression is not None or query_context.top_count is not None or not can_run_in_parallel(query_text, query_context):
+        return False
+    if -1 in query_context.join_key_indices or -1 in query_context.lhs_join_key_indices:
+        return False
+    num_buckets = executor.num_workers
+    input_iterator = query_context.input_iterator
+    join_record_iterator = query_context.join_map_impl.record_iterator
+    input_partitions = input_iterator.get_partitions(executor.num_workers)
+    join_partitions = join_record_iterator.get_partitions(executor.num_workers)
+    if input_partitions is None or join_partitions is None:
+        return False
+    scatter_tasks = [(partition, query_context.lhs_join_key_indices, num_buckets, executor.work_dir) for partition in input_partitions]
+    scatter_tasks += [(partition, query_context.join_key_indices, num_buckets, executor.work_dir) for partition in join_partitions]
+    scatter_results = executor.run_tasks(scatter_partition, scatter_tasks)
+    if scatter_results is None:
+        return False
+    input_scatter_results = scatter_results[:len(input_partitions)]
+    join_scatter_results = scatter_results[len(input_partitions):]
+    join_nr_offsets = get_partition_nr_offsets([partition_stats for _buckets, _max_record_len, partition_stats in join_scatter_results])
+    join_max_record_len = max([max_record_len for _buckets, max_record_len, _partition_stats in join_scatter_results])
+    probe_tasks = []
+    for b in range(num_buckets):
+        input_buckets = [buckets[b] for buckets, _max_record_len, _partition_stats in input_scatter_results]
+        join_buckets = [buckets[b] for buckets, _max_record_len, _partition_stats in join_scatter_results]
+        probe_tasks.append((query_text, input_iterator.get_header(), join_record_iterator.get_header(), input_buckets, join_buckets, join_nr_offsets, join_max_record_len, query_context.user_init_code, user_namespace, executor.work_dir))
+    runs = executor.run_tasks(probe_join_bucket, probe_tasks)
+    if runs is None:
+        return False
+    input_nr_offsets = get_partition_nr_offsets([partition_stats for _buckets, _max_record_len, partition_stats in input_scatter_results])
+    for partition_index, seq, _output_index, record in merge_runs(runs):
+        try:
+            if not query_context.writer.write(record):
+                break
+        except Exception as e:
+            if debug_mode:
+                raise
+            # Output errors are reported like in the main loop, see MAIN_LOOP_BODY
+            raise RbqlRuntimeError('At record {}, Details: {}'.format(input_nr_offsets[partition_index] + seq, e))
+    merge_partition_stats(input_iterator, [partition_stats for _buckets, _max_record_len, partition_stats in input_scatter_results], output_warnings)
+    merge_partition_stats(join_record_iterator, [partition_stats for _buckets, _max_record_len, partition_stats in join_scatter_results], output_warnings)
+    return True
+
+
+def run_parallel_query(query_text, query_context, num_workers, user_namespace, output_warnings):
+    # Returns False if the query can't be executed in parallel and should be executed serially
+    executor = make_parallel_executor(num_workers, user_namespace)
+    if executor is None:
+        return False
+    try:
+        if query_context.join_map_impl is not None:
+            return run_parallel_join(query_text, query_context, executor, user_namespace, output_warnings)
+        return run_parallel_sort(query_text, query_context, executor, user_namespace, output_warnings)
+    finally:
+        executor.close()
+
+
+def staged_query(query_stage_group, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace, parallel_workers=None):
+    # All stages of the group run in a single main loop, see group_fused_stages()
+    fused_stages, stage_input_iterator = parse_fused_stages(query_stage_group[:-1], input_iterator, user_init_code)
+    query_context = RBQLContext(stage_input_iterator, output_writer, user_init_code)
+    shallow_parse_input_query(query_stage_group[-1], stage_input_iterator, join_tables_registry, query_context)
+    if len(fused_stages):
+        query_context.input_iterator = input_iterator
+        query_context.fused_stages = fused_stages
+    if not parallel_workers or not run_parallel_query(query_stage_group[-1], query_context, parallel_workers, user_namespace, output_warnings):
+        compile_and_run(query_context, user_namespace)
+    if query_context.join_map_impl is not None:
+        query_context.join_map_impl.finish()
     query_context.writer.finish()
     output_warnings.extend(query_context.input_iterator.get_warnings())
+    for stage_context in query_context.fused_stages:
+        if len(stage_context.output_fields_info) > 1:
+            output_warnings.append(make_inconsistent_num_fields_warning('input', stage_context.output_fields_info))
+    for warning_source in query_context.warning_sources:
+        output_warnings.extend(warning_source.get_warnings())
     if query_context.join_map_impl is not None:
         output_warnings.extend(query_context.join_map_impl.get_warnings())
     output_warnings.extend(output_writer.get_warnings())
 
 
-def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
-    query_stages = split_query_to_stages(query_text)
-    previous_pipe = None
-    for i, query_stage_text in enumerate(query_stages):
-        output_pipe = TablePipe() if i + 1 < len(query_stages) else None
-        stage_iterator = input_iterator if previous_pipe is None else previous_pipe.get_iterator()
-        stage_writer = output_writer if output_pipe is None else output_pipe.get_writer()
-        staged_query(query_stage_text, stage_iterator, stage_writer, output_warnings, join_tables_registry, user_init_code, user_namespace)
-        previous_pipe = output_pipe
+def run_pipeline_stage(query_stage_group, input_iterator, output_pipe, output_warnings, join_tables_registry, user_init_code, user_namespace, stage_errors):
+    try:
+        staged_query(query_stage_group, input_iterator, output_pipe.get_writer(), output_warnings, join_tables_registry, user_init_code, user_namespace)
+    except Exception as e:
+        stage_errors.append(e)
+        output_pipe.fail(e)
+
+
+def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None, parallel_workers=None):
+    # parallel_workers enables parallel execution of eligible single-stage queries over input tables that support partitioning, see RBQLInputIterator.get_partitions()
+    query_stage_groups = group_fused_stages(split_query_to_stages(query_text))
+    if len(query_stage_groups) == 1:
+        staged_query(query_stage_groups[0], input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace, parallel_workers)
+        return
+    # All stage groups except the last one run in separate threads, each stage reads the output of the previous one through a QueuePipe.
+    pipes = []
+    stage_threads = []
+    stage_warnings = []
+    stage_errors = []
+    try:
+        stage_iterator = input_iterator
+        for query_stage_group in query_stage_groups[:-1]:
+            pipes.append(QueuePipe())
+            stage_warnings.append([])
+            stage_thread = threading.Thread(target=run_pipeline_stage, args=(query_stage_group, stage_iterator, pipes[-1], stage_warnings[-1], join_tables_registry, user_init_code, user_namespace, stage_errors))
+            stage_thread.daemon = True
+            stage_thread.start()
+            stage_threads.append(stage_thread)
+            stage_iterator = pipes[-1].get_iterator()
+        stage_warnings.append([])
+        staged_query(query_stage_groups[-1], stage_iterator, output_writer, stage_warnings[-1], join_tables_registry, user_init_code, user_namespace)
+    finally:
+        # Closing the pipes stops the previous stages if the last stage has finished early e.g. because of TOP/LIMIT or an error.
+        for pipe in pipes:
+            pipe.close()
+        for stage_thread in stage_threads:
+            stage_thread.join()
+    if len(stage_errors):
+        raise stage_errors[0]
+    for warnings in stage_warnings:
+        output_warnings.extend(warnings)
+
+
+def get_query_modifiers(query_text):
+    # Returns modifiers of the first stage of the query, e.g. `header` for `SELECT * WITH (header)`
+    format_expression, _string_literals = separate_string_literals(cleanup_query(split_query_to_stages(query_text)[0]))
+    return separate_actions(default_statement_groups, format_expression).get(WITH, [])
+
+
+def broadcast_input_table(input_iterator, pipes):
+    header = input_iterator.get_header()
+    for pipe in pipes:
+        # Number of fields warnings of the queries should use the input table record numbering which can include the header line
+        pipe.get_iterator().NR = getattr(input_iterator, 'NR', 0)
+        pipe.get_iterator().fields_info = dict(getattr(input_iterator, 'fields_info', None) or {})
+        pipe.get_writer().set_header(header)
+    active_pipes = pipes
+    batch = []
+    while len(active_pipes):
+        record = input_iterator.get_record()
+        if record is not None:
+            batch.append(record)
+            if len(batch) < pipeline_batch_size:
+                continue
+        if len(batch):
+            # Pipes of queries that have finished early are closed, they don't get new batches
+            active_pipes = [pipe for pipe in active_pipes if pipe.put(batch)]
+            batch = []
+        if record is None:
+            break
+    for pipe in active_pipes:
+        pipe.put(None)
+
+
+def run_shared_scan_query(query_text, pipe, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace, query_errors, query_index):
+    try:
+        query(query_text, pipe.get_iterator(), output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace)
+    except Exception as e:
+        query_errors[query_index] = e
+    finally:
+        # Stops passing records to this query if it has finished early e.g. because of TOP/LIMIT or an error
+        pipe.close()
+
+
+def query_multiple(query_texts, input_iterator, output_writers, output_warnings_list, join_tables_registries=None, user_init_code='', user_namespace=None):
+    # Executes multiple queries in a single pass over the input table: each record is read and parsed only once and record batches are passed to all queries through QueuePipes, each query runs in its own thread.
+    # Batches and records are shared by the queries, so they must not be modified in place. WITH modifiers of all queries are applied to the shared input table.
+    # join_tables_registries is either a list with a registry for each query or None.
+    # Returns a list with the exception of each failed query or None for each successful query, an error or early termination of one query doesn't stop the others.
+    for query_text in query_texts:
+        for modifier in get_query_modifiers(query_text):
+            input_iterator.handle_query_modifier(modifier)
+    query_errors = [None] * len(query_texts)
+    pipes = [QueuePipe() for _ in query_texts]
+    query_threads = []
+    for i, query_text in enumerate(query_texts):
+        query_thread = threading.Thread(target=run_shared_scan_query, args=(query_text, pipes[i], output_writers[i], output_warnings_list[i], join_tables_registries[i] if join_tables_registries else None, user_init_code, user_namespace, query_errors, i))
+        query_thread.daemon = True
+        query_thread.start()
+        query_threads.append(query_thread)
+    try:
+        broadcast_input_table(input_iterator, pipes)
+    except Exception as e:
+        # Input table errors are reported by every query that hasn't finished yet
+        for pipe in pipes:
+            pipe.fail(e)
+    for query_thread in query_threads:
+        query_thread.join()
+    # Each query reports the number of fields warning for the records that it has read, see QueuePipeIterator
+    if getattr(input_iterator, 'fields_info', None) is not None:
+        input_iterator.fields_info = dict()
+    input_warnings = input_iterator.get_warnings()
+    for output_warnings in output_warnings_list:
+        output_warnings.extend([warning for warning in input_warnings if warning not in output_warnings])
+    return query_errors
 
 
 class RBQLInputIterator:
@@ -1628,6 +3984,88 @@ class RBQLInputIterator:
     def get_header(self):
         return None # Reimplement if your class can provide input header
 
+    def get_size_estimate(self):
+        return None # Reimplement if your class can estimate the table size in bytes, see should_build_join_on_input_table()
+
+    def get_records_with_positions(self):
+        # Reimplement together with get_record_at() if your class supports random access to records, see BinarySearchJoinMap.
+        # Should return an iterable of (record, position) pairs for all records of the table, positions are opaque to the engine.
+        return None
+
+    def get_record_at(self, position):
+        raise NotImplementedError('Unable to call the interface method')
+
+    def get_file_key_indices(self):
+        # Reimplement if the table consists of multiple files and some fields have the same value in all records of each file, e.g. hive-style `key=value` path segments.
+        # WHERE conjuncts that depend only on these fields are passed to set_file_filter(), so that whole files can be skipped.
+        return None
+
+    def set_file_filter(self, file_filter):
+        pass # file_filter(record) returns False if all records of the file would be rejected by WHERE, only file key fields of the record are set
+
+    def get_partitions(self, num_partitions):
+        # Reimplement if the rest of your table can be split into parts for parallel execution in worker processes, see run_parallel_query().
+        # Should return a list of picklable partitions in table order: partition.open() returns an iterator over records of the partition and partition.close() releases it.
+        # Partition iterators must count records in NR and sizes of records in fields_info like TableIterator, NR starts from the first record after the header.
+        return None
+
+    def supports_key_lookups(self, key_indices):
+        # Reimplement together with lookup_records() if your class can find records by the join key without a full scan, see LookupJoinMap.
+        # key_indices are 0-based field indices of the join key, -1 stands for NR.
+        return False
+
+    def lookup_records(self, key):
+        # Should return a list of (record_number, record) pairs for all records with the given join key in the table scan order, record_number can be None.
+        # key is a single value for single-field keys and a tuple otherwise. Records with other keys are allowed in the result: keys are compared with `==` again by LookupJoinMap.
+        raise NotImplementedError('Unable to call the interface method')
+
+
+class PartitionedJoinInputIterator(RBQLInputIterator):
+    # Replays input records in the original order together with their join matches precomputed by GraceHashJoinMap or InputTableHashJoinMap.
+    def __init__(self, source_iterator, merged_matches, join_map, num_records):
+        self.source_iterator = source_iterator
+        self.merged_matches = merged_matches
+        self.join_map = join_map
+        self.num_unread_records = num_records
+
+    def get_record(self):
+        for _nr, record_a, matches in self.merged_matches:
+            self.join_map.current_matches = matches
+            self.num_unread_records -= 1
+            return record_a
+        return None
+
+    def get_warnings(self):
+        fields_info = getattr(self.source_iterator, 'fields_info', None)
+        if fields_info is not None and self.num_unread_records > 0:
+            # The source table has been read in advance, so the number of fields warning should only cover records that were replayed before the query stopped e.g. because of TOP/LIMIT
+            last_nr = self.source_iterator.NR - self.num_unread_records
+            self.source_iterator.fields_info = {num_fields: nr for num_fields, nr in fields_info.items() if nr <= last_nr}
+        return self.source_iterator.get_warnings()
+
+    def get_header(self):
+        return self.source_iterator.get_header()
+
+
+class BucketIterator(RBQLInputIterator):
+    # Reads records of a single bucket of the input table in parallel join queries, see run_parallel_join()
+    def __init__(self, buckets):
+        self.entries = self.iterate_entries(buckets)
+        self.position = None
+        self.NR = 0
+
+    def iterate_entries(self, buckets):
+        for partition_index, bucket in enumerate(buckets):
+            for seq, record in iterate_run(bucket):
+                yield (partition_index, seq, record)
+
+    def get_record(self):
+        for partition_index, seq, record in self.entries:
+            self.position = (partition_index, seq)
+            self.NR += 1
+            return record
+        return None
+
 
 class RBQLOutputWriter:
     def write(self, fields):
@@ -1649,6 +4087,12 @@ class RBQLTableRegistry:
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         raise NotImplementedError('Unable to call the interface method')
 
+    def load_join_map_state(self, table_id, state_format, key_indices):
+        return None # Reimplement if your class can cache join maps built from its tables, see build_join_map()
+
+    def save_join_map_state(self, table_id, state_format, key_indices, state):
+        pass # Reimplement if your class can cache join maps built from its tables
+
     def finish(self):
         pass # Reimplement if your class needs to do something on finish e.g. cleanup
 
@@ -1697,6 +4141,19 @@ class TableIterator(RBQLInputIterator):
     def get_header(self):
         return self.column_names
 
+    def get_records_with_positions(self):
+        result = []
+        while True:
+            position = self.NR
+            record = self.get_record()
+            if record is None:
+                break
+            result.append((record, position))
+        return result
+
+    def get_record_at(self, position):
+        return self.table[position]
+
 
 class TableWriter(RBQLOutputWriter):
     def __init__(self, external_table):
@@ -1716,24 +4173,124 @@ class TableWriter(RBQLOutputWriter):
         self.finished = True
 
 
-class TablePipe:
-    # Each concrete class with Pipe interface like this one should know how to pass data and header from the reader to the iterator, so they can share some internal info
+class QueuePipeWriter(RBQLOutputWriter):
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.batch = []
+
+    def write(self, fields):
+        self.batch.append(fields)
+        if len(self.batch) >= pipeline_batch_size:
+            batch = self.batch
+            self.batch = []
+            # The reader has stopped, so there is no need to produce more records.
+            return self.pipe.put(batch)
+        return True
+
+    def set_header(self, header):
+        self.pipe.header = header
+        self.pipe.header_ready.set()
+
+    def finish(self):
+        if len(self.batch):
+            self.pipe.put(self.batch)
+            self.batch = []
+        self.pipe.put(None)
+        self.pipe.header_ready.set()
+
+
+class QueuePipeIterator(TableIterator):
+    # TableIterator is an old-style class in python2, so super() can't be used here
+    def __init__(self, pipe):
+        TableIterator.__init__(self, [], None)
+        self.pipe = pipe
+        self.batch_pos = 0
+        self.finished = False
+
+    def get_header(self):
+        self.pipe.wait_header()
+        return self.pipe.header
+
+    def get_variables_map(self, query_text):
+        self.column_names = self.get_header()
+        return TableIterator.get_variables_map(self, query_text)
+
+    def get_record(self):
+        if self.batch_pos >= len(self.table):
+            if self.finished:
+                return None
+            self.table = self.pipe.get()
+            self.batch_pos = 0
+            if self.table is None:
+                self.table = []
+                self.finished = True
+                return None
+        record = self.table[self.batch_pos]
+        self.batch_pos += 1
+        self.NR += 1
+        num_fields = len(record)
+        if num_fields not in self.fields_info:
+            self.fields_info[num_fields] = self.NR
+        return record
+
+    def get_records_with_positions(self):
+        return None # Records are not retained after they have been read, so random access is not supported
+
+
+class QueuePipe:
+    # Each concrete class with Pipe interface like this one should know how to pass data and header from the writer to the iterator, so they can share some internal info.
+    # Records are passed in batches through a bounded queue, so the writer and the iterator must be used from different threads. None in the queue marks the end of the table.
     def __init__(self):
-        self.table = []
-        self.writer = TableWriter(self.table)
-        self.iterator = None
+        self.queue = queue.Queue(maxsize=pipeline_queue_batches)
+        self.header = None
+        self.header_ready = threading.Event()
+        self.closed = False
+        self.error = None
+        self.writer = QueuePipeWriter(self)
+        self.iterator = QueuePipeIterator(self)
 
     def get_writer(self):
         return self.writer
 
     def get_iterator(self):
-        if not self.writer.finished:
-            # We don't have to check it in other pipes if implemented but this one is not thread safe.
-            raise RbqlIOHandlingError("Trying to read from non-thread-safe table pipe while not finishing writing yet")
-        if self.iterator is None:
-            self.iterator = TableIterator(self.table, self.writer.header)
         return self.iterator
 
+    def put(self, batch):
+        # Returns False if the reader has closed the pipe
+        while not self.closed:
+            try:
+                self.queue.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self):
+        # Returns None if the pipe has been closed, the writer can be unable to put the end of the table marker into the full queue after that
+        batch = None
+        while not self.closed:
+            try:
+                batch = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        if batch is None and self.error is not None:
+            raise self.error
+        return batch
+
+    def wait_header(self):
+        self.header_ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def fail(self, error):
+        self.error = error
+        self.header_ready.set()
+        self.put(None)
+
+    def close(self):
+        self.closed = True
+
 
 
 ListTableInfo = namedtuple('ListTableInfo', ['table_id', 'table', 'column_names'])
@@ -1752,6 +4309,15 @@ class ListTableRegistry(RBQLTableRegistry):
         return None
 
 
+class JoinSchemaRegistry(RBQLTableRegistry):
+    # Provides the join table header for parsing of parallel join queries in workers
+    def __init__(self, join_header):
+        self.join_header = join_header
+
+    def get_iterator_by_table_id(self, table_id, single_char_alias):
+        return TableIterator([], self.join_header, variable_prefix=single_char_alias)
+
+
 # FIXME modify to support multipe join tables - accept ListTableRegistry. You can use multiple join tables per query via chain operator.
 def query_table(query_text, input_table, output_table, output_warnings, join_table=None, input_column_names=None, join_column_names=None, output_column_names=None, normalize_column_names=True, user_init_code=''):
     if not normalize_column_names and input_column_names is not None and join_column_names is not None:
@@ -78,7 +78,7 @@ def run_with_python_csv(args, is_interactive):
     warnings = []
     error_type, error_msg = None, None
     try:
-        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color, strip_whitespaces=args.strip_spaces, comment_regex=args.comment_regex)
+        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color, strip_whitespaces=args.strip_spaces, comment_regex=args.comment_regex, join_cache_dir=args.join_cache_dir, parallel_workers=args.parallel_workers, join_cache_memory_capacity=args.join_cache_memory)
     except Exception as e:
         if args.debug_mode:
             raise
@@ -95,6 +95,38 @@ def run_with_python_csv(args, is_interactive):
     return success
 
 
+def run_multiple_with_python_csv(args):
+    if args.debug_mode:
+        rbql_csv.set_debug_mode()
+    delim = rbql_csv.normalize_delim(args.delim)
+    policy = args.policy if args.policy is not None else get_default_policy(delim)
+    out_delim, out_policy = (delim, policy) if args.out_format == 'input' else rbql_csv.interpret_named_csv_format(args.out_format)
+    query_texts = [query_text for query_text, _output_path in args.multi_query]
+    output_paths = [output_path for _query_text, output_path in args.multi_query]
+    user_init_code = rbql_csv.read_user_init_code(args.init_source_file) if args.init_source_file is not None else ''
+
+    warnings_list = [[] for _ in query_texts]
+    try:
+        query_errors = rbql_csv.query_csv_multiple(query_texts, args.input, delim, policy, output_paths, out_delim, out_policy, args.encoding, warnings_list, args.with_headers, args.comment_prefix, user_init_code, strip_whitespaces=args.strip_spaces, comment_regex=args.comment_regex, join_cache_dir=args.join_cache_dir, join_cache_memory_capacity=args.join_cache_memory)
+    except Exception as e:
+        if args.debug_mode:
+            raise
+        error_type, error_msg = rbql_engine.exception_to_error_info(e)
+        show_error(error_type, error_msg, is_interactive=False)
+        return False
+
+    success = True
+    for output_path, warnings, query_error in zip(output_paths, warnings_list, query_errors):
+        if query_error is None:
+            for warning in warnings:
+                show_warning('{}: {}'.format(output_path, warning), is_interactive=False)
+        else:
+            success = False
+            error_type, error_msg = rbql_engine.exception_to_error_info(query_error)
+            show_error(error_type, '{}: {}'.format(output_path, error_msg), is_interactive=False)
+    return success
+
+
 def run_with_python_sqlite(args, is_interactive):
     import sqlite3
     user_init_code = rbql_csv.read_user_init_code(args.init_source_file) if args.init_source_file is not None else ''
@@ -356,6 +388,9 @@ For json mode run this command:
 For sqlite mode run this command:
   $ rbql sqlite --help
 
+To apply a query to many CSV files with separate outputs run this command:
+  $ rbql batch --help
+
 '''
 
 csv_epilog = '''
@@ -370,7 +405,7 @@ Description of the available CSV split policies:
 
 def csv_main():
     parser = argparse.ArgumentParser(prog='rbql [csv]', formatter_class=argparse.RawDescriptionHelpFormatter, description=csv_tool_description, epilog=csv_epilog)
-    parser.add_argument('--input', metavar='FILE', help='read csv table from FILE instead of stdin. Required in interactive mode')
+    parser.add_argument('--input', metavar='FILE', help='read csv table from FILE instead of stdin. Required in interactive mode. FILE can be a quoted glob pattern to query multiple files with the same structure as a single table')
     parser.add_argument('--delim', help='delimiter character or multicharacter string, e.g. "," or "###". Can be autodetected in interactive mode')
     parser.add_argument('--policy', help='CSV split policy, see the explanation below. Can be autodetected in interactive mode', choices=policy_names)
     parser.add_argument('--with-headers', action='store_true', help='indicates that input (and join) table has header')
@@ -382,6 +417,10 @@ def csv_main():
     parser.add_argument('--output', metavar='FILE', help='write output table to FILE instead of stdout')
     parser.add_argument('--strip-spaces', action='store_true', help='strip leading and trailing whitespace chars from each input field')
     parser.add_argument('--color', action='store_true', help='colorize columns in output in non-interactive mode')
+    parser.add_argument('--join-cache-dir', metavar='DIR', help='cache join table indexes in DIR to speed up repeated JOIN queries against the same tables')
+    parser.add_argument('--join-cache-memory', metavar='N', type=int, default=0, help='keep indexes of up to N join tables in memory and reuse them between queries of the same process, e.g. between files in batch mode')
+    parser.add_argument('--parallel-workers', metavar='N', type=int, help='execute ORDER BY queries over input files in N worker processes')
+    parser.add_argument('--multi-query', metavar=('QUERY', 'FILE'), nargs=2, action='append', help='run QUERY and write its output table to FILE. Can be repeated to run several queries in a single pass over the input table')
     parser.add_argument('--version', action='store_true', help='print RBQL version and exit')
     parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
     parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
@@ -406,6 +445,21 @@ def csv_main():
         show_error('generic', 'Using "--policy" without "--delim" is not allowed', is_interactive=False)
         sys.exit(1)
 
+    if args.multi_query is not None:
+        for option_name, option_value in [('--query', args.query), ('--output', args.output), ('--parallel-workers', args.parallel_workers)]:
+            if option_value is not None:
+                show_error('generic', '"--multi-query" is not compatible with "{}" option'.format(option_name), is_interactive=False)
+                sys.exit(1)
+        if args.color:
+            show_error('generic', '"--multi-query" is not compatible with "--color" option', is_interactive=False)
+            sys.exit(1)
+        if args.delim is None:
+            show_error('generic', 'Separator must be provided with "--delim" option in "--multi-query" mode', is_interactive=False)
+            sys.exit(1)
+        if not run_multiple_with_python_csv(args):
+            sys.exit(1)
+        return
+
     is_interactive_mode = args.query is None
     if is_interactive_mode:
         if args.color:
@@ -536,6 +590,75 @@ def sqlite_main():
             sys.exit(1)
 
 
+batch_tool_description = '''
+Apply an RBQL query to each of many CSV files and write a separate output file for each of them
+
+Usage example:
+  $ rbql batch --query "update set a2 = a2.strip()" --delim , --output-dir cleaned 'data/*.csv'
+
+Output files have the same paths relative to the output directory as the input files relative to their common directory.
+Files are processed in parallel, errors don't stop processing of other files and are reported in the summary together with warnings.
+'''
+
+
+def report_batch_results(results):
+    num_failed = len([result for result in results if result.error_type is not None])
+    print('Processed {} files: {} succeeded, {} failed'.format(len(results), len(results) - num_failed, num_failed))
+    warning_paths = dict()
+    for result in results:
+        for warning in result.warnings:
+            warning_paths.setdefault(warning, []).append(result.input_path)
+    for warning, paths in warning_paths.items():
+        if len(paths) == 1:
+            show_warning('{}: {}'.format(paths[0], warning), is_interactive=False)
+        else:
+            show_warning('{} (in {} files, e.g. {})'.format(warning, len(paths), paths[0]), is_interactive=False)
+    for result in results:
+        if result.error_type is not None:
+            show_error(result.error_type, '{}: {}'.format(result.input_path, result.error_msg), is_interactive=False)
+    return num_failed == 0
+
+
+def batch_main():
+    parser = argparse.ArgumentParser(prog='rbql batch', formatter_class=argparse.RawDescriptionHelpFormatter, description=batch_tool_description, epilog=csv_epilog)
+    parser.add_argument('inputs', metavar='INPUT', nargs='+', help='input CSV files or quoted glob patterns')
+    parser.add_argument('--query', required=True, help='query string in rbql')
+    parser.add_argument('--output-dir', metavar='DIR', required=True, help='write output tables to DIR')
+    parser.add_argument('--delim', required=True, help='delimiter character or multicharacter string, e.g. "," or "###"')
+    parser.add_argument('--policy', help='CSV split policy, see the explanation below', choices=policy_names)
+    parser.add_argument('--with-headers', action='store_true', help='indicates that input (and join) tables have header')
+    parser.add_argument('--comment-prefix', metavar='PREFIX', help='ignore lines in input and join tables that start with the comment PREFIX, e.g. "#"')
+    parser.add_argument('--comment-regex', metavar='REGEX', help='ignore lines in input and join tables that contain the comment REGEX')
+    parser.add_argument('--out-format', help='output format', default='input', choices=out_format_names)
+    parser.add_argument('--encoding', help='manually set csv encoding', default=rbql_csv.default_csv_encoding, choices=['latin-1', 'utf-8'])
+    parser.add_argument('--strip-spaces', action='store_true', help='strip leading and trailing whitespace chars from each input field')
+    parser.add_argument('--join-cache-dir', metavar='DIR', help='cache join table indexes in DIR to speed up repeated JOIN queries against the same tables')
+    parser.add_argument('--join-cache-memory', metavar='N', type=int, default=0, help='keep indexes of up to N join tables in memory and reuse them between queries of the same process, e.g. between files in batch mode')
+    parser.add_argument('--workers', metavar='N', type=int, help='process files in N worker processes, defaults to the number of CPUs')
+    parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
+    parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
+    args = parser.parse_args()
+
+    if args.debug_mode:
+        rbql_csv.set_debug_mode()
+    if args.policy == 'monocolumn':
+        args.delim = ''
+    delim = rbql_csv.normalize_delim(args.delim)
+    policy = args.policy if args.policy is not None else get_default_policy(delim)
+    out_delim, out_policy = (delim, policy) if args.out_format == 'input' else rbql_csv.interpret_named_csv_format(args.out_format)
+    user_init_code = rbql_csv.read_user_init_code(args.init_source_file) if args.init_source_file is not None else ''
+    try:
+        results = rbql_csv.query_csv_batch(args.query, args.inputs, args.output_dir, delim, policy, out_delim, out_policy, args.encoding, args.with_headers, args.comment_prefix, user_init_code, strip_whitespaces=args.strip_spaces, comment_regex=args.comment_regex, join_cache_dir=args.join_cache_dir, num_workers=args.workers, join_cache_memory_capacity=args.join_cache_memory)
+    except Exception as e:
+        if args.debug_mode:
+            raise
+        error_type, error_msg = rbql_engine.exception_to_error_info(e)
+        show_error(error_type, error_msg, is_interactive=False)
+        sys.exit(1)
+    if not report_batch_results(results):
+        sys.exit(1)
+
+
 def main():
     if len(sys.argv) > 1:
         if sys.argv[1] == 'sqlite':
@@ -547,6 +670,9 @@ def main():
         elif sys.argv[1] == 'csv':
             del sys.argv[1]
             csv_main()
+        elif sys.argv[1] == 'batch':
+            del sys.argv[1]
+            batch_main()
         else:
             # TODO Consider showing "unknown mode" error if the first argument doesn't start with '--'
             csv_main()
@@ -23,15 +23,24 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         if re.match('^[a-zA-Z0-9_]*$', table_name) is None:
             raise rbql_engine.RbqlIOHandlingError('Unable to use "{}": input table name can contain only alphanumeric characters and underscore'.format(table_name))
         try:
-            self.cursor.execute('SELECT * FROM {};'.format(table_name))
+            self.cursor.execute('SELECT * FROM {} LIMIT 0;'.format(table_name))
         except sqlite3.OperationalError as e:
             if str(e).find('no such table') != -1:
                 raise rbql_engine.RbqlIOHandlingError('no such table "{}"'.format(table_name))
             raise
+        self.column_names = [description[0] for description in self.cursor.description]
+        # The table scan starts with the first read, so join tables searched with key lookups don't leave an unfinished statement that would prevent the connection from closing
+        self.scan_started = False
+        self.lookup_query = None
+        self.lookup_single_key = True
+
+    def start_scan(self):
+        if not self.scan_started:
+            self.cursor.execute('SELECT * FROM {};'.format(self.table_name))
+            self.scan_started = True
 
     def get_header(self):
-        column_names = [description[0] for description in self.cursor.description]
-        return column_names
+        return self.column_names
 
     def get_variables_map(self, query_text):
         variable_map = dict()
@@ -42,6 +51,7 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         return variable_map
 
     def get_record(self):
+        self.start_scan()
         record_tuple = self.cursor.fetchone()
         if record_tuple is None:
             return None
@@ -50,6 +60,7 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
 
     def get_all_records(self, num_rows=None):
         # TODO consider to use TOP in the sqlite query when num_rows is not None
+        self.start_scan()
         if num_rows is None:
             return self.cursor.fetchall()
         result = []
@@ -63,6 +74,56 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
     def get_warnings(self):
         return []
 
+    def fetch_all(self, query, params=()):
+        # Cursors are closed right away, otherwise unfinalized statements would prevent the connection from closing
+        cursor = self.db_connection.cursor()
+        try:
+            return cursor.execute(query, params).fetchall()
+        finally:
+            cursor.close()
+
+    def get_indexed_column_lists(self):
+        # Returns lists of columns that can be searched without a full table scan: columns of each index in index order and the INTEGER PRIMARY KEY column
+        result = []
+        for index_info in self.fetch_all('PRAGMA index_list({});'.format(self.table_name)):
+            index_name = index_info[1]
+            if len(index_info) > 4 and index_info[4]:
+                continue # Partial indexes don't cover all records
+            index_columns = self.fetch_all('PRAGMA index_info("{}");'.format(index_name.replace('"', '""')))
+            result.append([column_info[2] for column_info in sorted(index_columns)])
+        table_info = self.fetch_all('PRAGMA table_info({});'.format(self.table_name))
+        primary_key_columns = [column_info for column_info in table_info if column_info[5]]
+        if len(primary_key_columns) == 1 and primary_key_columns[0][2].upper() == 'INTEGER':
+            result.append([primary_key_columns[0][1]])
+        return result
+
+    def supports_key_lookups(self, key_indices):
+        if -1 in key_indices:
+            return False
+        column_names = self.get_header()
+        key_columns = [column_names[i] for i in key_indices]
+        # Equality conditions on all columns of an index prefix let sqlite use the index for lookups.
+        if not any(set(key_columns) == set(index_columns[:len(key_columns)]) for index_columns in self.get_indexed_column_lists()):
+            return False
+        # `IS` matches NULL keys like python `==` does. Type affinity and collation of the columns can make sqlite match more records than `==`, so LookupJoinMap checks the keys of the returned records again.
+        conditions = ' AND '.join(['"{}" IS ?'.format(column_name.replace('"', '""')) for column_name in key_columns])
+        import sqlite3
+        try:
+            self.fetch_all('SELECT rowid FROM {} LIMIT 0;'.format(self.table_name))
+            has_rowid = True
+        except sqlite3.OperationalError:
+            has_rowid = False # "WITHOUT ROWID" tables are scanned in the primary key order which is also the order of equal keys in their indexes
+        # Matches are returned in the table scan order like in the hash join, otherwise sqlite would return them in the index order.
+        if has_rowid:
+            self.lookup_query = 'SELECT * FROM {} WHERE {} ORDER BY rowid;'.format(self.table_name, conditions)
+        else:
+            self.lookup_query = 'SELECT * FROM {} WHERE {};'.format(self.table_name, conditions)
+        self.lookup_single_key = len(key_indices) == 1
+        return True
+
+    def lookup_records(self, key):
+        return [(None, list(record_tuple)) for record_tuple in self.fetch_all(self.lookup_query, (key,) if self.lookup_single_key else key)]
+
 
 class SqliteDbRegistry(rbql_engine.RBQLTableRegistry):
     def __init__(self, db_connection):
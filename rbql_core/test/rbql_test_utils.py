@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..'))
+
+from rbql import rbql_engine
+
+
+class PatchingTestCase(unittest.TestCase):
+    # Module settings and functions that a test replaces are restored by the cleanup callbacks after tearDown
+
+    def patch_attribute(self, owner, name, value):
+        # Returns the original value of `owner.name`
+        original_value = getattr(owner, name)
+        self.addCleanup(setattr, owner, name, original_value)
+        setattr(owner, name, value)
+        return original_value
+
+    def save_attribute(self, owner, name):
+        # For settings that the test changes directly, e.g. `rbql_engine.join_table_memory_limit = 50`, returns the original value
+        return self.patch_attribute(owner, name, getattr(owner, name))
+
+    def spy_function(self, owner, name, on_call):
+        # `on_call(result, *args)` is invoked after every successful call of `owner.name`, returns the original function
+        original_function = getattr(owner, name)
+        def spy(*args):
+            result = original_function(*args)
+            on_call(result, *args)
+            return result
+        return self.patch_attribute(owner, name, spy)
+
+
+class JoinMapSpyTestCase(PatchingTestCase):
+    # Records join maps that were built by the queries
+    def setUp(self):
+        self.built_join_maps = []
+        self.built_join_map_impls = []
+        def on_build_join(_result, query_context, _record_filter):
+            self.built_join_maps.append(type(query_context.join_map_impl).__name__)
+            self.built_join_map_impls.append(query_context.join_map_impl)
+        self.spy_function(rbql_engine, 'build_join', on_build_join)
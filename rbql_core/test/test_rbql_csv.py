@@ -0,0 +1,567 @@
+import os
+import sys
+import argparse
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..'))
+
+from rbql import rbql_csv
+from rbql import rbql_engine
+from rbql import rbql_dbm
+from rbql_test_utils import PatchingTestCase
+
+
+def write_csv(path, table):
+    with open(path, 'w', encoding='utf-8') as dst:
+        for record in table:
+            dst.write(','.join(record) + '\n')
+
+
+def read_file(path):
+    with open(path, encoding='utf-8') as src:
+        return src.read()
+
+
+class CSVQueryTestCase(PatchingTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def run_query(self, query_text, input_name, output_name, with_headers=True, **kwargs):
+        warnings = []
+        rbql_csv.query_csv(query_text, self.get_path(input_name), ',', 'quoted', self.get_path(output_name), ',', 'quoted', 'utf-8', warnings, with_headers, **kwargs)
+        return read_file(self.get_path(output_name)), warnings
+
+    def make_join_tables(self, num_records=2000, num_keys=300):
+        rng = random.Random(len(self.id()))
+        write_csv(self.get_path('input.csv'), [['id', 'key', 'val']] + [[str(i), str(rng.randint(0, num_keys)), str(rng.randint(0, 100))] for i in range(num_records)])
+        write_csv(self.get_path('dim.csv'), [['key', 'name']] + [[str(k), 'name_{}'.format(k)] for k in range(0, num_keys, 2)])
+
+
+class TestJoinIndexCache(CSVQueryTestCase):
+    query_text = 'SELECT a.id, b.name JOIN dim.csv ON a.key == b.key'
+
+    def tearDown(self):
+        rbql_csv.join_map_memory_cache.clear()
+        super(TestJoinIndexCache, self).tearDown()
+
+    def test_disk_cache(self):
+        self.make_join_tables()
+        expected_output, _warnings = self.run_query(self.query_text, 'input.csv', 'expected.csv')
+        cache_dir = self.get_path('cache')
+        output, warnings = self.run_query(self.query_text, 'input.csv', 'first.csv', join_cache_dir=cache_dir)
+        self.assertEqual(expected_output, output)
+        self.assertTrue(any('was built from the table' in w for w in warnings))
+        output, warnings = self.run_query(self.query_text, 'input.csv', 'second.csv', join_cache_dir=cache_dir)
+        self.assertEqual(expected_output, output)
+        self.assertTrue(any('was loaded from the cache in' in w for w in warnings))
+
+    def test_memory_cache(self):
+        self.make_join_tables()
+        expected_output, _warnings = self.run_query(self.query_text, 'input.csv', 'expected.csv')
+        self.assertEqual(0, len(rbql_csv.join_map_memory_cache))
+        for i in range(3):
+            output, warnings = self.run_query(self.query_text, 'input.csv', 'output.csv', join_cache_memory_capacity=1)
+            self.assertEqual(expected_output, output)
+            self.assertEqual(i > 0, any('loaded from the in-memory cache' in w for w in warnings))
+        self.assertEqual(1, len(rbql_csv.join_map_memory_cache))
+
+    def test_memory_cache_capacity(self):
+        self.make_join_tables()
+        write_csv(self.get_path('dim2.csv'), [['key', 'name']] + [[str(k), 'other_{}'.format(k)] for k in range(0, 300, 3)])
+        self.run_query(self.query_text, 'input.csv', 'output.csv', join_cache_memory_capacity=1)
+        self.run_query('SELECT a.id, b.name JOIN dim2.csv ON a.key == b.key', 'input.csv', 'output.csv', join_cache_memory_capacity=1)
+        self.assertEqual(1, len(rbql_csv.join_map_memory_cache))
+        _output, warnings = self.run_query(self.query_text, 'input.csv', 'output.csv', join_cache_memory_capacity=1)
+        self.assertTrue(any('was built from the table' in w for w in warnings))
+
+    def test_modified_table_is_reindexed(self):
+        self.make_join_tables()
+        cache_dir = self.get_path('cache')
+        self.run_query(self.query_text, 'input.csv', 'output.csv', join_cache_dir=cache_dir, join_cache_memory_capacity=1)
+        write_csv(self.get_path('dim.csv'), [['key', 'name'], ['1', 'changed_name']])
+        output, warnings = self.run_query(self.query_text, 'input.csv', 'output.csv', join_cache_dir=cache_dir, join_cache_memory_capacity=1)
+        self.assertTrue(any('was built from the table' in w for w in warnings))
+        self.assertEqual({'changed_name'}, set(line.split(',')[1] for line in output.splitlines()[1:]))
+
+
+class TestBinarySearchJoin(CSVQueryTestCase):
+    def write_sorted_join_table(self, name, line_separator):
+        records = [['key', 'name']] + sorted([[str(k).zfill(3), u'имя_{}'.format(k)] for k in range(0, 300, 2)] + [['100', '"multi\nline, quoted"'], ['102', 'dup']])
+        with open(self.get_path(name), 'wb') as dst:
+            dst.write(line_separator.join(','.join(record) for record in records).encode('utf-8') + line_separator.encode('utf-8'))
+
+    def run_rfc_query(self, query_text, output_name, **kwargs):
+        warnings = []
+        rbql_csv.query_csv(query_text, self.get_path('input.csv'), ',', 'quoted_rfc', self.get_path(output_name), ',', 'quoted_rfc', 'utf-8', warnings, True, **kwargs)
+        return read_file(self.get_path(output_name)), warnings
+
+    def test_same_results_as_hash_join(self):
+        write_csv(self.get_path('input.csv'), [['id', 'key']] + [[str(i), str(i * 7 % 320).zfill(3)] for i in range(500)])
+        for line_separator in ['\n', '\r\n']:
+            self.write_sorted_join_table('sorted.csv', line_separator)
+            query_text = 'SELECT a.id, b.name LEFT JOIN sorted.csv ON a.key == b.key'
+            expected_output, expected_warnings = self.run_rfc_query(query_text, 'expected.csv')
+            output, warnings = self.run_rfc_query(query_text + ' WITH (binarysearch)', 'output.csv')
+            self.assertEqual(expected_output, output)
+            self.assertEqual(expected_warnings, warnings)
+            self.assertIn('multi\nline, quoted', output)
+
+    def test_cached_offset_index(self):
+        write_csv(self.get_path('input.csv'), [['id', 'key']] + [[str(i), str(i * 7 % 320).zfill(3)] for i in range(500)])
+        self.write_sorted_join_table('sorted.csv', '\n')
+        query_text = 'SELECT a.id, b.name JOIN sorted.csv ON a.key == b.key'
+        expected_output, _warnings = self.run_rfc_query(query_text, 'expected.csv')
+        cache_dir = self.get_path('cache')
+        for i in range(2):
+            output, warnings = self.run_rfc_query(query_text + ' WITH (binarysearch)', 'output.csv', join_cache_dir=cache_dir)
+            self.assertEqual(expected_output, output)
+            self.assertEqual(i > 0, any('was loaded from the cache in' in w for w in warnings))
+        # Hash join must not reuse the offset index of the same table
+        output, warnings = self.run_rfc_query(query_text, 'output.csv', join_cache_dir=cache_dir)
+        self.assertEqual(expected_output, output)
+        self.assertTrue(any('was built from the table' in w for w in warnings))
+
+
+class TestInputTableHashJoin(CSVQueryTestCase):
+    def test_hash_map_is_built_on_small_input_table(self):
+        self.make_join_tables(num_records=5000, num_keys=20000)
+        write_csv(self.get_path('small.csv'), [['id', 'key']] + [[str(i), str(i * 37)] for i in range(30)])
+        for query_text in ['SELECT a.id, b.name JOIN dim.csv ON a.key == b.key', 'SELECT a.id, b.name LEFT JOIN dim.csv ON a.key == b.key']:
+            output, warnings = self.run_query(query_text, 'small.csv', 'output.csv')
+            self.assertTrue(any('built on the input table' in w for w in warnings))
+            saved_size_ratio = self.patch_attribute(rbql_engine, 'join_build_side_size_ratio', 1000000)
+            expected_output, expected_warnings = self.run_query(query_text, 'small.csv', 'expected.csv')
+            rbql_engine.join_build_side_size_ratio = saved_size_ratio
+            self.assertFalse(any('built on the input table' in w for w in expected_warnings))
+            self.assertEqual(expected_output, output)
+        # Big input table and small join table
+        _output, warnings = self.run_query('SELECT a.id, b.key JOIN small.csv ON a.key == b.key', 'input.csv', 'output.csv')
+        self.assertFalse(any('built on the input table' in w for w in warnings))
+
+
+class TestDbmJoin(CSVQueryTestCase):
+    def get_data_lines(self, output):
+        return output.splitlines()[1:]
+
+    def get_dbm_table_name(self, name):
+        # dbm.dumb creates "name.dat" and "name.dir" files, dbm.ndbm creates "name.db", dbm.gnu and dbm.sqlite3 create a single "name" file
+        for file_name in [name, name + '.db', name + '.dat']:
+            if os.path.exists(self.get_path(file_name)):
+                return file_name
+        self.fail('Unable to find files of "{}" dbm database'.format(name))
+
+    def check_same_results_as_csv_join_table(self, dbm_module):
+        self.make_join_tables()
+        db = dbm_module.open(self.get_path('lookup'), 'c')
+        for line in read_file(self.get_path('dim.csv')).splitlines()[1:]:
+            key, name = line.split(',')
+            db[key] = name
+        db.close()
+        table_name = self.get_dbm_table_name('lookup')
+        for join_type in ['JOIN', 'LEFT JOIN']:
+            expected_output, _warnings = self.run_query('SELECT a.id, b.name {} dim.csv ON a.key == b.key'.format(join_type), 'input.csv', 'expected.csv')
+            output, _warnings = self.run_query('SELECT a.id, b.value {} {} ON a.key == b.key'.format(join_type, table_name), 'input.csv', 'output.csv')
+            self.assertEqual(self.get_data_lines(expected_output), self.get_data_lines(output))
+        # Joins on other fields read the whole store
+        output, _warnings = self.run_query('SELECT a.id, b.key JOIN {} ON a.key == b.value'.format(table_name), 'input.csv', 'output.csv')
+        self.assertEqual([], self.get_data_lines(output))
+
+    def test_same_results_as_csv_join_table(self):
+        import dbm
+        self.check_same_results_as_csv_join_table(dbm)
+
+    def test_dumb_dbm_files(self):
+        import dbm.dumb
+        self.check_same_results_as_csv_join_table(dbm.dumb)
+
+    def test_keys_are_read_one_by_one(self):
+        class NoKeysListDb(dict):
+            def keys(self):
+                raise AssertionError('Keys must not be loaded into memory')
+        record_iterator = rbql_dbm.DbmRecordIterator(NoKeysListDb([(b'k1', b'v1'), (b'k2', b'v2')]), 'utf-8')
+        self.assertEqual([['k1', 'v1'], ['k2', 'v2'], None], [record_iterator.get_record() for _ in range(3)])
+
+    def test_shelve_values_are_unpacked(self):
+        import shelve
+        write_csv(self.get_path('input.csv'), [['id', 'key'], ['1', 'k1'], ['2', 'k2'], ['3', 'k3']])
+        store = shelve.open(self.get_path('store'))
+        store['k1'] = ['x', 10]
+        store['k3'] = 'y'
+        store.close()
+        output, _warnings = self.run_query('SELECT a1, b2, b3 LEFT JOIN {} ON a2 == b1 WITH (shelve)'.format(self.get_dbm_table_name('store')), 'input.csv', 'output.csv', with_headers=False)
+        self.assertEqual(['id,,', '1,x,10', '2,,', '3,y,'], output.splitlines())
+
+    def test_values_are_not_unpickled_without_shelve_modifier(self):
+        import dbm
+        import pickle
+        write_csv(self.get_path('input.csv'), [['k1'], ['k2']])
+        db = dbm.open(self.get_path('lookup'), 'c')
+        db[b'k1'] = pickle.dumps('x', protocol=2)
+        db[b'k2'] = b'\x80 text'
+        db.close()
+        warnings = []
+        rbql_csv.query_csv('SELECT b2 JOIN {} ON a1 == b1'.format(self.get_dbm_table_name('lookup')), self.get_path('input.csv'), ',', 'quoted', self.get_path('output.csv'), ',', 'quoted', 'latin-1', warnings, False)
+        with open(self.get_path('output.csv'), 'rb') as src:
+            output_lines = src.read().splitlines()
+        self.assertEqual([pickle.dumps('x', protocol=2), b'\x80 text'], output_lines)
+
+
+class ParallelQueryTestCase(CSVQueryTestCase):
+    # Records whether queries were actually executed in parallel
+    def setUp(self):
+        super(ParallelQueryTestCase, self).setUp()
+        self.parallel_results = []
+        self.spy_function(rbql_engine, 'run_parallel_query', lambda result, *_args: self.parallel_results.append(result))
+
+    def check_same_as_serial(self, query_text, input_name, expect_parallel=True, with_headers=True):
+        expected_output, expected_warnings = self.run_query(query_text, input_name, 'expected.csv', with_headers)
+        self.assertEqual([], self.parallel_results)
+        output, warnings = self.run_query(query_text, input_name, 'output.csv', with_headers, parallel_workers=3)
+        self.assertEqual(expected_output, output)
+        self.assertEqual(expected_warnings, warnings)
+        self.assertEqual([expect_parallel], self.parallel_results)
+        self.parallel_results = []
+
+
+class TestParallelSort(ParallelQueryTestCase):
+    def make_input_table(self, name='input.csv'):
+        rng = random.Random(45)
+        table = [['id', 'key', 'val']] + [[str(i), str(rng.randint(0, 50)), rng.choice(['x', 'y', u'é'])] for i in range(3000)]
+        table[1500] = ['1500', '7', 'x', 'extra'] # Inconsistent number of fields
+        write_csv(self.get_path(name), table)
+
+    def test_same_results_as_serial(self):
+        self.make_input_table()
+        for query_text in ['SELECT a.id, a.key ORDER BY int(a.key)', 'SELECT a.id, a.val ORDER BY a.val DESC', 'SELECT TOP 20 a.id ORDER BY -int(a.key), a.val', 'SELECT DISTINCT a.key ORDER BY int(a.key)', 'SELECT a.id WHERE a.val == "x" ORDER BY a.key']:
+            self.check_same_as_serial(query_text, 'input.csv')
+        self.check_same_as_serial('SELECT a1, a2 ORDER BY a2', 'input.csv', with_headers=False)
+
+    def test_crlf_and_bom(self):
+        self.make_input_table()
+        with open(self.get_path('input.csv'), 'rb') as src:
+            data = src.read()
+        with open(self.get_path('crlf.csv'), 'wb') as dst:
+            dst.write(b'\xef\xbb\xbf' + data.replace(b'\n', b'\r\n'))
+        self.check_same_as_serial('SELECT a.id, a.val ORDER BY a.val, int(a.key) DESC', 'crlf.csv')
+
+    def test_serial_queries(self):
+        self.make_input_table()
+        for query_text in ['SELECT NR, a.id ORDER BY a.key', 'SELECT a.key, COUNT(*) GROUP BY a.key', 'SELECT * WHERE a.key == "5" |> SELECT * ORDER BY a.id']:
+            expected_output, _warnings = self.run_query(query_text, 'input.csv', 'expected.csv')
+            output, _warnings = self.run_query(query_text, 'input.csv', 'output.csv', parallel_workers=3)
+            self.assertEqual(expected_output, output)
+        self.assertNotIn(True, self.parallel_results)
+
+    def test_errors_are_reported_as_in_serial_mode(self):
+        self.make_input_table()
+        query_text = 'SELECT a.id ORDER BY int(a.val)'
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as expected_cm:
+            self.run_query(query_text, 'input.csv', 'expected.csv')
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            self.run_query(query_text, 'input.csv', 'output.csv', parallel_workers=3)
+        self.assertEqual(str(expected_cm.exception), str(cm.exception))
+
+
+class TestParallelJoin(ParallelQueryTestCase):
+    def test_same_results_as_serial(self):
+        self.make_join_tables(num_records=3000)
+        for query_text in ['SELECT a.id, b.name JOIN dim.csv ON a.key == b.key', 'SELECT a.*, b.name, bNR LEFT JOIN dim.csv ON a.key == b.key', 'SELECT a.id, b.name INNER JOIN dim.csv ON a.key == b.key WHERE int(a.val) > 50', 'SELECT a.id JOIN dim.csv ON a.key == b.key AND a.val == b.key']:
+            self.check_same_as_serial(query_text, 'input.csv')
+
+    def test_strict_left_join(self):
+        write_csv(self.get_path('input.csv'), [['id', 'key']] + [[str(i), str(i % 50)] for i in range(1000)])
+        write_csv(self.get_path('dim.csv'), [['key', 'name']] + [[str(k), 'name_{}'.format(k)] for k in range(60)])
+        self.check_same_as_serial('SELECT a.id, b.name STRICT LEFT JOIN dim.csv ON a.key == b.key', 'input.csv')
+        write_csv(self.get_path('dim.csv'), [['key', 'name']] + [[str(k), 'name_{}'.format(k)] for k in range(40)])
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as expected_cm:
+            self.run_query('SELECT a.id, b.name STRICT LEFT JOIN dim.csv ON a.key == b.key', 'input.csv', 'expected.csv')
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            self.run_query('SELECT a.id, b.name STRICT LEFT JOIN dim.csv ON a.key == b.key', 'input.csv', 'output.csv', parallel_workers=3)
+        self.assertEqual(str(expected_cm.exception), str(cm.exception))
+
+    def test_inconsistent_records(self):
+        self.make_join_tables(num_records=3000)
+        with open(self.get_path('input.csv'), 'a', encoding='utf-8') as dst:
+            dst.write('3000,5,1,extra\n3001\n')
+        with open(self.get_path('dim.csv'), 'a', encoding='utf-8') as dst:
+            dst.write('4,name_4,extra\n')
+        # Missing join key fields are reported like in serial mode
+        query_text = 'SELECT a.id, b.name LEFT JOIN dim.csv ON a.key == b.key'
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as expected_cm:
+            self.run_query(query_text, 'input.csv', 'expected.csv')
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            self.run_query(query_text, 'input.csv', 'output.csv', parallel_workers=3)
+        self.assertEqual(str(expected_cm.exception), str(cm.exception))
+        with open(self.get_path('input.csv'), encoding='utf-8') as src:
+            lines = src.readlines()
+        with open(self.get_path('input.csv'), 'w', encoding='utf-8') as dst:
+            dst.writelines(lines[:-1])
+        self.parallel_results = []
+        self.check_same_as_serial(query_text, 'input.csv')
+
+    def test_serial_queries(self):
+        self.make_join_tables(num_records=3000)
+        for query_text in ['SELECT TOP 10 a.id, b.name JOIN dim.csv ON a.key == b.key', 'SELECT a.id, b.name JOIN dim.csv ON a.key == b.key ORDER BY b.name', 'SELECT a.id, b.name JOIN dim.csv ON NR == b.key']:
+            expected_output, _warnings = self.run_query(query_text, 'input.csv', 'expected.csv')
+            output, _warnings = self.run_query(query_text, 'input.csv', 'output.csv', parallel_workers=3)
+            self.assertEqual(expected_output, output)
+        self.assertNotIn(True, self.parallel_results)
+
+
+class TestThreadBackend(ParallelQueryTestCase):
+    def setUp(self):
+        super(TestThreadBackend, self).setUp()
+        self.patch_attribute(rbql_engine, 'parallel_backend', 'threads')
+        self.executors = []
+        self.saved_make_parallel_executor = self.spy_function(rbql_engine, 'make_parallel_executor', lambda executor, *_args: self.executors.append(executor))
+
+    def test_same_results_as_serial(self):
+        self.make_join_tables(num_records=3000)
+        for query_text in ['SELECT a.id, a.val ORDER BY int(a.val) DESC', 'SELECT TOP 30 a.id ORDER BY a.key', 'SELECT a.id, b.name LEFT JOIN dim.csv ON a.key == b.key', 'SELECT a.*, bNR JOIN dim.csv ON a.key == b.key']:
+            self.check_same_as_serial(query_text, 'input.csv')
+        self.assertTrue(all(executor.use_threads and executor.work_dir is None for executor in self.executors))
+
+    def test_backend_detection(self):
+        self.assertTrue(rbql_engine.use_thread_workers())
+        rbql_engine.parallel_backend = 'processes'
+        self.assertFalse(rbql_engine.use_thread_workers())
+        # User namespace can only be shared with thread workers
+        self.assertIsNone(self.saved_make_parallel_executor(2, {'x': 1}))
+        rbql_engine.parallel_backend = None
+        is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+        self.assertEqual(is_gil_enabled is not None and not is_gil_enabled(), rbql_engine.use_thread_workers())
+
+    def test_user_namespace(self):
+        write_csv(self.get_path('input.csv'), [['id', 'val']] + [[str(i), str(i * 37 % 101)] for i in range(2000)])
+        def run_engine_query(parallel_workers):
+            input_stream = open(self.get_path('input.csv'), 'rb')
+            try:
+                input_iterator = rbql_csv.CSVRecordIterator(input_stream, 'utf-8', ',', 'quoted', has_header=True)
+                output_table = []
+                # User namespace is available in queries as `udf`, see rbql_ipython.AttrDict
+                user_namespace = argparse.Namespace(shift=lambda v: int(v) + 1000)
+                rbql_engine.query('SELECT a.id, udf.shift(a.val) ORDER BY udf.shift(a.val)', input_iterator, rbql_engine.TableWriter(output_table), [], user_namespace=user_namespace, parallel_workers=parallel_workers)
+                return output_table
+            finally:
+                input_stream.close()
+        expected_table = run_engine_query(None)
+        self.assertEqual(expected_table, run_engine_query(3))
+        self.assertEqual([True], self.parallel_results)
+
+
+class TestMultiFileInput(CSVQueryTestCase):
+    def setUp(self):
+        super(TestMultiFileInput, self).setUp()
+        self.file_readers = []
+        self.spy_function(rbql_csv, 'InputFileReader', lambda file_reader, *_args: self.file_readers.append(file_reader))
+
+    def make_partitioned_tables(self, dates, num_parts=2, num_records=50):
+        # Writes parts/date=<date>/part-<i>.csv files and a single concatenated table with the date field for comparison
+        rng = random.Random(len(self.id()))
+        concatenated = [['id', 'val', 'date']]
+        for date in dates:
+            os.makedirs(self.get_path(os.path.join('parts', 'date={}'.format(date))))
+            for part in range(num_parts):
+                records = [[str(len(concatenated) + i), str(rng.randint(0, 100))] for i in range(num_records)]
+                write_csv(self.get_path(os.path.join('parts', 'date={}'.format(date), 'part-{}.csv'.format(part))), [['id', 'val']] + records)
+                concatenated += [record + [date] for record in records]
+        write_csv(self.get_path('concatenated.csv'), concatenated)
+
+    def run_with_timeout(self, target, timeout=30):
+        result = []
+        worker = threading.Thread(target=lambda: result.append(target()))
+        worker.daemon = True
+        worker.start()
+        worker.join(timeout)
+        self.assertFalse(worker.is_alive(), 'The query has not finished in {} seconds'.format(timeout))
+        return result[0]
+
+    def check_readers_are_closed(self):
+        self.assertTrue(len(self.file_readers))
+        for file_reader in self.file_readers:
+            self.assertFalse(file_reader.thread.is_alive())
+
+    def test_same_results_as_concatenated_table(self):
+        self.make_partitioned_tables(['2020-01-01', '2020-01-02', '2020-01-03'])
+        for query_text in ['SELECT *', 'SELECT a.date, COUNT(*), SUM(int(a.val)) GROUP BY a.date', 'SELECT a.id, a.date WHERE int(a.val) > 50 ORDER BY int(a.val), NR']:
+            expected, expected_warnings = self.run_query(query_text, 'concatenated.csv', 'expected.csv')
+            actual, warnings = self.run_query(query_text, os.path.join('parts', 'date=*', 'part-*.csv'), 'actual.csv')
+            self.assertEqual(expected, actual)
+            self.assertEqual(expected_warnings, warnings)
+        self.check_readers_are_closed()
+
+    def test_files_are_pruned_by_path_keys(self):
+        self.make_partitioned_tables(['2020-01-01', '2020-01-02', '2020-01-03', '2020-01-04'])
+        query_text = 'SELECT a.id, a.val, a.date WHERE a.date >= "2020-01-03" and int(a.val) < 70'
+        expected, _warnings = self.run_query(query_text, 'concatenated.csv', 'expected.csv')
+        actual, warnings = self.run_query(query_text, os.path.join('parts', 'date=*', 'part-*.csv'), 'actual.csv')
+        self.assertEqual(expected, actual)
+        self.assertEqual(["4 of 8 input files were skipped because their path keys don't satisfy WHERE conditions"], warnings)
+        self.assertEqual(4, len(self.file_readers))
+        self.assertTrue(all(file_reader.key_values[0] >= '2020-01-03' for file_reader in self.file_readers))
+
+    def test_early_top(self):
+        self.make_partitioned_tables(['2020-01-{:02}'.format(day) for day in range(1, 21)], num_parts=3, num_records=3000)
+        query_text = 'SELECT TOP 5 a.id, a.date WHERE int(a.val) > 10'
+        expected, _warnings = self.run_query(query_text, 'concatenated.csv', 'expected.csv')
+        actual, warnings = self.run_with_timeout(lambda: self.run_query(query_text, os.path.join('parts', 'date=*', 'part-*.csv'), 'actual.csv'))
+        self.assertEqual(expected, actual)
+        self.assertEqual([], warnings)
+        # Only the first prefetched files are opened and their reader threads are stopped even though they haven't finished reading
+        self.assertLessEqual(len(self.file_readers), rbql_csv.multi_file_prefetch_count + 1)
+        self.check_readers_are_closed()
+
+    def test_no_headers(self):
+        os.makedirs(self.get_path(os.path.join('parts', 'date=2020-01-01')))
+        write_csv(self.get_path(os.path.join('parts', 'date=2020-01-01', 'part-0.csv')), [['1', 'x'], ['2', 'y']])
+        write_csv(self.get_path(os.path.join('parts', 'date=2020-01-01', 'part-1.csv')), [['3', 'z']])
+        output, warnings = self.run_query('SELECT NR, *', os.path.join('parts', '*', 'part-*.csv'), 'output.csv', with_headers=False)
+        # Path keys are only available as named fields in header mode
+        self.assertEqual('1,1,x\n2,2,y\n3,3,z\n', output)
+        self.assertEqual([], warnings)
+
+    def test_header_mismatch_and_inconsistent_records(self):
+        write_csv(self.get_path('part-0.csv'), [['id', 'val'], ['1', 'x'], ['2', 'y']])
+        write_csv(self.get_path('part-1.csv'), [['id', 'value'], ['3', 'z', 'extra']])
+        output, warnings = self.run_query('SELECT NR, a.id, a.val', 'part-*.csv', 'output.csv')
+        self.assertEqual('NR,id,val\n1,1,x\n2,2,y\n3,3,z\n', output)
+        self.assertEqual(2, len(warnings))
+        self.assertEqual('Header of "{}" file is different from the header of "{}" file'.format(self.get_path('part-1.csv'), self.get_path('part-0.csv')), warnings[0])
+        self.assertIn('Number of fields in "input" table is not consistent', warnings[1])
+        self.check_readers_are_closed()
+
+    def test_no_matching_files(self):
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+            self.run_query('SELECT *', 'missing-*.csv', 'output.csv')
+
+
+class TestBatchQuery(CSVQueryTestCase):
+    query_text = 'SELECT a.id, int(a.val) * 2 WHERE a.id != "3"'
+
+    def setUp(self):
+        super(TestBatchQuery, self).setUp()
+        self.save_attribute(rbql_engine, 'parallel_backend')
+        os.makedirs(self.get_path(os.path.join('data', 'sub')))
+        write_csv(self.get_path(os.path.join('data', 'a.csv')), [['id', 'val'], ['1', '10'], ['2', '20'], ['3', '30']])
+        write_csv(self.get_path(os.path.join('data', 'sub', 'b.csv')), [['val', 'id'], ['40', '4'], ['50', '5', 'extra']])
+        write_csv(self.get_path(os.path.join('data', 'c.csv')), [['id', 'val'], ['6', '60'], ['7', 'bad']])
+
+    def run_batch(self, input_paths, num_workers):
+        output_dir = self.get_path('output_{}'.format(num_workers))
+        return rbql_csv.query_csv_batch(self.query_text, [self.get_path(p) for p in input_paths], output_dir, ',', 'quoted', ',', 'quoted', 'utf-8', True, num_workers=num_workers)
+
+    def check_same_as_single_queries(self, results):
+        self.assertEqual([self.get_path(os.path.join('data', name)) for name in ['a.csv', 'c.csv', os.path.join('sub', 'b.csv')]], [result.input_path for result in results])
+        for result in results:
+            self.assertTrue(result.output_path.startswith(self.get_path('output_')))
+            input_name = os.path.relpath(result.input_path, self.tmp_dir)
+            try:
+                expected, expected_warnings = self.run_query(self.query_text, input_name, 'expected.csv')
+            except Exception as e:
+                expected_error_type, expected_error_msg = rbql_engine.exception_to_error_info(e)
+                self.assertEqual((expected_error_type, expected_error_msg), (result.error_type, result.error_msg))
+                # Output directory contains only complete results
+                self.assertFalse(os.path.exists(result.output_path))
+                continue
+            self.assertIsNone(result.error_type)
+            self.assertEqual(expected, read_file(result.output_path))
+            self.assertEqual(expected_warnings, result.warnings)
+
+    def test_serial(self):
+        results = self.run_batch([os.path.join('data', '*.csv'), os.path.join('data', 'sub', '*.csv'), os.path.join('data', 'a.csv')], num_workers=1)
+        self.assertEqual(3, len(results))
+        self.assertEqual(self.get_path(os.path.join('output_1', 'sub', 'b.csv')), results[2].output_path)
+        self.assertEqual('query execution', results[1].error_type)
+        self.assertEqual(1, len(results[2].warnings))
+        self.check_same_as_single_queries(results)
+
+    def test_thread_workers(self):
+        rbql_engine.parallel_backend = 'threads'
+        self.check_same_as_single_queries(self.run_batch([os.path.join('data', '*.csv'), os.path.join('data', 'sub', 'b.csv')], num_workers=2))
+
+    def test_process_workers(self):
+        rbql_engine.parallel_backend = 'processes'
+        self.check_same_as_single_queries(self.run_batch([os.path.join('data', '*.csv'), os.path.join('data', 'sub', 'b.csv')], num_workers=2))
+
+    def test_main_loop_is_compiled_once_per_header(self):
+        rbql_engine.compiled_main_loop_cache.clear()
+        for i in range(5):
+            write_csv(self.get_path(os.path.join('data', 'sub', 'same_{}.csv'.format(i))), [['val', 'id'], [str(i), str(i)]])
+        self.run_batch([os.path.join('data', 'a.csv'), os.path.join('data', 'sub', '*.csv')], num_workers=1)
+        # a.csv and files with the (val, id) header need different field indices
+        self.assertEqual(2, len(rbql_engine.compiled_main_loop_cache))
+
+    def test_no_matching_files(self):
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+            self.run_batch([os.path.join('data', 'missing_*.csv')], num_workers=1)
+
+
+class TestMultipleQueries(CSVQueryTestCase):
+    def run_multiple(self, query_texts, input_name, with_headers=True):
+        output_paths = [self.get_path('output_{}.csv'.format(i)) for i in range(len(query_texts))]
+        warnings_list = [[] for _ in query_texts]
+        errors = rbql_csv.query_csv_multiple(query_texts, self.get_path(input_name), ',', 'quoted', output_paths, ',', 'quoted', 'utf-8', warnings_list, with_headers)
+        return errors, output_paths, warnings_list
+
+    def check_same_as_separate_queries(self, query_texts, input_name, with_headers=True):
+        errors, output_paths, warnings_list = self.run_multiple(query_texts, input_name, with_headers)
+        for query_text, error, output_path, warnings in zip(query_texts, errors, output_paths, warnings_list):
+            try:
+                expected, expected_warnings = self.run_query(query_text, input_name, 'expected.csv', with_headers)
+            except Exception as e:
+                self.assertEqual(rbql_engine.exception_to_error_info(e), rbql_engine.exception_to_error_info(error))
+                # Output files of failed queries are removed
+                self.assertFalse(os.path.exists(output_path))
+                continue
+            self.assertIsNone(error, query_text)
+            self.assertEqual(expected, read_file(output_path), query_text)
+            self.assertEqual(expected_warnings, warnings, query_text)
+        return errors
+
+    def test_same_results_as_separate_queries(self):
+        self.make_join_tables()
+        query_texts = [
+            'SELECT a.key, COUNT(*) GROUP BY a.key',
+            'SELECT TOP 10 a.id, b.name JOIN dim.csv ON a.key == b.key',
+            'SELECT a.id, a.val WHERE int(a.val) > 90 ORDER BY int(a.val), NR',
+            'UPDATE SET a.val = "0" WHERE a.key == "1"',
+            'SELECT TOP 1 *',
+        ]
+        errors = self.check_same_as_separate_queries(query_texts, 'input.csv')
+        self.assertEqual([None] * len(query_texts), errors)
+
+    def test_errors_and_warnings(self):
+        write_csv(self.get_path('input.csv'), [['id', 'val'], ['1', '10'], ['2'], ['3', 'x'], ['4', '40']])
+        query_texts = ['SELECT a.id, a.val', 'SELECT a.id, int(a.val) * 2', 'SELECT TOP 1 a.id', 'SELECT a.id JOIN missing.csv ON a.id == b1', 'SELECT COUNT(*)']
+        errors = self.check_same_as_separate_queries(query_texts, 'input.csv')
+        self.assertEqual([None, None, None], [errors[0], errors[2], errors[4]])
+        self.assertIsInstance(errors[1], rbql_engine.RbqlRuntimeError)
+        self.assertIsInstance(errors[3], rbql_engine.RbqlIOHandlingError)
+
+    def test_glob_input(self):
+        write_csv(self.get_path('part-0.csv'), [['1', 'a'], ['2', 'b']])
+        write_csv(self.get_path('part-1.csv'), [['3', 'c']])
+        query_texts = ['SELECT NR, a2', 'SELECT TOP 1 a1', 'SELECT COUNT(*)']
+        errors = self.check_same_as_separate_queries(query_texts, 'part-*.csv', with_headers=False)
+        self.assertEqual([None, None, None], errors)
+        self.assertEqual('1,a\n2,b\n3,c\n', read_file(self.get_path('output_0.csv')))
+
+    def test_output_paths_must_match_queries(self):
+        write_csv(self.get_path('input.csv'), [['1']])
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+            rbql_csv.query_csv_multiple(['SELECT *', 'SELECT a1'], self.get_path('input.csv'), ',', 'quoted', [self.get_path('output.csv')], ',', 'quoted', 'utf-8', [[], []], False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1006 @@
+import os
+import sys
+import random
+import unittest
+import threading
+import subprocess
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..'))
+
+from rbql import rbql_engine
+from rbql_test_utils import PatchingTestCase, JoinMapSpyTestCase
+
+# Run tests: `python3 -m unittest discover -s rbql_core/test` or `python3 -m pytest rbql_core/test`
+# The engine must stay python2 compatible, python2 tests use the interpreter from RBQL_PYTHON2 environment variable or `python2` from PATH and are skipped if neither is available.
+
+
+def run_table_query(query_text, input_table, join_table=None, input_column_names=None, join_column_names=None):
+    output_table = []
+    warnings = []
+    output_column_names = []
+    rbql_engine.query_table(query_text, input_table, output_table, warnings, join_table, input_column_names, join_column_names, output_column_names)
+    return output_table, warnings
+
+
+def find_python2():
+    for candidate in [os.environ.get('RBQL_PYTHON2'), 'python2', 'python2.7']:
+        if not candidate:
+            continue
+        try:
+            version = subprocess.check_output([candidate, '-c', 'import sys; print(sys.version_info[0])'], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        if version.strip() == b'2':
+            return candidate
+    return None
+
+
+python2_path = find_python2()
+
+# Loads the engine without executing rbql/__init__.py which imports python3-only modules.
+python2_prologue = '''
+import sys, types
+rbql_package = types.ModuleType('rbql')
+rbql_package.__path__ = [{rbql_dir!r}]
+sys.modules['rbql'] = rbql_package
+from rbql import rbql_engine
+def run_table_query(query_text, input_table, join_table=None):
+    output_table = []
+    rbql_engine.query_table(query_text, input_table, output_table, [], join_table)
+    return output_table
+'''
+
+
+def run_python2_snippet(snippet):
+    # Returns stdout of the snippet executed by python2 after `python2_prologue`
+    code = python2_prologue.format(rbql_dir=os.path.join(script_dir, '..', 'rbql')) + snippet
+    return subprocess.check_output([python2_path, '-c', code]).decode('utf-8').strip()
+
+
+class TestMedianAndPercentile(PatchingTestCase):
+    def setUp(self):
+        self.save_attribute(rbql_engine, 'values_spill_threshold')
+
+    def make_table(self):
+        rng = random.Random(26)
+        return [[rng.choice('abc'), str(rng.randint(-50, 50)), str(rng.randint(0, 1000) / 8.0)] for _ in range(2000)]
+
+    def expected_percentile(self, values, percentile):
+        values = sorted(values)
+        rank = (len(values) - 1) * percentile / 100.0
+        lower_rank = int(rank)
+        a = values[lower_rank]
+        if lower_rank == rank or values[lower_rank + 1] == a:
+            return a
+        return a + (values[lower_rank + 1] - a) * (rank - lower_rank)
+
+    def test_median_and_percentile(self):
+        table = self.make_table()
+        output_table, _warnings = run_table_query('SELECT a1, MEDIAN(a2), PERCENTILE(a3, 90), PERCENTILE(a2, 0), PERCENTILE(a2, 100) GROUP BY a1', table)
+        for key, median, p90, p0, p100 in output_table:
+            int_values = [int(r[1]) for r in table if r[0] == key]
+            float_values = [float(r[2]) for r in table if r[0] == key]
+            self.assertEqual(self.expected_percentile(int_values, 50), median)
+            self.assertAlmostEqual(self.expected_percentile(float_values, 90), p90)
+            self.assertEqual(min(int_values), p0)
+            self.assertEqual(max(int_values), p100)
+
+    def test_spilled_groups_give_same_results(self):
+        table = self.make_table()
+        query_text = 'SELECT a1, MEDIAN(a2), MEDIAN(a3), PERCENTILE(a3, 37) GROUP BY a1'
+        expected_table, _warnings = run_table_query(query_text, table)
+        rbql_engine.values_spill_threshold = 7
+        output_table, _warnings = run_table_query(query_text, table)
+        self.assertEqual(expected_table, output_table)
+
+    def test_spilled_group_with_mixed_int_and_float_values(self):
+        table = [[str(v)] for v in range(100)] + [['0.5'], ['99.5']] + [[str(v)] for v in range(100, 150)]
+        expected_table, _warnings = run_table_query('SELECT MEDIAN(a1), PERCENTILE(a1, 10)', table)
+        rbql_engine.values_spill_threshold = 10
+        output_table, _warnings = run_table_query('SELECT MEDIAN(a1), PERCENTILE(a1, 10)', table)
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual([[74.5, 14.1]], [[round(v, 6) for v in output_table[0]]])
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT MEDIAN(a1), PERCENTILE(a1, 25)", [[1], [2], [3], [4], [5]]))')
+        self.assertEqual('[[3, 2]]', output)
+
+
+class TestApproxPercentile(unittest.TestCase):
+    def get_rank_error(self, values, estimate, percentile):
+        # Distance from the requested rank to the closest rank of the estimate
+        values = sorted(values)
+        target_rank = len(values) * percentile / 100.0
+        lower_rank = sum(1 for v in values if v < estimate)
+        upper_rank = sum(1 for v in values if v <= estimate)
+        return max(0, lower_rank - target_rank, target_rank - upper_rank)
+
+    def test_estimate_is_close_to_exact_rank(self):
+        rng = random.Random(27)
+        table = [[str(i % 2), str(rng.randint(0, 1000000))] for i in range(40000)]
+        output_table, _warnings = run_table_query('SELECT a1, APPROX_PERCENTILE(a2, 10), APPROX_PERCENTILE(a2, 50), APPROX_PERCENTILE(a2, 99) GROUP BY a1', table)
+        self.assertEqual(2, len(output_table))
+        for record in output_table:
+            values = [int(r[1]) for r in table if r[0] == record[0]]
+            for estimate, percentile in zip(record[1:], [10, 50, 99]):
+                self.assertLess(self.get_rank_error(values, estimate, percentile), len(values) * 0.02)
+
+    def test_small_groups_are_exact(self):
+        table = [[str(v)] for v in [5, 1, 4, 2, 3]]
+        output_table, _warnings = run_table_query('SELECT APPROX_PERCENTILE(a1, 0), APPROX_PERCENTILE(a1, 50), APPROX_PERCENTILE(a1, 100)', table)
+        self.assertEqual([[1, 3, 5]], output_table)
+
+    def test_sketches_are_mergeable(self):
+        rng = random.Random(27)
+        first, second = [rbql_engine.KLLSketch(200) for _ in range(2)]
+        values = [rng.random() for _ in range(20000)]
+        for i, value in enumerate(values):
+            (first if i % 2 else second).update(value)
+        first.merge(second)
+        self.assertLess(self.get_rank_error(values, first.get_quantile(0.5), 50), len(values) * 0.02)
+        self.assertLess(sum(len(level) for level in first.compactors), 3 * 200)
+
+    def test_invalid_percentile(self):
+        with self.assertRaises(rbql_engine.RbqlParsingError):
+            run_table_query('SELECT APPROX_PERCENTILE(a1, 101)', [['1']])
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT APPROX_PERCENTILE(a1, 50)", [[str(v)] for v in range(1, 100000)]))')
+        self.assertLess(abs(int(output.strip('[]')) - 50000), 2000)
+
+
+class TestApproxCountDistinct(unittest.TestCase):
+    def test_estimate_is_close_to_exact_count(self):
+        rng = random.Random(28)
+        table = [[str(i % 3), str(rng.randint(0, 30000))] for i in range(60000)]
+        output_table, _warnings = run_table_query('SELECT a1, APPROX_COUNT_DISTINCT(a2) GROUP BY a1', table)
+        for key, estimate in output_table:
+            exact_count = len(set(r[1] for r in table if r[0] == key))
+            # Standard error with the default precision is ~0.8%
+            self.assertLess(abs(estimate - exact_count), exact_count * 0.04)
+
+    def test_small_counts_are_exact(self):
+        output_table, _warnings = run_table_query('SELECT APPROX_COUNT_DISTINCT(a1)', [['x'], ['y'], ['x'], ['z'], [u'é']])
+        self.assertEqual([[4]], output_table)
+
+    def test_sketches_are_mergeable(self):
+        first, second, combined = [rbql_engine.HyperLogLogSketch(12) for _ in range(3)]
+        for i in range(5000):
+            (first if i % 2 else second).update(str(i))
+            combined.update(str(i))
+        first.merge(second)
+        self.assertEqual(combined.get_estimate(), first.get_estimate())
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT APPROX_COUNT_DISTINCT(a1)", [["x"], [u"\\u00e9"], ["x"], [1], [u"y"]]))')
+        self.assertEqual('[[4]]', output)
+
+
+class TestTopK(unittest.TestCase):
+    def make_skewed_table(self, num_records, num_rare_values):
+        # Values 'h0'...'h4' are heavy hitters with clearly different frequencies, the other values are rare
+        rng = random.Random(29)
+        table = []
+        for i in range(num_records):
+            if rng.random() < 0.5:
+                table.append([str(i % 2), 'h{}'.format(min(int(rng.expovariate(0.7)), 4))])
+            else:
+                table.append([str(i % 2), 'r{}'.format(rng.randint(0, num_rare_values))])
+        return table
+
+    def expected_top(self, values, num_items):
+        counts = dict()
+        order = []
+        for value in values:
+            if value not in counts:
+                counts[value] = 0
+                order.append(value)
+            counts[value] += 1
+        return [(value, counts[value]) for value in sorted(order, key=lambda v: -counts[v])[:num_items]]
+
+    def test_exact_when_summary_has_enough_counters(self):
+        table = self.make_skewed_table(5000, 20)
+        output_table, warnings = run_table_query('SELECT a1, TOP_K(a2, 5) GROUP BY a1', table)
+        for key, top_values in output_table:
+            self.assertEqual([value for value, _count in self.expected_top([r[1] for r in table if r[0] == key], 5)], top_values)
+        self.assertEqual([], warnings)
+
+    def test_heavy_hitters_with_many_rare_values(self):
+        table = self.make_skewed_table(40000, 100000)
+        output_table, warnings = run_table_query('SELECT TOP_K(a2, 3)', table)
+        self.assertEqual([[[value for value, _count in self.expected_top([r[1] for r in table], 3)]]], output_table)
+        self.assertEqual(1, len(warnings))
+        self.assertTrue(warnings[0].startswith('TOP_K results are approximate'))
+
+    def test_approximate_top_distinct_count(self):
+        table = self.make_skewed_table(40000, 100000)
+        output_table, warnings = run_table_query('SELECT TOP 3 DISTINCT COUNT a2 WITH (approx)', table)
+        expected_table = [[count, value] for value, count in self.expected_top([r[1] for r in table], 3)]
+        self.assertEqual([record[1] for record in expected_table], [record[1] for record in output_table])
+        max_error = int(warnings[0].split('overestimated by up to ')[1].split(',')[0])
+        for expected_record, record in zip(expected_table, output_table):
+            self.assertTrue(expected_record[0] <= record[0] <= expected_record[0] + max_error)
+
+    def test_approximate_top_distinct_count_is_exact_for_few_records(self):
+        table = self.make_skewed_table(3000, 3)
+        expected_table, _warnings = run_table_query('SELECT DISTINCT COUNT a2', table)
+        expected_table.sort(key=lambda v: -v[0])
+        output_table, warnings = run_table_query('SELECT TOP 4 DISTINCT COUNT a2 WITH (approx)', table)
+        self.assertEqual(expected_table[:4], output_table)
+        self.assertEqual([], warnings)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT TOP_K(a1, 2)", [["x"], [u"y"], ["y"], ["z"], ["x"], ["y"]]))')
+        self.assertEqual("[[[u'y', 'x']]]", output)
+
+
+class TestDistinct(PatchingTestCase):
+    def setUp(self):
+        self.saved_memory_limit = self.save_attribute(rbql_engine, 'distinct_records_memory_limit')
+
+    def make_table(self):
+        rng = random.Random(30)
+        return [[str(rng.randint(0, 300)), rng.choice('xyz')] for _ in range(3000)]
+
+    def expected_distinct_count(self, records):
+        counts = dict()
+        order = []
+        for record in records:
+            if record not in counts:
+                counts[record] = 0
+                order.append(record)
+            counts[record] += 1
+        return [[counts[record]] + list(record) for record in order]
+
+    def test_distinct_keeps_first_seen_order(self):
+        table = self.make_table()
+        output_table, _warnings = run_table_query('SELECT DISTINCT a1, a2', table)
+        expected_table = [list(record) for record in self.expected_distinct_count([tuple(r) for r in table])]
+        self.assertEqual([record[1:] for record in expected_table], output_table)
+
+    def test_distinct_count(self):
+        table = self.make_table()
+        output_table, _warnings = run_table_query('SELECT DISTINCT COUNT a1, a2', table)
+        self.assertEqual(self.expected_distinct_count([tuple(r) for r in table]), output_table)
+
+    def test_spilled_records_give_same_results(self):
+        table = self.make_table()
+        for query_text in ['SELECT DISTINCT a1, a2', 'SELECT DISTINCT COUNT a1, a2', 'SELECT TOP 20 DISTINCT a1']:
+            rbql_engine.distinct_records_memory_limit = self.saved_memory_limit
+            expected_table, _warnings = run_table_query(query_text, table)
+            rbql_engine.distinct_records_memory_limit = 50
+            output_table, _warnings = run_table_query(query_text, table)
+            self.assertEqual(expected_table, output_table)
+
+    def test_equal_values_are_not_distinct(self):
+        table = [[1], [1.0], [True], [2], [2.5], ['1']]
+        output_table, _warnings = run_table_query('SELECT DISTINCT a1', table)
+        self.assertEqual([[1], [2], [2.5], ['1']], output_table)
+        output_table, _warnings = run_table_query('SELECT DISTINCT COUNT a1', table)
+        self.assertEqual([[3, 1], [1, 2], [1, 2.5], [1, '1']], output_table)
+        rbql_engine.distinct_records_memory_limit = 1
+        output_table, _warnings = run_table_query('SELECT DISTINCT COUNT a1', table)
+        self.assertEqual([[3, 1], [1, 2], [1, 2.5], [1, '1']], output_table)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('rbql_engine.distinct_records_memory_limit = 2\nprint(run_table_query("SELECT DISTINCT COUNT a2", [[1, "a"], [2, u"a"], [3, "b"], [4, "c"], [5, "b"]]))')
+        self.assertEqual("[[2, 'a'], [2, 'b'], [1, 'c']]", output)
+
+
+class TestSortedGroupBy(PatchingTestCase):
+    query_text = 'SELECT a1, COUNT(*), SUM(a2), MEDIAN(a2), ARRAY_AGG(a2), APPROX_COUNT_DISTINCT(a2) GROUP BY a1'
+
+    def setUp(self):
+        self.save_attribute(rbql_engine, 'values_spill_threshold')
+        self.save_attribute(rbql_engine, 'sorted_aggregation_detection_groups')
+        self.saved_groups = []
+        self.spy_function(rbql_engine.AggregateWriter, 'save_finished_group', lambda _result, _writer, key: self.saved_groups.append(key))
+
+    def make_table(self, keys):
+        return [[key, str(i)] for i, key in enumerate(keys)]
+
+    def check_same_as_hash_aggregation(self, table, expect_fallback, same_order=True):
+        expected_table, expected_warnings = run_table_query(self.query_text, table)
+        output_table, warnings = run_table_query(self.query_text + ' WITH (sorted)', table)
+        if same_order:
+            self.assertEqual(expected_table, output_table)
+        else:
+            self.assertEqual(sorted(expected_table), sorted(output_table))
+        fallback_warnings = [w for w in warnings if w not in expected_warnings]
+        self.assertEqual(1 if expect_fallback else 0, len(fallback_warnings))
+
+    def test_sorted_input(self):
+        rng = random.Random(31)
+        self.check_same_as_hash_aggregation(self.make_table(sorted(rng.choice('abcdefgh') for _ in range(500))), expect_fallback=False)
+
+    def test_descending_input(self):
+        rng = random.Random(31)
+        table = self.make_table(sorted((rng.choice('abcdefgh') for _ in range(500)), reverse=True))
+        expected_table, _warnings = run_table_query(self.query_text, table)
+        output_table, warnings = run_table_query(self.query_text + ' WITH (sorted)', table)
+        # Groups are written in the input order
+        self.assertEqual(list(reversed(expected_table)), output_table)
+        self.assertEqual([], warnings)
+
+    def test_unwritten_groups_fall_back_to_hash_aggregation(self):
+        self.check_same_as_hash_aggregation(self.make_table(['a', 'b', 'd', 'c', 'e', 'c']), expect_fallback=True)
+        self.check_same_as_hash_aggregation(self.make_table(['c', 'd', 'a', 'b', 'd']), expect_fallback=True, same_order=False)
+        self.check_same_as_hash_aggregation(self.make_table(['c', 'b', 'e', 'd']), expect_fallback=True, same_order=False)
+
+    def test_written_group_reappears(self):
+        for keys in [['a', 'b', 'a'], ['a', 'a', 'b', 'c', 'b'], ['a', 'b', 'd', 'c', 'a'], ['c', 'b', 'a', 'd', 'b']]:
+            with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+                run_table_query(self.query_text + ' WITH (sorted)', self.make_table(keys))
+            self.assertIn('Input table is not sorted by GROUP BY key', str(cm.exception))
+
+    def test_spilled_median_group(self):
+        rbql_engine.values_spill_threshold = 5
+        self.check_same_as_hash_aggregation(self.make_table(['b'] * 23 + ['c'] * 11 + ['a'] * 7 + ['c'] * 3), expect_fallback=True, same_order=False)
+        self.check_same_as_hash_aggregation(self.make_table(['a'] * 23 + ['b'] * 11 + ['c'] * 3), expect_fallback=False)
+
+    def test_top_stops_reading_input(self):
+        class CountingIterator(rbql_engine.TableIterator):
+            def get_record(self):
+                self.num_read = getattr(self, 'num_read', 0) + 1
+                return rbql_engine.TableIterator.get_record(self)
+        input_iterator = CountingIterator([[str(i // 2).zfill(4)] for i in range(2000)])
+        output_table = []
+        rbql_engine.query('SELECT TOP 2 a1, COUNT(*) GROUP BY a1 WITH (sorted)', input_iterator, rbql_engine.TableWriter(output_table), [])
+        self.assertEqual([['0000', 2], ['0001', 2]], output_table)
+        self.assertLess(input_iterator.num_read, 10)
+
+    def check_detected_sorted_input(self, keys, expect_saved_groups):
+        table = self.make_table(keys)
+        expected_table, expected_warnings = run_table_query(self.query_text, table)
+        rbql_engine.sorted_aggregation_detection_groups = 3
+        del self.saved_groups[:]
+        output_table, warnings = run_table_query(self.query_text, table)
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+        self.assertEqual(expect_saved_groups, len(self.saved_groups) > 0)
+
+    def test_detected_sorted_input(self):
+        rbql_engine.values_spill_threshold = 5
+        self.check_detected_sorted_input(sorted(['k{:03}'.format(i // 7) for i in range(300)]), expect_saved_groups=True)
+        # Finished groups are loaded back when a key breaks the order
+        self.check_detected_sorted_input(['a', 'b', 'b', 'c', 'd', 'e', 'f', 'c', 'a', 'g', 'f'], expect_saved_groups=True)
+        self.check_detected_sorted_input(['d', 'c', 'b', 'a', 'e', 'f', 'g'], expect_saved_groups=False)
+        self.check_detected_sorted_input(['a', 'b', 'a', 'c', 'd', 'e', 'f'], expect_saved_groups=False)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a1, COUNT(*) GROUP BY a1 WITH (sorted)", [["c"], ["b"], ["b"], ["a"]]))')
+        self.assertEqual("[['c', 1], ['b', 2], ['a', 1]]", output)
+        output = run_python2_snippet('rbql_engine.sorted_aggregation_detection_groups = 2\nprint(run_table_query("SELECT a1, COUNT(*) GROUP BY a1", [["a"], ["b"], ["b"], ["c"], ["d"], ["b"]]))')
+        self.assertEqual("[['a', 1], ['b', 3], ['c', 1], ['d', 1]]", output)
+
+
+class TestGraceHashJoin(JoinMapSpyTestCase):
+    def setUp(self):
+        super(TestGraceHashJoin, self).setUp()
+        self.saved_memory_limit = self.save_attribute(rbql_engine, 'join_table_memory_limit')
+        self.save_attribute(rbql_engine, 'join_spill_partitions')
+        self.num_spills = 0
+        def on_spill_hash_map(_result, _join_map):
+            self.num_spills += 1
+        self.spy_function(rbql_engine.GraceHashJoinMap, 'spill_hash_map', on_spill_hash_map)
+
+    def make_tables(self):
+        rng = random.Random(33)
+        input_table = [[str(rng.randint(0, 200)), str(i)] for i in range(1000)]
+        join_table = [[str(rng.randint(0, 300)), 'v{}'.format(i)] for i in range(300)]
+        input_table[500] = ['7'] # Inconsistent number of fields
+        return input_table, join_table
+
+    def check_same_as_in_memory_join(self, query_text, input_table, join_table):
+        expected_table, expected_warnings = run_table_query(query_text, input_table, join_table)
+        self.assertEqual(0, self.num_spills)
+        rbql_engine.join_table_memory_limit = 50
+        rbql_engine.join_spill_partitions = 4
+        try:
+            output_table, warnings = run_table_query(query_text, input_table, join_table)
+        finally:
+            rbql_engine.join_table_memory_limit = self.saved_memory_limit
+        self.assertEqual(1, self.num_spills)
+        self.num_spills = 0
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+
+    def test_same_results_as_in_memory_join(self):
+        input_table, join_table = self.make_tables()
+        for query_text in ['SELECT NR, a2, b2, bNR JOIN B ON a1 == b1', 'SELECT a2, b2 LEFT JOIN B ON a1 == b1 WHERE NR % 3 != 0', 'SELECT b2, COUNT(*) JOIN B ON a1 == b1 GROUP BY b2', 'SELECT TOP 10 a2, b2 LEFT JOIN B ON a1 == b1 ORDER BY NR DESC', 'SELECT TOP 10 a2, b2 JOIN B ON a1 == b1']:
+            self.check_same_as_in_memory_join(query_text, input_table, join_table)
+        self.assertEqual(['GraceHashJoinMap'] * 10, self.built_join_maps)
+
+    def test_strict_left_join(self):
+        input_table = [[str(i % 20), str(i)] for i in range(100)]
+        join_table = [[str(i), 'v{}'.format(i)] for i in range(100)]
+        self.check_same_as_in_memory_join('SELECT a2, b2 STRICT LEFT JOIN B ON a1 == b1', input_table, join_table)
+        rbql_engine.join_table_memory_limit = 50
+        with self.assertRaises(rbql_engine.RbqlRuntimeError):
+            run_table_query('SELECT a2, b2 STRICT LEFT JOIN B ON a1 == b1', input_table + [['missing', '0']], join_table)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('rbql_engine.join_table_memory_limit = 2\nprint(run_table_query("SELECT a2, b2 LEFT JOIN B ON a1 == b1", [[1, "p"], [2, "q"], [3, "r"], [1, "s"]], [[1, "x"], [3, "y"], [1, "z"], [4, "w"]]))')
+        self.assertEqual("[['p', 'x'], ['p', 'z'], ['q', None], ['r', 'y'], ['s', 'x'], ['s', 'z']]", output)
+
+
+class TestBinarySearchJoin(JoinMapSpyTestCase):
+    def check_same_as_hash_join(self, query_text, input_table, join_table):
+        expected_table, expected_warnings = run_table_query(query_text, input_table, join_table)
+        output_table, warnings = run_table_query(query_text + ' WITH (binarysearch)', input_table, join_table)
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+        self.assertEqual('BinarySearchJoinMap', self.built_join_maps[-1])
+
+    def test_same_results_as_hash_join(self):
+        rng = random.Random(35)
+        # Only the join table has to be sorted
+        input_table = [['k{:03d}'.format(rng.randint(0, 150)), str(i)] for i in range(400)]
+        join_table = sorted([['k{:03d}'.format(rng.randint(0, 150)), 'v{}'.format(i)] for i in range(200)], key=lambda r: r[0])
+        for query_text in ['SELECT a1, a2, b2, bNR JOIN B ON a1 == b1', 'SELECT * LEFT JOIN B ON a1 == b1', 'SELECT TOP 7 a2, b2 JOIN B ON a1 == b1', 'SELECT b2, COUNT(*) JOIN B ON a1 == b1 GROUP BY b2']:
+            self.check_same_as_hash_join(query_text, input_table, join_table)
+
+    def test_multiple_join_keys(self):
+        input_table = [['b', '1', 'x'], ['a', '2', 'y'], ['a', '1', 'z'], ['b', '1', 'w']]
+        join_table = [['a', '1', 'p'], ['a', '1', 'q'], ['b', '0', 'r'], ['b', '1', 's']]
+        self.check_same_as_hash_join('SELECT a3, b3 JOIN B ON a1 == b1 AND a2 == b2', input_table, join_table)
+
+    def test_unsorted_join_table(self):
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            run_table_query('SELECT a2, b2 JOIN B ON a1 == b1 WITH (binarysearch)', [['a', '1']], [['a', 'x'], ['c', 'y'], ['b', 'z']])
+        self.assertIn('Join table "B" is not sorted', str(cm.exception))
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a2, b2 LEFT JOIN B ON a1 == b1 WITH (binarysearch)", [["c", 1], ["b", 2], ["a", 3]], [["b", "x"], ["b", "y"], ["c", "z"]]))')
+        self.assertEqual("[[1, 'z'], [2, 'x'], [2, 'y'], [3, None]]", output)
+
+
+class TestCompactJoinRecords(JoinMapSpyTestCase):
+    join_column_names = ['k', 'c2', 'c3', 'c4', 'c5', 'c6']
+
+    def setUp(self):
+        super(TestCompactJoinRecords, self).setUp()
+        self.saved_query_uses_whole_join_record = self.save_attribute(rbql_engine, 'query_uses_whole_join_record')
+
+    def make_tables(self):
+        rng = random.Random(36)
+        input_table = [[str(rng.randint(0, 60)), str(i)] for i in range(300)]
+        join_table = [[str(rng.randint(0, 60))] + ['v{}_{}'.format(i, j) for j in range(2, 7)] for i in range(100)]
+        join_table[10] = join_table[10][:3] # Short record
+        return input_table, join_table
+
+    def run_query(self, query_text, input_table, join_table):
+        return run_table_query(query_text, input_table, join_table, ['id', 'x'], self.join_column_names)
+
+    def test_same_results_as_whole_records(self):
+        input_table, join_table = self.make_tables()
+        # UPDATE queries require unique join keys
+        unique_join_table = list(dict((record[0], record) for record in reversed(join_table)).values())
+        query_texts = ['SELECT a1, b3 JOIN B ON a1 == b1', 'SELECT a.x, b.c5, bNF LEFT JOIN B ON a.id == b.k WHERE b.c3 is None or b.c3 != "v5_3"', 'SELECT b["c6"], b[2] JOIN B ON a1 == b1 ORDER BY b.c2 DESC', 'SELECT b.c2, COUNT(*) JOIN B ON a1 == b1 GROUP BY b.c2']
+        for query_text, join_table in [(query_text, join_table) for query_text in query_texts] + [('UPDATE SET a2 = b.c4 LEFT JOIN B ON a1 == b1', unique_join_table)]:
+            output_table, warnings = self.run_query(query_text, input_table, join_table)
+            stored_field_indices = self.built_join_map_impls[-1].stored_field_indices
+            self.assertIsNotNone(stored_field_indices)
+            self.assertLess(len(stored_field_indices), 4)
+            rbql_engine.query_uses_whole_join_record = lambda format_expression, rb_actions: True
+            expected_table, expected_warnings = self.run_query(query_text, input_table, join_table)
+            rbql_engine.query_uses_whole_join_record = self.saved_query_uses_whole_join_record
+            self.assertIsNone(self.built_join_map_impls[-1].stored_field_indices)
+            self.assertEqual(expected_table, output_table)
+            self.assertEqual(expected_warnings, warnings)
+
+    def test_stored_records_contain_referenced_fields_only(self):
+        input_table, join_table = self.make_tables()
+        self.run_query('SELECT a1, b.c4 JOIN B ON a1 == b1', input_table, join_table)
+        join_map = self.built_join_map_impls[-1]
+        self.assertEqual([0, 3], join_map.stored_field_indices)
+        self.assertTrue(all(len(record_b) == 2 for records in join_map.hash_map.values() for _nr, _nf, record_b in records))
+
+    def test_whole_records_are_stored_for_star_queries(self):
+        input_table, join_table = self.make_tables()
+        for query_text in ['SELECT * JOIN B ON a1 == b1', 'SELECT a1, b.* JOIN B ON a1 == b1']:
+            self.run_query(query_text, input_table, join_table)
+            self.assertIsNone(self.built_join_map_impls[-1].stored_field_indices)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a2, b4, b2 LEFT JOIN B ON a1 == b1", [[1, "p"], [2, "q"]], [[1, "x", "y", "z"], [3, "u", "v", "w"]]))')
+        self.assertEqual("[['p', 'z', 'x'], ['q', None, None]]", output)
+
+
+class TestJoinFilterPushdown(JoinMapSpyTestCase):
+    def setUp(self):
+        super(TestJoinFilterPushdown, self).setUp()
+        self.saved_is_join_table_only_expression = self.save_attribute(rbql_engine, 'is_join_table_only_expression')
+
+    def make_tables(self):
+        rng = random.Random(38)
+        input_table = [[str(rng.randint(0, 40)), str(i)] for i in range(300)]
+        join_table = [[str(rng.randint(0, 40)), rng.choice(['x', 'y', 'zz', '5', '12'])] for _ in range(100)]
+        return input_table, join_table
+
+    def get_num_stored_join_records(self):
+        return sum(len(records) for records in self.built_join_map_impls[-1].hash_map.values())
+
+    def check_same_as_without_pushdown(self, query_text, input_table, join_table, expect_filter, user_init_code=''):
+        output_table, warnings = [], []
+        rbql_engine.query_table(query_text, input_table, output_table, warnings, join_table, user_init_code=user_init_code)
+        self.assertEqual(expect_filter, self.built_join_map_impls[-1].record_filter is not None)
+        num_stored_records = self.get_num_stored_join_records()
+        rbql_engine.is_join_table_only_expression = lambda expression, input_variables_map, join_variables_map: False
+        expected_table, expected_warnings = [], []
+        rbql_engine.query_table(query_text, input_table, expected_table, expected_warnings, join_table, user_init_code=user_init_code)
+        rbql_engine.is_join_table_only_expression = self.saved_is_join_table_only_expression
+        self.assertIsNone(self.built_join_map_impls[-1].record_filter)
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+        if expect_filter:
+            self.assertLess(num_stored_records, self.get_num_stored_join_records())
+
+    def test_join_table_only_conjuncts_filter_join_records(self):
+        input_table, join_table = self.make_tables()
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE b2 == "x"', input_table, join_table, expect_filter=True)
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE int(a2) % 2 == 0 and b2 in ["x", "y"] and len(b2) == 1', input_table, join_table, expect_filter=True)
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE like(b2, "z%")', input_table, join_table, expect_filter=True)
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE is_long(b2)', input_table, join_table, expect_filter=True, user_init_code='def is_long(v):\n    return len(v) > 1')
+        self.check_same_as_without_pushdown('SELECT a1, COUNT(*) JOIN B ON a1 == b1 WHERE b2 != "y" GROUP BY a1', input_table, join_table, expect_filter=True)
+
+    def test_conjuncts_with_input_fields_are_not_pushed_down(self):
+        input_table, join_table = self.make_tables()
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE b2 == "x" or a2 == "7"', input_table, join_table, expect_filter=False)
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE b2 != a2', input_table, join_table, expect_filter=False)
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE bNR > 10', input_table, join_table, expect_filter=False)
+
+    def test_left_join(self):
+        input_table, join_table = self.make_tables()
+        # The filter rejects the null record of unmatched input records just like WHERE in the main loop
+        self.check_same_as_without_pushdown('SELECT a2, b2 LEFT JOIN B ON a1 == b1 WHERE b2 == "x"', input_table, join_table, expect_filter=True)
+        self.check_same_as_without_pushdown('SELECT a2, b2 LEFT JOIN B ON a1 == b1 WHERE b2 is None or b2 == "x"', input_table, join_table, expect_filter=False)
+
+    def test_filter_errors_are_reported_by_main_loop(self):
+        input_table, join_table = self.make_tables()
+        with self.assertRaises(rbql_engine.RbqlRuntimeError):
+            run_table_query('SELECT a2, b2 JOIN B ON a1 == b1 WHERE int(b2) > 6', input_table, join_table)
+        # Records with non-numeric values are rejected by the first conjunct in the main loop, so the error in the filter is harmless
+        self.check_same_as_without_pushdown('SELECT a2, b2 JOIN B ON a1 == b1 WHERE b2.isdigit() and int(b2) > 6', input_table, join_table, expect_filter=True)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a2, b2 JOIN B ON a1 == b1 WHERE b2 != \'y\' and a2 != \'r\'", [[1, "p"], [2, "q"], [2, "r"]], [[1, "x"], [2, "y"], [2, "z"]]))')
+        self.assertEqual("[['p', 'x'], ['q', 'z']]", output)
+
+
+class TestJoinKeyLookups(JoinMapSpyTestCase):
+    def test_missed_lookups_do_not_grow_hash_map(self):
+        input_table = [[str(i)] for i in range(1000)]
+        join_table = [[str(i), 'v'] for i in range(0, 1000, 100)]
+        output_table, _warnings = run_table_query('SELECT a1, b2 LEFT JOIN B ON a1 == b1', input_table, join_table)
+        self.assertEqual(1000, len(output_table))
+        self.assertEqual(10, len(self.built_join_map_impls[-1].hash_map))
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        key_filter = rbql_engine.KeyBloomFilter(8192, 5)
+        keys = [str(i) for i in range(500)] + list(range(500)) + [('a', i) for i in range(500)]
+        for key in keys:
+            key_filter.add(key)
+        self.assertTrue(all(key_filter.may_contain(key) for key in keys))
+        num_false_positives = sum(1 for i in range(1000, 11000) if key_filter.may_contain(str(i)))
+        self.assertLess(num_false_positives, 10000 * 0.2)
+
+    def test_spilled_join_with_saturated_bloom_filter(self):
+        self.save_attribute(rbql_engine, 'join_table_memory_limit')
+        self.save_attribute(rbql_engine, 'join_bloom_filter_bits')
+        rng = random.Random(39)
+        input_table = [[str(rng.randint(0, 5000)), str(i)] for i in range(2000)]
+        join_table = [[str(rng.randint(0, 5000)), 'v{}'.format(i)] for i in range(300)]
+        query_text = 'SELECT a2, b2, bNR LEFT JOIN B ON a1 == b1'
+        expected_table, _warnings = run_table_query(query_text, input_table, join_table)
+        rbql_engine.join_table_memory_limit = 20
+        for num_bits in [64, 1024 * 1024]:
+            rbql_engine.join_bloom_filter_bits = num_bits
+            output_table, _warnings = run_table_query(query_text, input_table, join_table)
+            self.assertEqual(expected_table, output_table)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('rbql_engine.join_table_memory_limit = 2\nrbql_engine.join_bloom_filter_bits = 1024\nprint(run_table_query("SELECT a2, b2 JOIN B ON a1 == b1", [[i % 7, i] for i in range(10)], [[3, "x"], [u"3", "y"], [5, "z"], [6, "w"]]))')
+        self.assertEqual("[[3, 'x'], [5, 'z'], [6, 'w']]", output)
+
+
+class TestInputTableHashJoin(JoinMapSpyTestCase):
+    def setUp(self):
+        super(TestInputTableHashJoin, self).setUp()
+        self.saved_should_build_join_on_input_table = self.save_attribute(rbql_engine, 'should_build_join_on_input_table')
+        self.save_attribute(rbql_engine, 'join_table_memory_limit')
+
+    def check_same_as_join_table_hash_join(self, query_text, input_table, join_table):
+        expected_table, expected_warnings = run_table_query(query_text, input_table, join_table)
+        self.assertEqual('GraceHashJoinMap', self.built_join_maps[-1])
+        rbql_engine.should_build_join_on_input_table = lambda input_iterator, join_record_iterator: True
+        output_table, warnings = run_table_query(query_text, input_table, join_table)
+        rbql_engine.should_build_join_on_input_table = self.saved_should_build_join_on_input_table
+        self.assertEqual('InputTableHashJoinMap', self.built_join_maps[-1])
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings + ['Join hash map was built on the input table because it is estimated to be much smaller than the join table'], warnings)
+
+    def test_same_results_as_join_table_hash_join(self):
+        rng = random.Random(40)
+        input_table = [[str(rng.randint(0, 500)), str(i)] for i in range(50)]
+        join_table = [[str(rng.randint(0, 500)), 'v{}'.format(i)] for i in range(2000)]
+        input_table[20] = ['7'] # Inconsistent number of fields
+        for query_text in ['SELECT NR, a2, b2, bNR JOIN B ON a1 == b1', 'SELECT a2, b2 LEFT JOIN B ON a1 == b1 WHERE b2 != "v5"', 'SELECT TOP 3 a2, b2 JOIN B ON a1 == b1', 'SELECT b2, COUNT(*) JOIN B ON a1 == b1 GROUP BY b2']:
+            self.check_same_as_join_table_hash_join(query_text, input_table, join_table)
+
+    def test_input_table_above_memory_limit_is_partitioned(self):
+        rng = random.Random(40)
+        input_table = [[str(rng.randint(0, 300)), str(i)] for i in range(200)]
+        join_table = [[str(rng.randint(0, 500)), 'v{}'.format(i)] for i in range(2000)]
+        rbql_engine.join_table_memory_limit = 50
+        for query_text in ['SELECT NR, a2, b2, bNR JOIN B ON a1 == b1', 'SELECT a2, b2 LEFT JOIN B ON a1 == b1 WHERE b2 != "v5"', 'SELECT TOP 3 a2, b2 JOIN B ON a1 == b1']:
+            self.check_same_as_join_table_hash_join(query_text, input_table, join_table)
+            self.assertEqual(rbql_engine.join_spill_partitions, len(self.built_join_map_impls[-1].match_runs))
+
+    def test_strict_left_join(self):
+        join_table = [[str(i), 'v{}'.format(i)] for i in range(100)]
+        self.check_same_as_join_table_hash_join('SELECT a2, b2 STRICT LEFT JOIN B ON a1 == b1', [['5', 'p'], ['7', 'q'], ['5', 'r']], join_table)
+        rbql_engine.should_build_join_on_input_table = lambda input_iterator, join_record_iterator: True
+        with self.assertRaises(rbql_engine.RbqlRuntimeError):
+            run_table_query('SELECT a2, b2 STRICT LEFT JOIN B ON a1 == b1', [['5', 'p'], ['500', 'q']], join_table)
+
+
+class TestSemiJoin(JoinMapSpyTestCase):
+    input_table = [['1', 'p'], ['2', 'q'], ['3', 'r'], ['2', 's']]
+    join_table = [['1', 'x'], ['2', 'y'], ['2', 'z'], ['4', 'w']]
+
+    def check_join(self, query_text, expected_table, expected_join_map):
+        output_table, _warnings = run_table_query(query_text, self.input_table, self.join_table, ['k', 'w'], ['k', 'v'])
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual([expected_join_map], self.built_join_maps)
+        del self.built_join_maps[:]
+
+    def test_semi_join_is_used_when_join_fields_are_referenced_only_in_on_clause(self):
+        expected_table = [['1', 'p'], ['2', 'q'], ['2', 'q'], ['2', 's'], ['2', 's']]
+        self.check_join('SELECT a.* JOIN B ON a.k == b.k', expected_table, 'SemiJoinMap')
+        self.check_join('SELECT a1, a2 JOIN B ON a1 == b1', expected_table, 'SemiJoinMap')
+        self.check_join('SELECT a.k, a.w JOIN B ON a.k == b["k"]', expected_table, 'SemiJoinMap')
+        self.check_join('SELECT a.*, b.v JOIN B ON a.k == b.k', [['1', 'p', 'x'], ['2', 'q', 'y'], ['2', 'q', 'z'], ['2', 's', 'y'], ['2', 's', 'z']], 'GraceHashJoinMap')
+
+    def test_semi_join_with_other_join_types_and_aggregates(self):
+        self.check_join('SELECT a.* LEFT JOIN B ON a.k == b.k', [['1', 'p'], ['2', 'q'], ['2', 'q'], ['3', 'r'], ['2', 's'], ['2', 's']], 'SemiJoinMap')
+        self.check_join('SELECT a.k, COUNT(*) JOIN B ON a.k == b.k GROUP BY a.k', [['1', 1], ['2', 4]], 'SemiJoinMap')
+        with self.assertRaises(rbql_engine.RbqlRuntimeError):
+            run_table_query('SELECT a.* STRICT LEFT JOIN B ON a.k == b.k', self.input_table, self.join_table, ['k', 'w'], ['k', 'v'])
+
+    def test_join_fields_outside_on_clause_disable_semi_join(self):
+        self.check_join('SELECT a.* JOIN B ON a.k == b.k WHERE b.v != "z"', [['1', 'p'], ['2', 'q'], ['2', 's']], 'GraceHashJoinMap')
+        self.check_join('SELECT a.k, bNR JOIN B ON a.k == b.k', [['1', 1], ['2', 2], ['2', 3], ['2', 2], ['2', 3]], 'GraceHashJoinMap')
+        self.check_join('SELECT * JOIN B ON a.k == b.k ORDER BY b.v + a.w DESC', [['2', 's', '2', 'z'], ['2', 'q', '2', 'z'], ['2', 's', '2', 'y'], ['2', 'q', '2', 'y'], ['1', 'p', '1', 'x']], 'GraceHashJoinMap')
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a1 JOIN B ON a1 == b1", [[1], [2]], [[2], [2], [3]]))')
+        self.assertEqual('[[2], [2]]', output)
+
+
+class TestMergeJoin(JoinMapSpyTestCase):
+    def make_sorted_tables(self):
+        rng = random.Random(32)
+        input_table = sorted([['k{:03d}'.format(rng.randint(0, 150)), str(i)] for i in range(400)], key=lambda r: r[0])
+        join_table = sorted([['k{:03d}'.format(rng.randint(0, 150)), 'v{}'.format(i)] for i in range(200)], key=lambda r: r[0])
+        return input_table, join_table
+
+    def check_same_as_hash_join(self, query_text, input_table, join_table):
+        expected_table, expected_warnings = run_table_query(query_text, input_table, join_table)
+        output_table, warnings = run_table_query(query_text + ' WITH (mergejoin)', input_table, join_table)
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+        self.assertEqual('MergeJoinMap', self.built_join_maps[-1])
+
+    def test_same_results_as_hash_join(self):
+        input_table, join_table = self.make_sorted_tables()
+        for query_text in ['SELECT a1, a2, b2 JOIN B ON a1 == b1', 'SELECT * LEFT JOIN B ON a1 == b1', 'SELECT a2, bNR JOIN B ON a1 == b1', 'SELECT a1, COUNT(*) JOIN B ON a1 == b1 GROUP BY a1']:
+            self.check_same_as_hash_join(query_text, input_table, join_table)
+
+    def test_multiple_join_keys(self):
+        input_table = [['a', '1', 'x'], ['a', '2', 'y'], ['b', '1', 'z'], ['b', '1', 'w']]
+        join_table = [['a', '1', 'p'], ['a', '1', 'q'], ['b', '0', 'r'], ['b', '1', 's']]
+        self.check_same_as_hash_join('SELECT a3, b3 JOIN B ON a1 == b1 AND a2 == b2', input_table, join_table)
+
+    def test_strict_left_join(self):
+        self.check_same_as_hash_join('SELECT a2, b2 STRICT LEFT JOIN B ON a1 == b1', [['a', '1'], ['a', '2'], ['c', '3']], [['a', 'x'], ['b', 'y'], ['c', 'z']])
+        with self.assertRaises(rbql_engine.RbqlRuntimeError):
+            run_table_query('SELECT a2, b2 STRICT LEFT JOIN B ON a1 == b1 WITH (mergejoin)', [['a', '1'], ['b', '2']], [['a', 'x'], ['c', 'z']])
+
+    def test_top(self):
+        input_table, join_table = self.make_sorted_tables()
+        self.check_same_as_hash_join('SELECT TOP 5 a2, b2 JOIN B ON a1 == b1', input_table, join_table)
+
+    def test_unsorted_tables(self):
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            run_table_query('SELECT a2, b2 JOIN B ON a1 == b1 WITH (mergejoin)', [['b', '1'], ['a', '2']], [['a', 'x'], ['b', 'y']])
+        self.assertIn('Input table "A" is not sorted', str(cm.exception))
+        # Unsorted tail of B is detected even if the input table has no keys there
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            run_table_query('SELECT a2, b2 JOIN B ON a1 == b1 WITH (mergejoin)', [['a', '1']], [['a', 'x'], ['c', 'y'], ['b', 'z']])
+        self.assertIn('Join table "B" is not sorted', str(cm.exception))
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a2, b2 LEFT JOIN B ON a1 == b1 WITH (mergejoin)", [["a", 1], ["b", 2], ["b", 3]], [["b", "x"], ["b", "y"], ["c", "z"]]))')
+        self.assertEqual("[[1, None], [2, 'x'], [2, 'y'], [3, 'x'], [3, 'y']]", output)
+
+
+class TestRangeJoins(unittest.TestCase):
+    def make_tables(self):
+        rng = random.Random(41)
+        input_table = [[rng.choice('xyz'), str(rng.randint(0, 1000)), str(i)] for i in range(300)]
+        join_table = [[rng.choice('xyzw'), str(rng.randint(0, 1000)), 'v{}'.format(i)] for i in range(200)]
+        return input_table, join_table
+
+    def expected_asof(self, input_table, join_table, op, backward, left):
+        result = []
+        for record_a in input_table:
+            ts_a = int(record_a[1])
+            candidates = [record_b for record_b in join_table if record_b[0] == record_a[0] and op(ts_a, int(record_b[1]))]
+            if len(candidates):
+                # The closest join record, ties are resolved by the join table order: the last one backward and the first one forward
+                if backward:
+                    best = max(int(r[1]) for r in candidates)
+                    record_b = [r for r in candidates if int(r[1]) == best][-1]
+                else:
+                    best = min(int(r[1]) for r in candidates)
+                    record_b = [r for r in candidates if int(r[1]) == best][0]
+                result.append([record_a[2], record_b[2]])
+            elif left:
+                result.append([record_a[2], None])
+        return result
+
+    def test_asof_join(self):
+        input_table, join_table = self.make_tables()
+        operators = [('>=', lambda a, b: a >= b, True), ('>', lambda a, b: a > b, True), ('<=', lambda a, b: a <= b, False), ('<', lambda a, b: a < b, False)]
+        for op_name, op, backward in operators:
+            for join_type, left in [('ASOF JOIN', False), ('LEFT ASOF JOIN', True)]:
+                output_table, _warnings = run_table_query('SELECT a3, b3 {} B ON a1 == b1 AND a2 {} b2'.format(join_type, op_name), input_table, join_table)
+                self.assertEqual(self.expected_asof(input_table, join_table, op, backward, left), output_table)
+
+    def test_asof_join_with_swapped_condition(self):
+        input_table, join_table = self.make_tables()
+        expected_table, _warnings = run_table_query('SELECT a3, b3 ASOF JOIN B ON a1 == b1 AND a2 >= b2', input_table, join_table)
+        output_table, _warnings = run_table_query('SELECT a3, b3 ASOF JOIN B ON b1 == a1 AND b2 <= a2', input_table, join_table)
+        self.assertEqual(expected_table, output_table)
+
+    def test_interval_join_gives_same_matches_as_join_with_where(self):
+        rng = random.Random(41)
+        input_table = [[rng.choice('xyz'), str(rng.randint(0, 100)), str(i)] for i in range(300)]
+        join_table = []
+        for i in range(100):
+            lo = rng.randint(0, 100)
+            join_table.append([rng.choice('xyzw'), str(lo), str(lo + rng.randint(0, 30)), 'v{}'.format(i)])
+        for lo_op, hi_op in [('<=', '<'), ('<', '<='), ('<=', '<='), ('<', '<')]:
+            condition = 'b2 {} a2 {} b3'.format(lo_op, hi_op)
+            output_table, _warnings = run_table_query('SELECT a3, b4 INTERVAL JOIN B ON a1 == b1 AND ' + condition, input_table, join_table)
+            where_condition = 'float(b2) {} float(a2) {} float(b3)'.format(lo_op, hi_op)
+            expected_table, _warnings = run_table_query('SELECT a3, b4 JOIN B ON a1 == b1 WHERE ' + where_condition, input_table, join_table)
+            # Matches of each input record are ordered by the interval lower bound instead of the join table order
+            self.assertEqual(sorted(expected_table), sorted(output_table))
+            self.assertEqual([r[0] for r in expected_table], [r[0] for r in output_table])
+
+    def test_left_interval_join_without_equality_keys(self):
+        input_table = [['1'], ['5'], ['12'], ['2020-01-01']]
+        join_table = [['0', '5', 'p'], ['4', '10', 'q'], ['5', '6', 'r']]
+        output_table, _warnings = run_table_query('SELECT a1, b3 LEFT INTERVAL JOIN B ON b1 <= a1 < b2', input_table, join_table)
+        self.assertEqual([['1', 'p'], ['5', 'q'], ['5', 'r'], ['12', None], ['2020-01-01', None]], output_table)
+
+    def test_string_range_values(self):
+        input_table = [['2024-01-15'], ['2024-03-01'], ['2023-12-31']]
+        join_table = [['2024-01-01', 'jan'], ['2024-02-01', 'feb'], ['2024-03-01', 'mar']]
+        output_table, _warnings = run_table_query('SELECT a1, b2 LEFT ASOF JOIN B ON a1 >= b1', input_table, join_table)
+        self.assertEqual([['2024-01-15', 'jan'], ['2024-03-01', 'mar'], ['2023-12-31', None]], output_table)
+
+    def test_invalid_conditions(self):
+        for query_text in ['SELECT * ASOF JOIN B ON a1 == b1', 'SELECT * ASOF JOIN B ON a1 >= a2', 'SELECT * INTERVAL JOIN B ON a1 <= b1 < b2', 'SELECT * INTERVAL JOIN B ON b1 <= a1']:
+            with self.assertRaises(rbql_engine.RbqlParsingError):
+                run_table_query(query_text, [['1', '2']], [['1', '2']])
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a2, b3 LEFT ASOF JOIN B ON a1 == b1 AND a2 >= b2", [["x", 5], ["x", 1], ["y", 7]], [["x", 2, "p"], ["x", 4, "q"], ["y", 8, "r"]]))')
+        self.assertEqual("[[5, 'q'], [1, None], [7, None]]", output)
+
+
+class TestStageFusion(PatchingTestCase):
+    def setUp(self):
+        self.saved_group_fused_stages = self.save_attribute(rbql_engine, 'group_fused_stages')
+
+    def make_table(self):
+        rng = random.Random(44)
+        table = [[rng.choice('xyz'), str(rng.randint(0, 100)), str(i)] for i in range(500)]
+        table[77] = ['x', '5'] # Inconsistent number of fields
+        return table
+
+    def run_without_fusion(self, query_text, table, column_names=None):
+        rbql_engine.group_fused_stages = lambda query_stages: [[query_stage_text] for query_stage_text in query_stages]
+        try:
+            return run_table_query(query_text, table, input_column_names=column_names)
+        finally:
+            rbql_engine.group_fused_stages = self.saved_group_fused_stages
+
+    def check_same_as_without_fusion(self, query_text, table, num_stage_groups, column_names=None):
+        self.assertEqual(num_stage_groups, len(rbql_engine.group_fused_stages(rbql_engine.split_query_to_stages(query_text))))
+        expected_table, expected_warnings = self.run_without_fusion(query_text, table, column_names)
+        output_table, warnings = run_table_query(query_text, table, input_column_names=column_names)
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+
+    def test_same_results_as_separate_stages(self):
+        table = self.make_table()
+        self.check_same_as_without_fusion('SELECT a1, int(a2) * 2 WHERE NR % 2 == 0 |> SELECT a2, a1, NR WHERE a2 > 10 |> SELECT * ORDER BY a1, a3', table, 1)
+        self.check_same_as_without_fusion('SELECT * EXCEPT a2 |> SELECT a1, COUNT(*) GROUP BY a1', table, 1)
+        self.check_same_as_without_fusion('SELECT a1, NF |> SELECT TOP 5 * WHERE a2 == 2', table, 1)
+        self.check_same_as_without_fusion('SELECT * WHERE a1 != "z" |> SELECT DISTINCT a1 |> SELECT a1 + "!"', table, 2)
+
+    def test_column_names(self):
+        table = [[str(i), str(i * i)] for i in range(100)]
+        self.check_same_as_without_fusion('SELECT a.n AS num, a.sq AS square WHERE a.n != "5" |> SELECT a.square, a.num WHERE int(a.num) % 7 == 0', table, 1, column_names=['n', 'sq'])
+
+    def test_join_stages_are_not_fused(self):
+        table = [r for r in self.make_table() if len(r) == 3]
+        join_table = [['x', 'X'], ['y', 'Y']]
+        query_text = 'SELECT a1, a3 |> SELECT a2, b2 JOIN B ON a1 == b1 |> SELECT a1 WHERE a2 == "X"'
+        self.assertEqual(3, len(rbql_engine.group_fused_stages(rbql_engine.split_query_to_stages(query_text))))
+        output_table, _warnings = run_table_query(query_text, table, join_table)
+        self.assertEqual([[r[2]] for r in table if r[0] == 'x'], output_table)
+
+    def test_errors_in_fused_stages(self):
+        table = [['1'], ['2'], ['x'], ['4']]
+        query_text = 'SELECT int(a1) |> SELECT a1 * 2'
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as expected_cm:
+            self.run_without_fusion(query_text, table)
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            run_table_query(query_text, table)
+        self.assertEqual(str(expected_cm.exception), str(cm.exception))
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT a1 * 2, NR WHERE a1 != 2 |> SELECT a2, a1 WHERE NR > 1", [[1], [2], [3], [4]]))')
+        self.assertEqual('[[3, 6], [4, 8]]', output)
+
+
+class TestQueuePipeline(PatchingTestCase):
+    def setUp(self):
+        # Small batches and queues make the stages block on the pipes with small tables
+        self.patch_attribute(rbql_engine, 'pipeline_batch_size', 10)
+        self.patch_attribute(rbql_engine, 'pipeline_queue_batches', 2)
+
+    def run_with_timeout(self, target, timeout=30):
+        result = []
+        worker = threading.Thread(target=lambda: result.append(target()))
+        worker.daemon = True
+        worker.start()
+        worker.join(timeout)
+        self.assertFalse(worker.is_alive(), 'The query has not finished in {} seconds'.format(timeout))
+        return result[0]
+
+    def test_top_after_two_buffered_stages(self):
+        table = [[str(i)] for i in range(1, 2001)]
+        query_text = 'SELECT DISTINCT a1 WHERE time.sleep(0.0001) is None |> SELECT DISTINCT a1 |> SELECT TOP 1 a1'
+        output_table, _warnings = self.run_with_timeout(lambda: run_table_query(query_text, table))
+        self.assertEqual([['1']], output_table)
+
+    def test_stages_give_same_results_as_single_query(self):
+        table = [[str(i % 37), str(i)] for i in range(3000)]
+        expected_table, _warnings = run_table_query('SELECT a1, COUNT(*) WHERE int(a2) % 3 != 0 GROUP BY a1', table)
+        expected_table.sort(reverse=True)
+        output_table, _warnings = self.run_with_timeout(lambda: run_table_query('SELECT * WHERE int(a2) % 3 != 0 |> SELECT DISTINCT a1, a2 |> SELECT a1, COUNT(*) GROUP BY a1 |> SELECT * ORDER BY a1 DESC', table))
+        self.assertEqual(expected_table, output_table)
+
+    def test_query_multiple_with_top_and_failing_query(self):
+        table = [[str(i)] for i in range(1, 2001)]
+        query_texts = ['SELECT TOP 3 a1 |> SELECT DISTINCT a1', 'SELECT COUNT(*)', 'SELECT int(a1) // (1000 - int(a1))', 'SELECT DISTINCT a1 |> SELECT TOP 2 a1']
+        output_tables = [[] for _ in query_texts]
+        warnings_list = [[] for _ in query_texts]
+        output_writers = [rbql_engine.TableWriter(output_table) for output_table in output_tables]
+        errors = self.run_with_timeout(lambda: rbql_engine.query_multiple(query_texts, rbql_engine.TableIterator(table), output_writers, warnings_list))
+        self.assertEqual([None, None, None], [errors[0], errors[1], errors[3]])
+        self.assertIsInstance(errors[2], rbql_engine.RbqlRuntimeError)
+        self.assertEqual([['1'], ['2'], ['3']], output_tables[0])
+        self.assertEqual([[2000]], output_tables[1])
+        self.assertEqual([['1'], ['2']], output_tables[3])
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        output = run_python2_snippet('print(run_table_query("SELECT DISTINCT a1 |> SELECT TOP 2 a1 ORDER BY a1 DESC", [[i % 5] for i in range(100)]))')
+        self.assertEqual('[[4], [3]]', output)
+
+
+class TestQueryMultiple(PatchingTestCase):
+    def setUp(self):
+        self.patch_attribute(rbql_engine, 'pipeline_batch_size', 10)
+        self.patch_attribute(rbql_engine, 'pipeline_queue_batches', 2)
+
+    def run_multiple(self, query_texts, table, join_table=None):
+        output_tables = [[] for _ in query_texts]
+        warnings_list = [[] for _ in query_texts]
+        output_writers = [rbql_engine.TableWriter(output_table) for output_table in output_tables]
+        join_tables_registries = None
+        if join_table is not None:
+            join_tables_registries = [rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', join_table, None)]) for _ in query_texts]
+        errors = rbql_engine.query_multiple(query_texts, rbql_engine.TableIterator(table), output_writers, warnings_list, join_tables_registries)
+        return errors, output_tables, warnings_list
+
+    def check_same_as_separate_queries(self, query_texts, table, join_table=None):
+        errors, output_tables, warnings_list = self.run_multiple(query_texts, table, join_table)
+        for query_text, error, output_table, warnings in zip(query_texts, errors, output_tables, warnings_list):
+            try:
+                expected_table, expected_warnings = run_table_query(query_text, table, join_table)
+            except Exception as e:
+                self.assertEqual(type(e), type(error), query_text)
+                self.assertEqual(str(e), str(error))
+                continue
+            self.assertIsNone(error, query_text)
+            self.assertEqual(expected_table, output_table, query_text)
+            self.assertEqual(expected_warnings, warnings, query_text)
+        return errors
+
+    def test_same_results_as_separate_queries(self):
+        table = [[str(i), str(i % 7), str(i % 11)] for i in range(500)]
+        join_table = [[str(k), 'name_{}'.format(k)] for k in range(0, 7, 2)]
+        query_texts = [
+            'SELECT a2, COUNT(*), SUM(int(a3)) GROUP BY a2',
+            'SELECT TOP 5 a1, a2 ORDER BY -int(a3), NR',
+            'SELECT DISTINCT a2, a3 WHERE int(a1) > 100',
+            'SELECT a1, b2 JOIN B ON a2 == b1 WHERE int(a1) % 5 == 0',
+            'SELECT TOP 3 * WHERE a2 == "3"',
+            'UPDATE SET a2 = "updated" WHERE a3 == "0"',
+            'SELECT * LIMIT 2 |> SELECT a1',
+        ]
+        errors = self.check_same_as_separate_queries(query_texts, table, join_table)
+        self.assertEqual([None] * len(query_texts), errors)
+        # Records are shared by the queries and UPDATE must not modify them in place
+        self.assertEqual('0', table[0][1])
+
+    def test_errors_and_warnings(self):
+        table = [[str(i), 'x'] for i in range(1, 300)]
+        table[150] = ['150']
+        query_texts = ['SELECT a1, a2', 'SELECT TOP 2 a2', 'SELECT a1 WHERE int(a1) // (200 - int(a1)) < 0', 'SELECT a1 // 0', 'SELECT COUNT(*)']
+        errors = self.check_same_as_separate_queries(query_texts, table)
+        self.assertEqual([None, None, None], [errors[0], errors[1], errors[4]])
+        self.assertIsInstance(errors[2], rbql_engine.RbqlRuntimeError)
+        self.assertIsInstance(errors[3], rbql_engine.RbqlRuntimeError)
+
+    def test_input_table_error_is_reported_by_unfinished_queries(self):
+        class FailingIterator(rbql_engine.TableIterator):
+            def get_record(self):
+                record = rbql_engine.TableIterator.get_record(self)
+                if record is not None and record[0] == 100:
+                    raise rbql_engine.RbqlIOHandlingError('Unable to read record 100')
+                return record
+        output_tables = [[], []]
+        output_writers = [rbql_engine.TableWriter(output_table) for output_table in output_tables]
+        errors = rbql_engine.query_multiple(['SELECT TOP 3 a1', 'SELECT COUNT(*)'], FailingIterator([[i] for i in range(200)]), output_writers, [[], []])
+        self.assertIsNone(errors[0])
+        self.assertEqual([[0], [1], [2]], output_tables[0])
+        self.assertIsInstance(errors[1], rbql_engine.RbqlIOHandlingError)
+
+    @unittest.skipIf(python2_path is None, 'python2 is not available')
+    def test_python2(self):
+        snippet = '''
+output_tables = [[], [], []]
+errors = rbql_engine.query_multiple(['SELECT a1 * 2 WHERE a1 > 2', 'SELECT TOP 1 a1', 'SELECT a1 // (a1 - 3)'], rbql_engine.TableIterator([[i] for i in range(1, 6)]), [rbql_engine.TableWriter(t) for t in output_tables], [[], [], []])
+print([output_tables[0], output_tables[1], [type(e).__name__ for e in errors]])
+'''
+        output = run_python2_snippet(snippet)
+        self.assertEqual("[[[6], [8], [10]], [[1]], ['NoneType', 'NoneType', 'RbqlRuntimeError']]", output)
+
+
+if __name__ == '__main__':
+    unittest.main()
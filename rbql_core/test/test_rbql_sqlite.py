@@ -0,0 +1,89 @@
+import os
+import sys
+import random
+import sqlite3
+import unittest
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, '..'))
+
+from rbql import rbql_engine
+from rbql import rbql_sqlite
+from rbql_test_utils import JoinMapSpyTestCase
+
+
+class TestSqliteLookupJoin(JoinMapSpyTestCase):
+    def setUp(self):
+        super(TestSqliteLookupJoin, self).setUp()
+        self.db_connection = sqlite3.connect(':memory:')
+        rng = random.Random(42)
+        cursor = self.db_connection.cursor()
+        cursor.execute('CREATE TABLE orders (id INTEGER, customer_id INTEGER, region TEXT, amount REAL)')
+        cursor.executemany('INSERT INTO orders VALUES (?, ?, ?, ?)', [(i, rng.randint(0, 150), rng.choice(['n', 's', 'e', 'w']), rng.randint(0, 1000) / 4.0) for i in range(500)])
+        cursor.execute('CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT)')
+        cursor.executemany('INSERT INTO customers VALUES (?, ?)', [(i, 'customer_{}'.format(i)) for i in range(0, 150, 3)])
+        cursor.execute('CREATE TABLE managers (region TEXT, customer_id INTEGER, name TEXT)')
+        cursor.execute('CREATE INDEX managers_index ON managers (region, customer_id)')
+        cursor.executemany('INSERT INTO managers VALUES (?, ?, ?)', [(rng.choice(['n', 's', 'e']), rng.randint(0, 150), 'manager_{}'.format(i)) for i in range(300)])
+        cursor.execute('CREATE TABLE labels (key TEXT, id INTEGER)')
+        cursor.executemany('INSERT INTO labels VALUES (?, ?)', [('ab', 1), ('AB', 2), ('1', 3), (None, 4), ('2', 5), ('ab ', 6)])
+        cursor.execute('CREATE TABLE dictionary (key TEXT COLLATE NOCASE, value TEXT)')
+        cursor.execute('CREATE INDEX dictionary_index ON dictionary (key)')
+        cursor.executemany('INSERT INTO dictionary VALUES (?, ?)', [('AB', 'upper'), (None, 'null'), ('ab', 'lower'), ('1', 'one'), ('Ab', 'mixed')])
+        cursor.close()
+        self.db_connection.commit()
+        self.saved_supports_key_lookups = self.save_attribute(rbql_sqlite.SqliteRecordIterator, 'supports_key_lookups')
+        self.save_attribute(rbql_engine, 'join_lookup_cache_size')
+
+    def tearDown(self):
+        self.db_connection.close()
+
+    def run_query(self, query_text, input_table_name='orders'):
+        output_table = []
+        warnings = []
+        input_iterator = rbql_sqlite.SqliteRecordIterator(self.db_connection, input_table_name)
+        rbql_engine.query(query_text, input_iterator, rbql_engine.TableWriter(output_table), warnings, rbql_sqlite.SqliteDbRegistry(self.db_connection))
+        return output_table, warnings
+
+    def check_same_as_full_scan(self, query_text, input_table_name='orders'):
+        output_table, warnings = self.run_query(query_text, input_table_name)
+        self.assertEqual('LookupJoinMap', self.built_join_maps[-1])
+        rbql_sqlite.SqliteRecordIterator.supports_key_lookups = lambda record_iterator, key_indices: False
+        expected_table, expected_warnings = self.run_query(query_text, input_table_name)
+        rbql_sqlite.SqliteRecordIterator.supports_key_lookups = self.saved_supports_key_lookups
+        self.assertNotEqual('LookupJoinMap', self.built_join_maps[-1])
+        self.assertEqual(expected_table, output_table)
+        self.assertEqual(expected_warnings, warnings)
+
+    def test_integer_primary_key_lookups(self):
+        for query_text in ['SELECT a.id, b.name JOIN customers ON a.customer_id == b.id', 'SELECT a.id, b.name LEFT JOIN customers ON a.customer_id == b.id', 'SELECT a.id, b.name JOIN customers ON a.customer_id == b.id WHERE b.name != "customer_3"']:
+            self.check_same_as_full_scan(query_text)
+
+    def test_join_record_number_queries_scan_table(self):
+        output_table, _warnings = self.run_query('SELECT TOP 20 b.id, bNR JOIN customers ON a.customer_id == b.id')
+        self.assertEqual('GraceHashJoinMap', self.built_join_maps[-1])
+        self.assertEqual(20, len(output_table))
+        self.assertTrue(all(customer_id == (nr - 1) * 3 for customer_id, nr in output_table))
+
+    def test_type_affinity_and_collation(self):
+        # sqlite converts '1' to 1 for the INTEGER PRIMARY KEY column and NOCASE collation matches 'ab' with 'AB', python `==` does neither
+        self.check_same_as_full_scan('SELECT a.key, b.name LEFT JOIN customers ON a.key == b.id', 'labels')
+        self.check_same_as_full_scan('SELECT a.key, b.value LEFT JOIN dictionary ON a.key == b.key', 'labels')
+        output_table, _warnings = self.run_query('SELECT a.key, b.value LEFT JOIN dictionary ON a.key == b.key', 'labels')
+        self.assertEqual([['ab', 'lower'], ['AB', 'upper'], ['1', 'one'], [None, 'null'], ['2', None], ['ab ', None]], output_table)
+
+    def test_lookup_cache_eviction(self):
+        rbql_engine.join_lookup_cache_size = 4
+        self.check_same_as_full_scan('SELECT a.id, b.name LEFT JOIN customers ON a.customer_id == b.id')
+
+    def test_multi_column_index_lookups(self):
+        self.check_same_as_full_scan('SELECT a.id, b.name JOIN managers ON a.region == b.region AND a.customer_id == b.customer_id')
+        self.check_same_as_full_scan('SELECT a.id, b.name LEFT JOIN managers ON a.region == b.region')
+
+    def test_unindexed_columns_are_scanned(self):
+        self.run_query('SELECT a.id, b.name JOIN managers ON a.customer_id == b.customer_id')
+        self.assertEqual('GraceHashJoinMap', self.built_join_maps[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()